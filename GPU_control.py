@@ -1,63 +1,375 @@
-"""Утилита для управления доступом к GPU с файловой блокировкой."""
+"""
+Утилита для управления доступом к GPU с файловой блокировкой.
 
+Блокировка справедливая и учитывает приоритет:
+- внутри процесса ожидающие (потоки и задачи asyncio) стоят в одной очереди:
+  interactive раньше bulk, при равном приоритете — по порядку прихода;
+  за файловую блокировку GPU_LOCK_PATH борется только первый в очереди;
+- между процессами ожидающий interactive держит разделяемую блокировку на файле
+  <GPU_LOCK_PATH>.interactive, и bulk не захватывает GPU, пока она есть.
+
+Interactive ждёт блокирующим flock в отдельном потоке и просыпается сразу после
+освобождения GPU. Bulk проверяет блокировку каждые BULK_POLL_INTERVAL секунд и
+уступает место в очереди interactive своего процесса. Асинхронное ожидание
+(async with gpu_lock(...)) не блокирует цикл событий.
+
+Метрики ожидания и удержания по классам приоритета — gpu.stats().
+"""
+
+import asyncio
 import fcntl
-import time
+import heapq
+import itertools
 import logging
-from contextlib import contextmanager
+import threading
+import time
+from collections import Counter
+
+import config
 
 logger = logging.getLogger(__name__)
 
+INTERACTIVE = "interactive"
+BULK = "bulk"
+PRIORITIES = {INTERACTIVE: 0, BULK: 1}
+
+BULK_POLL_INTERVAL = 0.02
+TIMEOUT_POLL_INTERVAL = 0.005
+
+_ACQUIRED = "acquired"
+_TIMEOUT = "timeout"
+_YIELDED = "yielded"
+
+
+class _Waiter:
+    """Ожидающий в очереди процесса."""
+
+    __slots__ = ("priority", "seq", "granted", "cancelled", "notify")
+
+    def __init__(self, priority: str, seq: int):
+        self.priority = priority
+        self.seq = seq
+        self.granted = False
+        self.cancelled = False
+        self.notify = None
+
+
+class _ClassStats:
+    """Счётчики и длительности ожидания и удержания GPU для класса приоритета."""
+
+    def __init__(self):
+        self.acquired = 0
+        self.timeouts = 0
+        self.yields = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+        self.hold_total = 0.0
+        self.hold_max = 0.0
+
+    def observe_wait(self, seconds: float):
+        self.acquired += 1
+        self.wait_total += seconds
+        self.wait_max = max(self.wait_max, seconds)
+
+    def observe_hold(self, seconds: float):
+        self.hold_total += seconds
+        self.hold_max = max(self.hold_max, seconds)
+
+    def snapshot(self) -> dict:
+        return {
+            "acquired": self.acquired,
+            "timeouts": self.timeouts,
+            "yields": self.yields,
+            "wait_avg": self.wait_total / self.acquired if self.acquired else None,
+            "wait_max": self.wait_max,
+            "hold_avg": self.hold_total / self.acquired if self.acquired else None,
+            "hold_max": self.hold_max,
+        }
+
+
 class GPULock:
     """
-    Менеджер блокировки GPU.
+    Менеджер блокировки GPU, общий для потоков и задач asyncio процесса.
     """
-    def __init__(self, lock_file_path="/shared/gpu.lock", timeout=None):
+
+    def __init__(self, lock_file_path="/shared/gpu.lock"):
         """
         Инициализация менеджера блокировки GPU.
         :param lock_file_path: Путь к файлу блокировки
-        :param timeout: Максимальное время ожидания в секундах (None = бесконечно)
         """
         self.lock_file_path = lock_file_path
-        self.timeout = timeout
-        self.lock_file = None
+        self.intent_file_path = lock_file_path + ".interactive"
+        self._mutex = threading.Lock()
+        self._queue = []
+        self._seq = itertools.count()
+        self._busy = False
+        self._holder = None
+        self._held_since = None
+        self._lock_file = None
+        self._stats = {priority: _ClassStats() for priority in PRIORITIES}
+
+    def acquire(self, priority: str = BULK, timeout=None) -> bool:
+        """
+        Захват GPU с ожиданием в текущем потоке.
+        :param priority: INTERACTIVE или BULK
+        :param timeout: Максимальное время ожидания в секундах (None = бесконечно)
+        :return: True, если GPU захвачен, False — по таймауту
+        :raises RuntimeError: При вызове из потока с работающим циклом событий — ожидание
+            заблокировало бы цикл, а вместе с ним и передачу очереди асинхронным ожидающим
+        """
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            pass
+        else:
+            raise RuntimeError(
+                "Синхронный захват GPU в цикле событий: используйте async with gpu_lock(...) "
+                "или asyncio.to_thread"
+            )
+        started = time.monotonic()
+        deadline = None if timeout is None else started + timeout
+        waiter = _Waiter(priority, next(self._seq))
+        while True:
+            event = threading.Event()
+            waiter.notify = event.set
+            self._enqueue(waiter)
+            if not event.wait(self._remaining(deadline)):
+                self._cancel(waiter)
+                return self._timed_out(priority)
+            if self._finish(waiter, self._contend_safe(priority, deadline), started):
+                return True
+            if waiter.granted:
+                return self._timed_out(priority)
 
-    def acquire(self):
-        """Попытка установить блокировку"""
-        start_time = time.time()
-        self.lock_file = open(self.lock_file_path, "a", encoding="utf-8")
+    async def acquire_async(self, priority: str = BULK, timeout=None) -> bool:
+        """
+        Захват GPU без блокировки цикла событий.
+        :param priority: INTERACTIVE или BULK
+        :param timeout: Максимальное время ожидания в секундах (None = бесконечно)
+        :return: True, если GPU захвачен, False — по таймауту
+        """
+        loop = asyncio.get_running_loop()
+        started = time.monotonic()
+        deadline = None if timeout is None else started + timeout
+        waiter = _Waiter(priority, next(self._seq))
         while True:
+            future = loop.create_future()
+            waiter.notify = lambda future=future: loop.call_soon_threadsafe(_resolve, future)
+            self._enqueue(waiter)
             try:
-                fcntl.flock(self.lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
-                logger.info("Блокировка GPU установлена")
+                await asyncio.wait_for(future, self._remaining(deadline))
+            except asyncio.TimeoutError:
+                self._cancel(waiter)
+                return self._timed_out(priority)
+            except asyncio.CancelledError:
+                self._cancel(waiter)
+                raise
+
+            contend = loop.run_in_executor(None, self._contend_safe, priority, deadline)
+            try:
+                result = await asyncio.shield(contend)
+            except asyncio.CancelledError:
+                contend.add_done_callback(self._abandon)
+                raise
+            if self._finish(waiter, result, started):
                 return True
-            except IOError:
-                if self.timeout is not None and (time.time() - start_time) > self.timeout:
-                    logger.warning("Таймаут ожидания GPU истек")
-                    return False
-                logger.info("GPU занят, жду...")
-                time.sleep(1)
+            if waiter.granted:
+                return self._timed_out(priority)
 
     def release(self):
         """Снятие блокировки"""
-        if self.lock_file:
-            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
-            self.lock_file.close()
-            logger.info("Блокировка GPU снята")
+        with self._mutex:
+            holder = self._holder
+            if holder is not None:
+                self._stats[holder].observe_hold(time.monotonic() - self._held_since)
+            self._holder = self._held_since = None
+        fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        logger.debug("Блокировка GPU снята (%s)", holder)
+        self._release_turn()
+
+    def interactive_waiting(self) -> bool:
+        """Ждёт ли GPU запрос interactive в этом или другом процессе."""
+        with self._mutex:
+            if any(w.priority == INTERACTIVE and not w.cancelled for _, _, w in self._queue):
+                return True
+        return self._remote_interactive_waiting()
+
+    def waiting(self) -> bool:
+        """Ждёт ли GPU кто-либо в этом процессе или interactive в другом процессе."""
+        with self._mutex:
+            if any(not w.cancelled for _, _, w in self._queue):
+                return True
+        return self._remote_interactive_waiting()
+
+    def stats(self) -> dict:
+        """Текущий держатель, очередь процесса и метрики по классам приоритета."""
+        with self._mutex:
+            waiting = Counter(w.priority for _, _, w in self._queue if not w.cancelled)
+            return {
+                "holder": self._holder,
+                "held_for": time.monotonic() - self._held_since if self._held_since else None,
+                "waiting": {priority: waiting[priority] for priority in PRIORITIES},
+                "classes": {priority: stats.snapshot() for priority, stats in self._stats.items()},
+            }
+
+    @staticmethod
+    def _remaining(deadline):
+        return None if deadline is None else max(deadline - time.monotonic(), 0)
+
+    def _timed_out(self, priority: str) -> bool:
+        with self._mutex:
+            self._stats[priority].timeouts += 1
+        logger.warning("Таймаут ожидания GPU истек (%s)", priority)
+        return False
+
+    # Очередь процесса: первый ожидающий получает ход и борется за файловую блокировку
+
+    def _enqueue(self, waiter: _Waiter):
+        with self._mutex:
+            waiter.granted = waiter.cancelled = False
+            heapq.heappush(self._queue, (PRIORITIES[waiter.priority], waiter.seq, waiter))
+            self._dispatch()
+
+    def _dispatch(self):
+        while not self._busy and self._queue:
+            _, _, waiter = heapq.heappop(self._queue)
+            if waiter.cancelled:
+                continue
+            self._busy = True
+            waiter.granted = True
+            waiter.notify()
+
+    def _cancel(self, waiter: _Waiter):
+        with self._mutex:
+            if waiter.granted:
+                self._busy = False
+                self._dispatch()
+            else:
+                waiter.cancelled = True
+
+    def _release_turn(self):
+        with self._mutex:
+            self._busy = False
+            self._dispatch()
+
+    def _finish(self, waiter: _Waiter, result: str, started: float) -> bool:
+        """
+        Обработка результата борьбы за файл. True — GPU захвачен; иначе ход отдан,
+        waiter.granted остаётся True при таймауте и сбрасывается, если bulk уступил очередь.
+        """
+        if result == _ACQUIRED:
+            with self._mutex:
+                self._holder = waiter.priority
+                self._held_since = time.monotonic()
+                self._stats[waiter.priority].observe_wait(self._held_since - started)
+            logger.debug("Блокировка GPU установлена (%s)", waiter.priority)
+            return True
+        self._release_turn()
+        if result == _YIELDED:
+            with self._mutex:
+                self._stats[waiter.priority].yields += 1
+            waiter.granted = False
+        return False
+
+    def _abandon(self, contend: asyncio.Future):
+        """Возврат хода и блокировки, захваченной уже отменённым ожидающим."""
+        if not contend.cancelled():
+            if contend.exception() is not None:
+                # Ход уже возвращён в _contend_safe
+                return
+            if contend.result() == _ACQUIRED:
+                fcntl.flock(self._lock_file, fcntl.LOCK_UN)
+        self._release_turn()
+
+    # Файловая блокировка между процессами
+
+    def _contend_safe(self, priority: str, deadline) -> str:
+        try:
+            return self._contend(priority, deadline)
+        except BaseException:
+            self._release_turn()
+            raise
+
+    def _contend(self, priority: str, deadline) -> str:
+        if self._lock_file is None:
+            self._lock_file = open(self.lock_file_path, "a", encoding="utf-8")
+        if priority == INTERACTIVE:
+            with open(self.intent_file_path, "a", encoding="utf-8") as intent:
+                fcntl.flock(intent, fcntl.LOCK_SH)
+                if deadline is None:
+                    fcntl.flock(self._lock_file, fcntl.LOCK_EX)
+                    return _ACQUIRED
+                return self._poll(deadline, TIMEOUT_POLL_INTERVAL, bulk=False)
+        return self._poll(deadline, BULK_POLL_INTERVAL, bulk=True)
+
+    def _poll(self, deadline, interval: float, bulk: bool) -> str:
+        while True:
+            if bulk:
+                with self._mutex:
+                    if any(w.priority == INTERACTIVE and not w.cancelled for _, _, w in self._queue):
+                        return _YIELDED
+                if not self._remote_interactive_waiting() and self._try_lock():
+                    return _ACQUIRED
+            elif self._try_lock():
+                return _ACQUIRED
+            if deadline is not None and time.monotonic() >= deadline:
+                return _TIMEOUT
+            time.sleep(interval)
+
+    def _try_lock(self) -> bool:
+        try:
+            fcntl.flock(self._lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            return True
+        except BlockingIOError:
+            return False
+
+    def _remote_interactive_waiting(self) -> bool:
+        with open(self.intent_file_path, "a", encoding="utf-8") as intent:
+            try:
+                fcntl.flock(intent, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return True
+            fcntl.flock(intent, fcntl.LOCK_UN)
+            return False
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
+
+
+gpu = GPULock(config.GPU_LOCK_PATH)
+
+
+class _GPULockGuard:
+    """Контекстный менеджер блокировки GPU (with и async with)."""
+
+    def __init__(self, lock: GPULock, priority: str, timeout):
+        self.lock = lock
+        self.priority = priority
+        self.timeout = timeout
 
     def __enter__(self):
         """Вход в контекст"""
-        if not self.acquire():
+        if not self.lock.acquire(self.priority, self.timeout):
             raise RuntimeError("Не удалось захватить GPU")
-        return self
+        return self.lock
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         """Выход из контекста"""
-        self.release()
-
-@contextmanager
-def gpu_lock(timeout=None):
-    """ Контекстный менеджер для блокировки GPU.
-    :param timeout: Максимальное время ожидания"""
-    lock = GPULock(timeout=timeout)
-    with lock:
-        yield
+        self.lock.release()
+
+    async def __aenter__(self):
+        if not await self.lock.acquire_async(self.priority, self.timeout):
+            raise RuntimeError("Не удалось захватить GPU")
+        return self.lock
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.lock.release()
+
+
+def gpu_lock(timeout=None, priority: str = BULK) -> _GPULockGuard:
+    """ Контекстный менеджер для блокировки GPU (with или async with).
+    :param timeout: Максимальное время ожидания
+    :param priority: INTERACTIVE (запросы пользователей) или BULK (загрузка данных)"""
+    return _GPULockGuard(gpu, priority, timeout)
@@ -3,98 +3,287 @@
 """
 
 import asyncio
+import importlib.util
 import logging
+import time
+import uuid
+from contextlib import aclosing
 import httpx
-from typing import Literal, Optional
+from typing import AsyncIterator, Literal, Optional
 from fastapi import HTTPException
 from mistralai import Mistral
 from mistralai import ChatCompletionResponse as MistralChatCompletionResponse
 from openai import AsyncOpenAI
 from openai.types.responses import Response as OpenAIChatCompletionResponse
+import config
 from config import MISTRAL_API_KEY, OPENAI_API_KEY, DEEPSEEK_API_KEY, PROXY
+from cache import ai_response_cache, query_embedding_cache
+from circuit_breaker import CircuitBreaker
+from context_builder import fit_context
+from llm_metrics import (
+    get_model_stats, record_call, record_fallback, record_retry, record_ttfb
+)
 from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type, before_log
 
 logger = logging.getLogger(__name__)
 
+# HTTP/2 доступен только при установленном пакете h2
+HTTP2_AVAILABLE = importlib.util.find_spec("h2") is not None
+
+
+def create_http_client(proxy: Optional[str] = None, model: Optional[str] = None) -> httpx.AsyncClient:
+    """
+    Создание долгоживущего HTTP клиента с пулом keep-alive соединений.
+
+    :param proxy: Адрес прокси (None — без прокси).
+    :param model: Модель, для которой учитывается время до заголовков ответа (TTFB).
+    """
+    event_hooks = {}
+    if model is not None:
+        async def mark_request(request: httpx.Request):
+            request.extensions["llm_started"] = time.perf_counter()
+
+        async def mark_response(response: httpx.Response):
+            started = response.request.extensions.get("llm_started")
+            if started is not None:
+                record_ttfb(model, time.perf_counter() - started)
+
+        event_hooks = {"request": [mark_request], "response": [mark_response]}
+
+    return httpx.AsyncClient(
+        event_hooks=event_hooks,
+        proxy=proxy,
+        http2=config.LLM_HTTP2 and HTTP2_AVAILABLE,
+        limits=httpx.Limits(
+            max_connections=config.LLM_MAX_CONNECTIONS,
+            max_keepalive_connections=config.LLM_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=config.LLM_KEEPALIVE_EXPIRY,
+        ),
+        timeout=httpx.Timeout(config.LLM_TIMEOUT, connect=config.LLM_CONNECT_TIMEOUT),
+    )
+
+def _count_retry(retry_state):
+    """Учёт повторной попытки в метриках модели (второй аргумент обработчика — имя модели)."""
+    record_retry(retry_state.args[1])
+
 # Декораторы для повторных попыток
 @retry(
     stop=stop_after_attempt(3),
     wait=wait_fixed(2),
     retry=retry_if_exception_type((asyncio.TimeoutError, ConnectionError, ValueError)),
-    before=before_log(logger, logging.INFO)
+    before=before_log(logger, logging.INFO),
+    before_sleep=_count_retry
 )
-async def mistral_request(api_key: str, model_name: str, messages: list) -> MistralChatCompletionResponse:
+async def mistral_request(client: Mistral, model_name: str, messages: list) -> MistralChatCompletionResponse:
     """Отправка запроса в Mistral API с автоматическими повторными попытками."""
-    async with Mistral(api_key=api_key) as client:
-        return await client.chat.complete_async(
-            model=model_name,
-            messages=messages
-        )
+    return await client.chat.complete_async(
+        model=model_name,
+        messages=messages
+    )
 
 @retry(
     stop=stop_after_attempt(3),
     wait=wait_fixed(2),
     retry=retry_if_exception_type((asyncio.TimeoutError, ConnectionError, ValueError)),
-    before=before_log(logger, logging.INFO)
+    before=before_log(logger, logging.INFO),
+    before_sleep=_count_retry
 )
-async def openai_response_request(api_key: str, model_name: str, input_text: str) -> OpenAIChatCompletionResponse:
+async def openai_response_request(client: AsyncOpenAI, model_name: str, input_text: str) -> OpenAIChatCompletionResponse:
     """Отправка запроса в OpenAI Responses API с автоматическими повторными попытками через прокси."""
-    http_client = None
-    if PROXY:
-        http_client = httpx.AsyncClient(proxy=PROXY)
-
-    client = AsyncOpenAI(
-        api_key=api_key,
-        http_client=http_client
+    return await client.responses.create(
+        model=model_name,
+        input=input_text
     )
-    
-    try:
-        return await client.responses.create(
-            model=model_name,
-            input=input_text
-        )
-    finally:
-        if http_client:
-            await http_client.aclose()
 
 @retry(
     stop=stop_after_attempt(3),
     wait=wait_fixed(2),
     retry=retry_if_exception_type((asyncio.TimeoutError, ConnectionError, ValueError)),
-    before=before_log(logger, logging.INFO)
+    before=before_log(logger, logging.INFO),
+    before_sleep=_count_retry
 )
-async def deepseek_request(api_key: str, model_name: str, messages: list):
+async def deepseek_request(client: AsyncOpenAI, model_name: str, messages: list):
     """Отправка запроса в DeepSeek API через OpenRouter с автоматическими повторными попытками."""
-    client = AsyncOpenAI(
-        base_url="https://openrouter.ai/api/v1",
-        api_key=api_key,
-    )
-    
     return await client.chat.completions.create(
         extra_body={},
         model=model_name,
         messages=messages
     )
 
-# Словарь для конфигурации моделей
+async def mistral_stream(client: Mistral, model_name: str, messages: list) -> AsyncIterator[str | dict]:
+    """Потоковый запрос в Mistral API: фрагменты текста, в конце — количество токенов."""
+    stream = await client.chat.stream_async(model=model_name, messages=messages)
+    async with stream as events:
+        async for event in events:
+            chunk = event.data
+            if chunk.choices and isinstance(chunk.choices[0].delta.content, str):
+                yield chunk.choices[0].delta.content
+            if chunk.usage:
+                yield {
+                    "prompt_tokens": chunk.usage.prompt_tokens,
+                    "completion_tokens": chunk.usage.completion_tokens,
+                }
+
+async def openai_response_stream(client: AsyncOpenAI, model_name: str, input_text: str) -> AsyncIterator[str | dict]:
+    """Потоковый запрос в OpenAI Responses API: фрагменты текста, в конце — количество токенов."""
+    stream = await client.responses.create(model=model_name, input=input_text, stream=True)
+    async with stream as events:
+        async for event in events:
+            if event.type == "response.output_text.delta":
+                yield event.delta
+            elif event.type == "response.completed" and event.response.usage:
+                yield {
+                    "prompt_tokens": event.response.usage.input_tokens,
+                    "completion_tokens": event.response.usage.output_tokens,
+                }
+
+async def deepseek_stream(client: AsyncOpenAI, model_name: str, messages: list) -> AsyncIterator[str | dict]:
+    """Потоковый запрос в DeepSeek через OpenRouter: фрагменты текста, в конце — количество токенов."""
+    stream = await client.chat.completions.create(
+        extra_body={},
+        model=model_name,
+        messages=messages,
+        stream=True,
+        stream_options={"include_usage": True},
+    )
+    async with stream as chunks:
+        async for chunk in chunks:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+            if chunk.usage:
+                yield {
+                    "prompt_tokens": chunk.usage.prompt_tokens,
+                    "completion_tokens": chunk.usage.completion_tokens,
+                }
+
+def _usage(usage, prompt_attr: str, completion_attr: str) -> Optional[dict]:
+    """Количество токенов из объекта usage ответа провайдера."""
+    if usage is None:
+        return None
+    return {
+        "prompt_tokens": getattr(usage, prompt_attr, None),
+        "completion_tokens": getattr(usage, completion_attr, None),
+    }
+
+def create_mistral_client(api_key: str, http_client: httpx.AsyncClient) -> Mistral:
+    """Клиент Mistral поверх общего HTTP клиента."""
+    return Mistral(
+        api_key=api_key,
+        async_client=http_client,
+        timeout_ms=int(config.LLM_TIMEOUT * 1000),
+    )
+
+
+def create_openai_client(api_key: str, http_client: httpx.AsyncClient) -> AsyncOpenAI:
+    """Клиент OpenAI поверх общего HTTP клиента."""
+    return AsyncOpenAI(api_key=api_key, http_client=http_client, timeout=http_client.timeout)
+
+
+def create_openrouter_client(api_key: str, http_client: httpx.AsyncClient) -> AsyncOpenAI:
+    """Клиент OpenRouter (OpenAI-совместимый API) поверх общего HTTP клиента."""
+    return AsyncOpenAI(
+        base_url="https://openrouter.ai/api/v1",
+        api_key=api_key,
+        http_client=http_client,
+        timeout=http_client.timeout,
+    )
+
+
+# Словарь для конфигурации моделей.
+# client и http_client создаются один раз в init_clients (см. lifespan),
+# context_tokens — бюджет контекста промпта в токенах (см. context_builder).
 MODEL_CONFIG = {
     "mistral-large-latest": {
         "api_key": MISTRAL_API_KEY,
         "handler": mistral_request,
+        "stream_handler": mistral_stream,
         "response_field": lambda r: r.choices[0].message.content,
+        "usage_field": lambda r: _usage(r.usage, "prompt_tokens", "completion_tokens"),
+        "client_factory": create_mistral_client,
+        "context_tokens": 12000,
+        "proxy": None,
     },
     "gpt-4o-mini": {
         "api_key": OPENAI_API_KEY,
         "handler": openai_response_request,
+        "stream_handler": openai_response_stream,
         "response_field": lambda r: r.output_text,
+        "usage_field": lambda r: _usage(r.usage, "input_tokens", "output_tokens"),
+        "client_factory": create_openai_client,
+        "context_tokens": 12000,
+        "proxy": PROXY,
     },
     "deepseek/deepseek-chat-v3-0324:free": {
         "api_key": DEEPSEEK_API_KEY,
         "handler": deepseek_request,
+        "stream_handler": deepseek_stream,
         "response_field": lambda r: r.choices[0].message.content,
+        "usage_field": lambda r: _usage(r.usage, "prompt_tokens", "completion_tokens"),
+        "client_factory": create_openrouter_client,
+        "context_tokens": 8000,
+        "proxy": None,
     }
 }
 
+# Автоматические выключатели моделей: при высокой доле ошибок модель временно пропускается
+for _model_config in MODEL_CONFIG.values():
+    _model_config["breaker"] = CircuitBreaker(
+        failure_rate_threshold=config.LLM_BREAKER_FAILURE_RATE,
+        min_calls=config.LLM_BREAKER_MIN_CALLS,
+        window=config.LLM_BREAKER_WINDOW,
+        cooldown=config.LLM_BREAKER_COOLDOWN,
+    )
+
+
+# Задачи закрытия неиспользованных HTTP клиентов (ссылки держатся до завершения)
+_closing_tasks = set()
+
+
+def _discard_http_client(http_client: httpx.AsyncClient):
+    """Закрытие HTTP клиента, который не понадобился, из синхронного кода."""
+    try:
+        loop = asyncio.get_running_loop()
+    except RuntimeError:
+        asyncio.run(http_client.aclose())
+        return
+    task = loop.create_task(http_client.aclose())
+    _closing_tasks.add(task)
+    task.add_done_callback(_closing_tasks.discard)
+
+
+def init_clients():
+    """
+    Создание клиентов моделей с постоянными пулами соединений.
+    Модели, клиент которых создать не удалось, запоминаются (client_error)
+    и не пересоздаются до close_clients.
+    """
+    for model, model_config in MODEL_CONFIG.items():
+        if model_config.get("client") is not None or model_config.get("client_error"):
+            continue
+        http_client = create_http_client(model_config["proxy"], model)
+        try:
+            model_config["client"] = model_config["client_factory"](model_config["api_key"], http_client)
+        except Exception as e:
+            logger.error("Не удалось создать клиент модели '%s': %s", model, e)
+            model_config["client_error"] = str(e) or type(e).__name__
+            _discard_http_client(http_client)
+            continue
+        model_config["http_client"] = http_client
+    logger.info("Клиенты моделей AI созданы (HTTP/2: %s)", config.LLM_HTTP2 and HTTP2_AVAILABLE)
+
+
+async def close_clients():
+    """Закрытие клиентов моделей и их пулов соединений."""
+    for model, model_config in MODEL_CONFIG.items():
+        http_client = model_config.pop("http_client", None)
+        model_config.pop("client", None)
+        model_config.pop("client_error", None)
+        if http_client is not None:
+            try:
+                await http_client.aclose()
+            except Exception as e:
+                logger.warning("Ошибка при закрытии клиента модели '%s': %s", model, e)
+
 # Порядок попыток моделей по умолчанию
 DEFAULT_MODEL_ORDER = ["mistral-large-latest", "deepseek/deepseek-chat-v3-0324:free", "gpt-4o-mini"]
 
@@ -132,20 +321,203 @@ PROMPT_TEMPLATES = {
     """
 }
 
-async def try_model(model: str, api_key: str, handler, get_response_text, input_type: str, query: str, context: str, history: str) -> str:
-    """Попытка запроса к конкретной модели."""
+class AllModelsFailed(Exception):
+    """Ни одна из моделей не вернула ответ."""
+
+    def __init__(self, last_error: Optional[Exception]):
+        super().__init__(str(last_error))
+        self.last_error = last_error
+
+
+def hedge_delay(model: str) -> Optional[float]:
+    """
+    Задержка перед запуском запроса к следующей модели: p95 задержки модели,
+    ограниченный LLM_HEDGE_MIN_DELAY..LLM_HEDGE_MAX_DELAY.
+    None, если параллельные запросы отключены.
+    """
+    if not config.LLM_HEDGE_ENABLED:
+        return None
+    p95 = get_model_stats(model).p95()
+    if p95 is None:
+        return config.LLM_HEDGE_MAX_DELAY
+    return min(max(p95, config.LLM_HEDGE_MIN_DELAY), config.LLM_HEDGE_MAX_DELAY)
+
+
+async def hedged_request(
+    models: list, call_model, request_id: Optional[str] = None
+) -> tuple[str, str, bool]:
+    """
+    Запрос к моделям с подстраховкой: запускается первая модель, и если она не ответила
+    за hedge_delay, параллельно запускается следующая. Если все запущенные запросы
+    завершились ошибкой, следующая модель запускается сразу. Побеждает первый успешный ответ, остальные запросы отменяются.
+    Модели с разомкнутым выключателем пропускаются без запроса.
+
+    :param models: Модели в порядке приоритета.
+    :param call_model: Корутина-функция model -> (текст ответа, количество токенов).
+    :param request_id: Идентификатор запроса для метрик.
+    :return: Модель, текст ответа и признак того, что первая модель не ответила
+        (ошибка или разомкнутый выключатель), а не просто проиграла гонку.
+    :raises AllModelsFailed: Если ни одна модель не ответила.
+    """
+    loop = asyncio.get_running_loop()
+    queue = list(models)
+    pending = {}
+    last_error = None
+    next_launch_at = None
+    first_failed = False
+
+    async def timed_call(current_model: str) -> str:
+        breaker = MODEL_CONFIG[current_model]["breaker"]
+        started = time.perf_counter()
+        try:
+            result, usage = await call_model(current_model)
+        except asyncio.CancelledError:
+            breaker.release()
+            record_call(current_model, "cancelled", time.perf_counter() - started, request_id=request_id)
+            raise
+        except Exception:
+            breaker.record_failure()
+            record_call(current_model, "error", time.perf_counter() - started, request_id=request_id)
+            raise
+        breaker.record_success()
+        record_call(current_model, "ok", time.perf_counter() - started, usage, request_id=request_id)
+        return result
+
+    def launch():
+        nonlocal next_launch_at, last_error, first_failed
+        while queue:
+            current_model = queue.pop(0)
+            breaker = MODEL_CONFIG[current_model]["breaker"]
+            if not breaker.allow():
+                logger.info("Модель '%s' пропущена: выключатель разомкнут", current_model)
+                first_failed = first_failed or current_model == models[0]
+                if last_error is None:
+                    last_error = RuntimeError(
+                        f"Модель '{current_model}' временно отключена после серии ошибок"
+                    )
+                continue
+            pending[asyncio.create_task(timed_call(current_model))] = current_model
+            delay = hedge_delay(current_model)
+            next_launch_at = loop.time() + delay if delay is not None else None
+            if len(pending) > 1:
+                logger.info("Параллельный запрос к модели '%s'", current_model)
+            return
+
+    try:
+        while queue or pending:
+            if not pending:
+                launch()
+                continue
+            timeout = None
+            if queue and next_launch_at is not None:
+                timeout = max(next_launch_at - loop.time(), 0)
+            done, _ = await asyncio.wait(
+                pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+            )
+            if not done:
+                launch()
+                continue
+            for task in done:
+                current_model = pending.pop(task)
+                try:
+                    result = task.result()
+                except Exception as e:
+                    last_error = e
+                    first_failed = first_failed or current_model == models[0]
+                    logger.error("Ошибка при работе с моделью '%s': %s", current_model, e)
+                    continue
+                if current_model != models[0]:
+                    record_fallback(models[0], current_model)
+                return current_model, result, first_failed
+    finally:
+        for task in pending:
+            task.cancel()
+        if pending:
+            await asyncio.gather(*pending, return_exceptions=True)
+
+    raise AllModelsFailed(last_error)
+
+
+def build_model_input(handler, input_type: str, query: str, context: str, history: str):
+    """Промпт для Responses API (строка) или список сообщений для chat API."""
     if handler == openai_response_request:
-        prompt = f"{PROMPT_TEMPLATES.get(input_type, '')}\n\nЗапрос: {query}\nКонтекст: {context}\nИстория: {history}"
-        response = await handler(api_key, model, prompt)
-    else:
-        system_content = PROMPT_TEMPLATES.get(input_type, """Ты — бот-помощник. Отвечай четко и кратко на русском языке.""")
-        messages = [
-            {"role": "system", "content": system_content},
-            {"role": "user", "content": f"Запрос: {query}\nКонтекст: {context}\nИстория: {history}"}
-        ]
-        response = await handler(api_key, model, messages)
-    
-    return get_response_text(response)
+        return f"{PROMPT_TEMPLATES.get(input_type, '')}\n\nЗапрос: {query}\nКонтекст: {context}\nИстория: {history}"
+    system_content = PROMPT_TEMPLATES.get(input_type, """Ты — бот-помощник. Отвечай четко и кратко на русском языке.""")
+    return [
+        {"role": "system", "content": system_content},
+        {"role": "user", "content": f"Запрос: {query}\nКонтекст: {context}\nИстория: {history}"}
+    ]
+
+def get_client(model: str):
+    """Клиент модели; создаётся при первом обращении, если lifespan ещё не создал его."""
+    model_config = MODEL_CONFIG[model]
+    if model_config.get("client") is None:
+        init_clients()
+    client = model_config.get("client")
+    if client is None:
+        raise RuntimeError(f"Клиент модели не создан: {model_config.get('client_error')}")
+    return client
+
+def resolve_models(model: Optional[str] = None) -> list:
+    """
+    Порядок моделей для запроса: указанная модель первой, остальные в порядке DEFAULT_MODEL_ORDER.
+
+    :raises HTTPException: Если модель не поддерживается.
+    """
+    if model:
+        # Если передана конкретная модель, сначала пробуем её, потом остальные
+        if model not in MODEL_CONFIG:
+            raise HTTPException(
+                status_code=400,
+                detail={
+                    "status": "error",
+                    "message": f"Модель '{model}' не поддерживается"
+                }
+            )
+        return [model] + [m for m in DEFAULT_MODEL_ORDER if m != model]
+    # Если модель не указана, пробуем модели в порядке DEFAULT_MODEL_ORDER;
+    # статистика задержек определяет только момент параллельного запроса (hedge_delay)
+    return list(DEFAULT_MODEL_ORDER)
+
+def context_budget(model: Optional[str] = None) -> int:
+    """Бюджет контекста в токенах для модели (CONTEXT_TOKEN_BUDGET, если модель не указана)."""
+    model_config = MODEL_CONFIG.get(model) if model else None
+    if model_config is None:
+        return config.CONTEXT_TOKEN_BUDGET
+    return model_config.get("context_tokens", config.CONTEXT_TOKEN_BUDGET)
+
+def fit_prompt_context(query: str, context: str, model: Optional[str]) -> str:
+    """Обрезка контекста под бюджет модели; экономия токенов пишется в лог."""
+    built = fit_context(query, context, context_budget(model))
+    if built.tokens_saved:
+        logger.info(
+            "Контекст для модели '%s' сокращён с %d до %d токенов (сэкономлено %d)",
+            model, built.original_tokens, built.tokens, built.tokens_saved
+        )
+    return built.text
+
+def model_context(query: str, context: str, input_type: str, model: str) -> str:
+    """
+    Контекст для конкретной модели: контексты wiki (формат format_contexts)
+    в текстовых запросах обрезаются под её бюджет, остальные передаются как есть.
+    """
+    if input_type != 'text':
+        return context
+    return fit_prompt_context(query, context, model)
+
+def fallback_notice(model: str, original_model: str) -> str:
+    """Предупреждение о том, что ответ дала другая модель."""
+    return f"<i>⚠️ Используется модель {model}, так как {original_model} недоступна</i>\n\n"
+
+async def try_model(model: str, client, handler, get_response_text, input_type: str, query: str, context: str, history: str, get_usage=None) -> tuple[str, Optional[dict]]:
+    """
+    Попытка запроса к конкретной модели.
+
+    :return: Текст ответа и количество токенов (None, если провайдер его не сообщил).
+    """
+    response = await handler(client, model, build_model_input(handler, input_type, query, context, history))
+    usage = get_usage(response) if get_usage is not None else None
+    return get_response_text(response), usage
 
 async def get_ai(
     query: str,
@@ -157,6 +529,8 @@ async def get_ai(
     """
     Асинхронная функция для взаимодействия с моделью AI.
     Формирует запрос на основе типа ввода и отправляет его в указанную модель.
+    Для текстовых запросов контекст wiki сокращается до бюджета токенов той модели,
+    которой отправляется запрос (в том числе резервной).
 
     :param query: Запрос пользователя.
     :param context: Контекст для анализа (например, текст таблицы или расшифровка голосового сообщения).
@@ -166,48 +540,48 @@ async def get_ai(
     :return: Ответ модели в виде строки.
     """
     original_model = model
-    models_to_try = []
-    
-    if model:
-        # Если передана конкретная модель, сначала пробуем её, потом остальные
-        if model not in MODEL_CONFIG:
-            raise HTTPException(
-                status_code=400,
-                detail={
-                    "status": "error",
-                    "message": f"Модель '{model}' не поддерживается"
-                }
-            )
-        models_to_try = [model] + [m for m in DEFAULT_MODEL_ORDER if m != model]
+    models_to_try = resolve_models(model)
+
+    # Ответ из кэша: точное совпадение или близкий запрос с тем же контекстом
+    cache_model = model or "auto"
+    query_embedding = None
+    if config.AI_CACHE_ENABLED:
+        query_embedding = query_embedding_cache.get(query)
+        cached = ai_response_cache.get(cache_model, input_type, query, context, history, query_embedding)
+        if cached is not None:
+            logger.info("Ответ модели взят из кэша")
+            return cached
+        generation = ai_response_cache.generation
+
+    async def call_model(current_model: str) -> tuple[str, Optional[dict]]:
+        model_config = MODEL_CONFIG[current_model]
+        return await try_model(
+            current_model, get_client(current_model), model_config["handler"],
+            model_config["response_field"], input_type, query,
+            model_context(query, context, input_type, current_model), history,
+            model_config.get("usage_field")
+        )
+
+    try:
+        current_model, response_text, original_failed = await hedged_request(
+            models_to_try, call_model, uuid.uuid4().hex
+        )
+    except AllModelsFailed as e:
+        last_error = e.last_error
     else:
-        # Если модель не указана, пробуем все в порядке по умолчанию
-        models_to_try = DEFAULT_MODEL_ORDER
-    
-    last_error = None
-    
-    for current_model in models_to_try:
-        try:
-            model_config = MODEL_CONFIG[current_model]
-            api_key = model_config["api_key"]
-            handler = model_config["handler"]
-            get_response_text = model_config["response_field"]
-            
-            response_text = await try_model(
-                current_model, api_key, handler, get_response_text, 
-                input_type, query, context, history
+        # Ответ другой модели при явно указанной: предупреждение, только если указанная
+        # модель действительно не ответила, а не проиграла параллельному запросу
+        if original_model and current_model != original_model:
+            notice = fallback_notice(current_model, original_model) if original_failed else ""
+            return notice + response_text
+
+        if config.AI_CACHE_ENABLED:
+            ai_response_cache.set(
+                cache_model, input_type, query, context, history, response_text,
+                query_embedding, generation
             )
-            
-            # Если это не первоначально запрашиваемая модель и была указана конкретная модель
-            if original_model and current_model != original_model:
-                return f"<i>⚠️ Используется модель {current_model}, так как {original_model} недоступна</i>\n\n{response_text}"
-            
-            return response_text
-            
-        except Exception as e:
-            last_error = e
-            logger.error(f"Ошибка при работе с моделью '{current_model}': {str(e)}")
-            continue
-    
+        return response_text
+
     # Если все модели не сработали
     raise HTTPException(
         status_code=500,
@@ -217,3 +591,139 @@ async def get_ai(
             "error": str(last_error)
         }
     )
+
+
+def stream_ai(
+    query: str,
+    context: str = "",
+    history: str = "",
+    input_type: Literal['voice', 'csv', 'text'] = 'text',
+    model: Optional[str] = None
+) -> AsyncIterator[tuple[str, dict]]:
+    """
+    Потоковый ответ модели AI в виде событий (имя, данные).
+
+    События: "token" с фрагментом текста, в конце "done" с моделью, количеством токенов
+    и временем до первого фрагмента, либо "error". Пока не получен первый фрагмент,
+    при ошибке модели запрос переходит к следующей.
+
+    :raises HTTPException: Если модель не поддерживается (до начала потока).
+    """
+    models_to_try = resolve_models(model)
+    return _stream_events(models_to_try, query, context, history, input_type, model)
+
+
+async def _stream_events(models_to_try, query, context, history, input_type, original_model):
+    """Генератор событий для stream_ai."""
+    started = time.perf_counter()
+    cache_model = original_model or "auto"
+    query_embedding = None
+    if config.AI_CACHE_ENABLED:
+        query_embedding = query_embedding_cache.get(query)
+        cached = ai_response_cache.get(cache_model, input_type, query, context, history, query_embedding)
+        if cached is not None:
+            yield "token", {"text": cached}
+            yield "done", {
+                "model": None,
+                "cached": True,
+                "ttft": time.perf_counter() - started,
+                "total_time": time.perf_counter() - started,
+                "prompt_tokens": None,
+                "completion_tokens": None,
+            }
+            return
+        generation = ai_response_cache.generation
+
+    request_id = uuid.uuid4().hex
+    last_error = None
+    for current_model in models_to_try:
+        model_config = MODEL_CONFIG[current_model]
+        breaker = model_config["breaker"]
+        if not breaker.allow():
+            logger.info("Модель '%s' пропущена: выключатель разомкнут", current_model)
+            continue
+
+        attempt_started = time.perf_counter()
+        parts = []
+        usage = {}
+        ttft = None
+        model_ttft = None
+        try:
+            handler = model_config["stream_handler"]
+            model_input = build_model_input(
+                model_config["handler"], input_type, query,
+                model_context(query, context, input_type, current_model), history
+            )
+            async with aclosing(handler(get_client(current_model), current_model, model_input)) as items:
+                async for item in items:
+                    if isinstance(item, dict):
+                        usage.update(item)
+                        continue
+                    if not item:
+                        continue
+                    if ttft is None:
+                        ttft = time.perf_counter() - started
+                        model_ttft = time.perf_counter() - attempt_started
+                        if original_model and current_model != original_model:
+                            yield "token", {"text": fallback_notice(current_model, original_model)}
+                    parts.append(item)
+                    yield "token", {"text": item}
+        except (asyncio.CancelledError, GeneratorExit):
+            breaker.release()
+            record_call(
+                current_model, "cancelled", time.perf_counter() - attempt_started, usage,
+                model_ttft, request_id, streamed=True
+            )
+            raise
+        except Exception as e:
+            breaker.record_failure()
+            record_call(
+                current_model, "error", time.perf_counter() - attempt_started, usage,
+                model_ttft, request_id, streamed=True
+            )
+            logger.error("Ошибка при работе с моделью '%s': %s", current_model, e)
+            if parts:
+                # Часть ответа уже отправлена, переход к другой модели невозможен
+                yield "error", {"model": current_model, "message": str(e)}
+                return
+            last_error = e
+            continue
+
+        breaker.record_success()
+        record_call(
+            current_model, "ok", time.perf_counter() - attempt_started, usage,
+            model_ttft, request_id, streamed=True
+        )
+        if current_model != models_to_try[0]:
+            record_fallback(models_to_try[0], current_model)
+        if config.AI_CACHE_ENABLED and parts and not (original_model and current_model != original_model):
+            ai_response_cache.set(
+                cache_model, input_type, query, context, history, "".join(parts),
+                query_embedding, generation
+            )
+        yield "done", {
+            "model": current_model,
+            "cached": False,
+            "ttft": ttft,
+            "total_time": time.perf_counter() - started,
+            "prompt_tokens": usage.get("prompt_tokens"),
+            "completion_tokens": usage.get("completion_tokens"),
+        }
+        return
+
+    yield "error", {
+        "message": "Не удалось получить ответ ни от одной модели",
+        "error": str(last_error),
+    }
+
+def get_models_diagnostics() -> dict:
+    """Состояние выключателей и статистика задержек по моделям."""
+    return {
+        model: {
+            "circuit": model_config["breaker"].snapshot(),
+            "latency": get_model_stats(model).snapshot(),
+            "client_ready": model_config.get("client") is not None,
+            "client_error": model_config.get("client_error"),
+        }
+        for model, model_config in MODEL_CONFIG.items()
+    }
@@ -0,0 +1,411 @@
+"""
+Кэши в памяти процесса.
+
+Содержит потокобезопасный LRU-кэш с ограничением по объёму в байтах, кэш ответов
+моделей AI и экземпляры кэшей, используемые в пути поиска.
+"""
+
+import hashlib
+import sys
+import threading
+import time
+from collections import OrderedDict, deque
+
+import numpy as np
+
+import config
+
+
+class LRUCache:
+    """
+    Потокобезопасный LRU-кэш с ограничением по суммарному весу записей в байтах.
+
+    Записи могут иметь время жизни (ttl); просроченные записи считаются промахом.
+    """
+
+    def __init__(self, max_bytes: int, weigher=sys.getsizeof, ttl: float | None = None):
+        """
+        :param max_bytes: Максимальный суммарный вес записей.
+        :param weigher: Функция, возвращающая вес значения в байтах.
+        :param ttl: Время жизни записи в секундах (None = бессрочно).
+        """
+        self.max_bytes = max_bytes
+        self.weigher = weigher
+        self.ttl = ttl
+        self.generation = 0
+        self._data = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def get(self, key, default=None):
+        """Получение значения с обновлением его позиции в LRU."""
+        with self._lock:
+            item = self._lookup(key)
+            if item is None:
+                self.misses += 1
+                return default
+            self.hits += 1
+            return item[0]
+
+    def get_many(self, keys) -> dict:
+        """Получение найденных в кэше значений по списку ключей."""
+        found = {}
+        with self._lock:
+            for key in keys:
+                item = self._lookup(key)
+                if item is None:
+                    self.misses += 1
+                    continue
+                self.hits += 1
+                found[key] = item[0]
+        return found
+
+    def set(self, key, value, generation=None, ttl: float | None = None):
+        """
+        Сохранение значения.
+
+        :param generation: Поколение кэша на момент чтения значения из источника;
+            если с тех пор кэш инвалидировался, значение не сохраняется.
+        :param ttl: Время жизни записи вместо заданного для кэша.
+        """
+        self.set_many({key: value}, generation, ttl)
+
+    def set_many(self, items: dict, generation=None, ttl: float | None = None):
+        """Сохранение нескольких значений (см. set)."""
+        ttl = ttl if ttl is not None else self.ttl
+        expires_at = time.monotonic() + ttl if ttl is not None else None
+        with self._lock:
+            if generation is not None and generation != self.generation:
+                return
+            for key, value in items.items():
+                weight = self.weigher(value)
+                if weight > self.max_bytes:
+                    continue
+                self._pop(key)
+                self._data[key] = (value, weight, expires_at)
+                self._size += weight
+            while self._size > self.max_bytes:
+                _, (_, weight, _) = self._data.popitem(last=False)
+                self._size -= weight
+                self.evictions += 1
+
+    def invalidate(self, keys):
+        """Удаление значений по ключам."""
+        with self._lock:
+            self.generation += 1
+            for key in keys:
+                self._pop(key)
+
+    def clear(self):
+        """Полная очистка кэша."""
+        with self._lock:
+            self.generation += 1
+            self._data.clear()
+            self._size = 0
+
+    def stats(self) -> dict:
+        """Статистика использования кэша."""
+        with self._lock:
+            requests = self.hits + self.misses
+            return {
+                "items": len(self._data),
+                "size_bytes": self._size,
+                "max_bytes": self.max_bytes,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / requests if requests else 0.0,
+                "evictions": self.evictions,
+            }
+
+    def _lookup(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return None
+        if item[2] is not None and item[2] <= time.monotonic():
+            self._pop(key)
+            return None
+        self._data.move_to_end(key)
+        return item
+
+    def _pop(self, key):
+        item = self._data.pop(key, None)
+        if item is not None:
+            self._size -= item[1]
+
+
+class RecentHistoryCache:
+    """
+    Последние сообщения пользователей: user_id -> [(query, response), ...].
+
+    Список пользователя заполняется из базы при первом чтении и дальше
+    поддерживается записью новых сообщений. Число пользователей ограничено (LRU),
+    списки живут не дольше ttl секунд — так видны сообщения, записанные другими
+    процессами.
+
+    Защита load от гонки с append: каждая запись получает номер из общего счётчика,
+    номер последней записи хранится, пока пользователь в кэше; для вытесненных
+    пользователей используется наибольший номер среди вытесненных (_floor).
+    """
+
+    def __init__(self, depth: int, max_users: int, ttl: float | None = None):
+        """
+        :param depth: Количество хранимых сообщений на пользователя.
+        :param max_users: Максимальное количество пользователей в кэше.
+        :param ttl: Время жизни списка пользователя в секундах (None = бессрочно).
+        """
+        self.depth = depth
+        self.max_users = max_users
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._writes = OrderedDict()
+        self._seq = 0
+        self._floor = 0
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        """История пользователя от старых сообщений к новым или None, если её нет в кэше."""
+        with self._lock:
+            item = self._data.get(user_id)
+            if item is None:
+                return None
+            messages, expires_at = item
+            if expires_at is not None and expires_at <= time.monotonic():
+                self._evict(user_id)
+                return None
+            self._data.move_to_end(user_id)
+            return list(messages)
+
+    def version(self, user_id) -> int:
+        """Номер последней записи; передаётся в load для защиты от гонки с append."""
+        with self._lock:
+            return self._seq
+
+    def load(self, user_id, messages, version: int):
+        """Заполнение истории из базы, если с момента чтения не было новых записей."""
+        with self._lock:
+            if self._writes.get(user_id, self._floor) > version:
+                return
+            expires_at = time.monotonic() + self.ttl if self.ttl is not None else None
+            self._data[user_id] = (deque(messages, maxlen=self.depth), expires_at)
+            self._data.move_to_end(user_id)
+            while len(self._data) > self.max_users:
+                self._evict(next(iter(self._data)))
+
+    def append(self, user_id, query, response):
+        """Добавление нового сообщения в историю пользователя, если она в кэше."""
+        with self._lock:
+            self._seq += 1
+            self._writes[user_id] = self._seq
+            self._writes.move_to_end(user_id)
+            item = self._data.get(user_id)
+            if item is not None:
+                item[0].append((query, response))
+            while len(self._writes) > self.max_users:
+                self._evict(next(iter(self._writes)))
+
+    def _evict(self, user_id):
+        """Удаление пользователя вместе с номером его последней записи."""
+        self._data.pop(user_id, None)
+        seq = self._writes.pop(user_id, None)
+        if seq is not None:
+            self._floor = max(self._floor, seq)
+
+
+class UsersCache:
+    """
+    Пользователи бота: множество user_id, уже записанных в таблицу users,
+    и список администраторов [(user_id, username), ...] с TTL.
+
+    Пользователи не удаляются из таблицы, поэтому известный id остаётся известным;
+    при переполнении множество очищается целиком. Список администраторов
+    обновляется по истечении TTL; код, меняющий is_admin, вызывает invalidate_admins.
+    """
+
+    def __init__(self, max_users: int, admins_ttl: float):
+        """
+        :param max_users: Максимальное количество известных user_id.
+        :param admins_ttl: Время жизни списка администраторов в секундах.
+        """
+        self.max_users = max_users
+        self.admins_ttl = admins_ttl
+        self.known_hits = 0
+        self.known_misses = 0
+        self._known = set()
+        self._admins = None
+        self._admins_loaded_at = 0.0
+        self._admins_generation = 0
+        self._lock = threading.Lock()
+
+    def is_known(self, user_id) -> bool:
+        """Записан ли пользователь в таблицу users."""
+        with self._lock:
+            if user_id in self._known:
+                self.known_hits += 1
+                return True
+            self.known_misses += 1
+            return False
+
+    def add_known(self, user_id):
+        """Запоминание пользователя, записанного в таблицу users."""
+        with self._lock:
+            if len(self._known) >= self.max_users:
+                self._known.clear()
+            self._known.add(user_id)
+
+    @property
+    def admins_generation(self) -> int:
+        """Счётчик сбросов списка администраторов; передаётся в set_admins."""
+        return self._admins_generation
+
+    def get_admins(self):
+        """Список администраторов или None, если его нет или он устарел."""
+        with self._lock:
+            if self._admins is None or time.monotonic() - self._admins_loaded_at > self.admins_ttl:
+                return None
+            return list(self._admins)
+
+    def set_admins(self, admins, generation: int):
+        """Сохранение списка, если с момента чтения из базы он не сбрасывался."""
+        with self._lock:
+            if generation != self._admins_generation:
+                return
+            self._admins = tuple(admins)
+            self._admins_loaded_at = time.monotonic()
+
+    def invalidate_admins(self):
+        """Сброс списка администраторов."""
+        with self._lock:
+            self._admins_generation += 1
+            self._admins = None
+
+    def stats(self) -> dict:
+        """Статистика кэша."""
+        with self._lock:
+            return {
+                "known_users": len(self._known),
+                "known_hits": self.known_hits,
+                "known_misses": self.known_misses,
+                "admins_cached": self._admins is not None,
+            }
+
+
+class AIResponseCache:
+    """
+    Двухуровневый кэш ответов моделей AI.
+
+    Точный уровень: ключ (model, input_type, хэш query+context+history).
+    Семантический уровень: ответы группируются по (model, input_type, хэш context+history),
+    внутри группы ищется запрос с косинусной близостью эмбеддингов не ниже порога.
+    """
+
+    def __init__(
+        self,
+        max_bytes: int,
+        ttl: float | None = None,
+        similarity_threshold: float | None = None,
+        group_size: int = 32,
+    ):
+        """
+        :param max_bytes: Объём каждого уровня в байтах.
+        :param ttl: Время жизни ответа в секундах.
+        :param similarity_threshold: Порог близости для семантического уровня (None — уровень отключён).
+        :param group_size: Максимальное количество запросов в группе семантического уровня.
+        """
+        self.exact = LRUCache(max_bytes, weigher=sys.getsizeof, ttl=ttl)
+        self.semantic = LRUCache(max_bytes, weigher=_semantic_group_weight, ttl=ttl)
+        self.similarity_threshold = similarity_threshold
+        self.group_size = group_size
+        self.semantic_hits = 0
+
+    @property
+    def generation(self) -> int:
+        """Поколение кэша; передаётся в set для защиты от записи после очистки."""
+        return self.exact.generation
+
+    @staticmethod
+    def _digest(*parts: str) -> str:
+        return hashlib.sha256("\x00".join(parts).encode("utf-8")).hexdigest()
+
+    def get(self, model, input_type, query, context, history, query_embedding=None) -> str | None:
+        """
+        Поиск ответа: сначала точный, затем семантический (если передан эмбеддинг запроса).
+
+        :param query_embedding: Нормализованный эмбеддинг запроса.
+        """
+        answer = self.exact.get((model, input_type, self._digest(query, context, history)))
+        if answer is not None or query_embedding is None or self.similarity_threshold is None:
+            return answer
+
+        group = self.semantic.get((model, input_type, self._digest(context, history)))
+        if not group:
+            return None
+        vector = np.ravel(query_embedding)
+        best_score, best_answer = max(
+            ((float(np.dot(vector, embedding)), cached) for embedding, cached in group),
+            key=lambda item: item[0],
+        )
+        if best_score < self.similarity_threshold:
+            return None
+        self.semantic_hits += 1
+        return best_answer
+
+    def set(self, model, input_type, query, context, history, answer, query_embedding=None, generation=None):
+        """Сохранение ответа на обоих уровнях."""
+        self.exact.set((model, input_type, self._digest(query, context, history)), answer, generation)
+        if query_embedding is None or self.similarity_threshold is None:
+            return
+        group_key = (model, input_type, self._digest(context, history))
+        group = self.semantic.get(group_key) or ()
+        group = (group + ((np.ravel(query_embedding), answer),))[-self.group_size:]
+        self.semantic.set(group_key, group, generation)
+
+    def clear(self):
+        """Очистка обоих уровней."""
+        self.exact.clear()
+        self.semantic.clear()
+
+    def stats(self) -> dict:
+        """Статистика уровней кэша."""
+        return {
+            "exact": self.exact.stats(),
+            "semantic": self.semantic.stats(),
+            "semantic_hits": self.semantic_hits,
+        }
+
+
+def _semantic_group_weight(group) -> int:
+    """Вес группы семантического уровня: эмбеддинги и тексты ответов."""
+    return sys.getsizeof(group) + sum(embedding.nbytes + sys.getsizeof(answer) for embedding, answer in group)
+
+
+def _topic_weight(topic) -> int:
+    """Вес кортежа (book_name, text, url) в байтах."""
+    return sys.getsizeof(topic) + sum(sys.getsizeof(part) for part in topic if part)
+
+
+# Контексты тем wiki по хэшу: hash -> (book_name, text, url)
+topic_cache = LRUCache(config.TOPIC_CACHE_MAX_BYTES, weigher=_topic_weight)
+
+# Последние сообщения пользователей для истории диалога
+history_cache = RecentHistoryCache(
+    config.HISTORY_DEPTH, config.HISTORY_CACHE_MAX_USERS, config.HISTORY_CACHE_TTL
+)
+
+# Известные пользователи бота и список администраторов
+users_cache = UsersCache(config.USERS_CACHE_MAX_ENTRIES, config.ADMINS_CACHE_TTL)
+
+# Эмбеддинги поисковых запросов по тексту запроса (переиспользуются кэшем ответов AI)
+query_embedding_cache = LRUCache(config.QUERY_EMBEDDING_CACHE_MAX_BYTES, weigher=lambda e: e.nbytes)
+
+# Ответы моделей AI
+ai_response_cache = AIResponseCache(
+    config.AI_CACHE_MAX_BYTES,
+    ttl=config.AI_CACHE_TTL,
+    similarity_threshold=config.AI_SEMANTIC_CACHE_THRESHOLD,
+)
@@ -0,0 +1,118 @@
+"""
+Автоматический выключатель (circuit breaker) для внешних сервисов.
+
+Состояния:
+- closed: запросы проходят, результаты копятся в скользящем окне;
+  при доле ошибок выше порога выключатель размыкается.
+- open: запросы не выполняются до истечения времени остывания.
+- half_open: пропускается ограниченное число пробных запросов; успех замыкает
+  выключатель, ошибка снова размыкает его.
+"""
+
+import time
+from collections import deque
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+
+
+class CircuitBreaker:
+    """Выключатель по доле ошибок в окне последних запросов."""
+
+    def __init__(
+        self,
+        failure_rate_threshold: float = 0.5,
+        min_calls: int = 4,
+        window: int = 20,
+        cooldown: float = 30.0,
+        half_open_max_calls: int = 1,
+    ):
+        """
+        :param failure_rate_threshold: Доля ошибок в окне, при которой выключатель размыкается.
+        :param min_calls: Минимальное количество запросов в окне для оценки доли ошибок.
+        :param window: Размер окна последних запросов.
+        :param cooldown: Время в секундах до перехода из open в half_open.
+        :param half_open_max_calls: Количество одновременных пробных запросов в half_open.
+        """
+        self.failure_rate_threshold = failure_rate_threshold
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self.half_open_max_calls = half_open_max_calls
+        self.state = CLOSED
+        self.opened_at = None
+        self.trips = 0
+        self.rejected = 0
+        self._outcomes = deque(maxlen=window)
+        self._trials = 0
+
+    def allow(self) -> bool:
+        """
+        Можно ли выполнить запрос. В half_open занимает слот пробного запроса,
+        который освобождается record_success, record_failure или release.
+        """
+        if self.state == OPEN:
+            if time.monotonic() - self.opened_at < self.cooldown:
+                self.rejected += 1
+                return False
+            self.state = HALF_OPEN
+            self._trials = 0
+        if self.state == HALF_OPEN:
+            if self._trials >= self.half_open_max_calls:
+                self.rejected += 1
+                return False
+            self._trials += 1
+        return True
+
+    def record_success(self):
+        """Учёт успешного запроса."""
+        if self.state == HALF_OPEN:
+            self.state = CLOSED
+            self._outcomes.clear()
+            self._trials = 0
+        self._outcomes.append(True)
+
+    def record_failure(self):
+        """Учёт неудачного запроса."""
+        if self.state == HALF_OPEN:
+            self._open()
+            return
+        self._outcomes.append(False)
+        if self.state == CLOSED and self.failure_rate() >= self.failure_rate_threshold \
+                and len(self._outcomes) >= self.min_calls:
+            self._open()
+
+    def release(self):
+        """Освобождение слота пробного запроса без результата (например, при отмене)."""
+        if self.state == HALF_OPEN and self._trials > 0:
+            self._trials -= 1
+
+    def failure_rate(self) -> float:
+        """Доля ошибок в окне."""
+        if not self._outcomes:
+            return 0.0
+        return self._outcomes.count(False) / len(self._outcomes)
+
+    def retry_after(self) -> float:
+        """Секунды до пробного запроса (0, если выключатель не разомкнут)."""
+        if self.state != OPEN:
+            return 0.0
+        return max(self.cooldown - (time.monotonic() - self.opened_at), 0.0)
+
+    def snapshot(self) -> dict:
+        """Состояние выключателя для диагностики."""
+        return {
+            "state": self.state,
+            "failure_rate": self.failure_rate(),
+            "calls_in_window": len(self._outcomes),
+            "retry_after": self.retry_after(),
+            "trips": self.trips,
+            "rejected": self.rejected,
+        }
+
+    def _open(self):
+        self.state = OPEN
+        self.opened_at = time.monotonic()
+        self.trips += 1
+        self._trials = 0
+        self._outcomes.clear()
@@ -0,0 +1,123 @@
+"""
+Клиент HTTP-сервиса 1С для проверки сотрудников по telegram id.
+
+Одна сессия aiohttp на всё приложение (закрывается в lifespan), кэш ответов с TTL:
+найденные сотрудники хранятся AUTH_1C_CACHE_TTL секунд, отказы в доступе —
+AUTH_1C_NEGATIVE_TTL секунд. Одновременные запросы одного и того же id
+объединяются в один запрос к 1С. Ошибки соединения не кэшируются.
+"""
+
+import asyncio
+import logging
+from typing import Dict
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+
+import config
+from cache import LRUCache
+from pyschemas import Employee1C
+
+logger = logging.getLogger(__name__)
+
+URL_1C = 'http://server1c.freedom1.ru/UNF_CRM_WS/hs/Grafana/anydata'
+
+ACCESS_DENIED = "Доступ запрещён"
+
+
+class Client1C:
+    """Клиент 1С с общей сессией, кэшем и объединением одновременных запросов."""
+
+    def __init__(self, url: str = URL_1C):
+        """
+        :param url: Адрес сервиса 1С.
+        """
+        self.url = url
+        self.cache = LRUCache(
+            config.AUTH_1C_CACHE_MAX_ENTRIES, weigher=lambda _: 1, ttl=config.AUTH_1C_CACHE_TTL
+        )
+        self.coalesced = 0
+        self._session: ClientSession | None = None
+        self._inflight: Dict[int, asyncio.Task] = {}
+
+    def _get_session(self) -> ClientSession:
+        if self._session is None or self._session.closed:
+            self._session = ClientSession(
+                timeout=ClientTimeout(total=config.AUTH_1C_TIMEOUT),
+                connector=TCPConnector(limit=config.AUTH_1C_MAX_CONNECTIONS),
+            )
+        return self._session
+
+    async def close(self):
+        """Закрытие сессии."""
+        for task in list(self._inflight.values()):
+            task.cancel()
+        self._inflight.clear()
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def get_employee(self, telegramid: int, use_cache: bool = True) -> Employee1C | Dict[str, str]:
+        """
+        Проверка сотрудника по telegram id.
+
+        :param telegramid: Telegram id пользователя.
+        :param use_cache: Использовать кэш (False — всегда запрашивать 1С и обновить кэш).
+        :return: Employee1C или словарь с ключом error.
+        """
+        if use_cache:
+            cached = self.cache.get(telegramid)
+            if cached is not None:
+                return cached
+
+        task = self._inflight.get(telegramid)
+        if task is None:
+            # Запрос к 1С не привязан к вызвавшему: его отмена не отменяет ожидание остальных
+            task = asyncio.ensure_future(self._lookup(telegramid))
+            self._inflight[telegramid] = task
+            task.add_done_callback(lambda done: self._lookup_done(telegramid, done))
+        else:
+            self.coalesced += 1
+        return await asyncio.shield(task)
+
+    async def _lookup(self, telegramid: int) -> Employee1C | Dict[str, str]:
+        """Запрос к 1С с сохранением результата в кэш."""
+        generation = self.cache.generation
+        result = await self._fetch(telegramid)
+        if isinstance(result, Employee1C):
+            self.cache.set(telegramid, result, generation)
+        elif result.get("error") == ACCESS_DENIED:
+            self.cache.set(telegramid, result, generation, ttl=config.AUTH_1C_NEGATIVE_TTL)
+        return result
+
+    def _lookup_done(self, telegramid: int, task: asyncio.Task):
+        if self._inflight.get(telegramid) is task:
+            del self._inflight[telegramid]
+        if not task.cancelled():
+            # Исключение получают ожидающие; если все они отменены, оно не должно остаться необработанным
+            task.exception()
+
+    async def _fetch(self, telegramid: int) -> Employee1C | Dict[str, str]:
+        """Запрос к 1С без кэша."""
+        params = {"query": "emploeyy", "telegramId": str(telegramid)}
+        async with self._get_session().get(self.url, params=params) as res:
+            if res.status != 200:
+                return {"error": "Ошибка соединения с 1С"}
+            data = await res.json(content_type=None)
+            if not data:
+                return {"error": ACCESS_DENIED}
+            fio = data.get("fio")
+            job_title = data.get('jobTitle')
+            if fio and job_title:
+                return Employee1C(fio=fio, jobTitle=job_title)
+            return {"error": "Неизвестный ответ от 1С"}
+
+    def invalidate(self, telegramids):
+        """Удаление пользователей из кэша."""
+        self.cache.invalidate(telegramids)
+
+    def stats(self) -> dict:
+        """Статистика кэша и объединённых запросов."""
+        return {**self.cache.stats(), "coalesced": self.coalesced, "inflight": len(self._inflight)}
+
+
+client_1c = Client1C()
@@ -20,6 +20,47 @@ REDIS_HOST= os.getenv('REDIS_HOST')
 REDIS_PORT= os.getenv('REDIS_PORT')
 REDIS_PASSWORD= os.getenv('REDIS_PASSWORD')
 REDIS_LOGIN= os.getenv('REDIS_LOGIN')
+REDIS_MAX_CONNECTIONS = int(os.getenv('REDIS_MAX_CONNECTIONS', '50'))
+REDIS_POOL_TIMEOUT = float(os.getenv('REDIS_POOL_TIMEOUT', '5'))
+REDIS_HEALTH_CHECK_INTERVAL = int(os.getenv('REDIS_HEALTH_CHECK_INTERVAL', '30'))
+REDIS_SOCKET_TIMEOUT = float(os.getenv('REDIS_SOCKET_TIMEOUT', '10'))
+REDIS_SOCKET_CONNECT_TIMEOUT = float(os.getenv('REDIS_SOCKET_CONNECT_TIMEOUT', '5'))
+# Локальный кэш тарифов (terrtar:*) и адресов (adds:*)
+REDIS_CACHE_MAX_BYTES = int(os.getenv('REDIS_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+REDIS_CACHE_TTL = float(os.getenv('REDIS_CACHE_TTL', '3600'))
+# Непересекающиеся шаблоны ключей login:* для параллельного SCAN, через запятую (login:0*,login:1*,...)
+REDIS_SCAN_SHARDS = [shard.strip() for shard in os.getenv('REDIS_SCAN_SHARDS', '').split(',') if shard.strip()]
+# Проверка сотрудников в 1С: кэш найденных (секунды), кэш отказов, размер кэша, таймаут и соединения
+AUTH_1C_CACHE_TTL = float(os.getenv('AUTH_1C_CACHE_TTL', '3600'))
+AUTH_1C_NEGATIVE_TTL = float(os.getenv('AUTH_1C_NEGATIVE_TTL', '300'))
+AUTH_1C_CACHE_MAX_ENTRIES = int(os.getenv('AUTH_1C_CACHE_MAX_ENTRIES', '10000'))
+AUTH_1C_TIMEOUT = float(os.getenv('AUTH_1C_TIMEOUT', '10'))
+AUTH_1C_MAX_CONNECTIONS = int(os.getenv('AUTH_1C_MAX_CONNECTIONS', '10'))
+
+# Кэш известных пользователей бота (таблица users) и время жизни списка администраторов в секундах
+USERS_CACHE_MAX_ENTRIES = int(os.getenv('USERS_CACHE_MAX_ENTRIES', '100000'))
+ADMINS_CACHE_TTL = float(os.getenv('ADMINS_CACHE_TTL', '300'))
+
+# Файл блокировки GPU, общий для процессов на хосте
+GPU_LOCK_PATH = os.getenv('GPU_LOCK_PATH', '/shared/gpu.lock')
+# Загрузка данных уступает GPU запросам пользователей не раньше чем через DEVICE_BULK_SLICE секунд
+# удержания; доля времени устройства, гарантированная загрузке за окно DEVICE_SHARE_WINDOW секунд
+DEVICE_BULK_SLICE = float(os.getenv('DEVICE_BULK_SLICE', '0.5'))
+DEVICE_BULK_MIN_SHARE = float(os.getenv('DEVICE_BULK_MIN_SHARE', '0.2'))
+DEVICE_SHARE_WINDOW = float(os.getenv('DEVICE_SHARE_WINDOW', '60'))
+# Сколько секунд эмбеддинг запроса ждёт GPU, прежде чем считаться на CPU
+DEVICE_INTERACTIVE_TIMEOUT = float(os.getenv('DEVICE_INTERACTIVE_TIMEOUT', '5'))
+
+# Интервал пересборки снимка выгрузки пользователей в секундах (0 — отключено)
+USERS_SNAPSHOT_INTERVAL = int(os.getenv('USERS_SNAPSHOT_INTERVAL', '600'))
+
+# Обновление ФИО пользователей из 1С: час ежедневного запуска (пусто — выключено), размер пачки,
+# одновременные запросы к 1С и частота запросов в секунду (0 — без ограничения)
+_users_refresh_hour = os.getenv('USERS_REFRESH_HOUR', '4')
+USERS_REFRESH_HOUR = int(_users_refresh_hour) if _users_refresh_hour else None
+USERS_REFRESH_BATCH_SIZE = int(os.getenv('USERS_REFRESH_BATCH_SIZE', '500'))
+USERS_REFRESH_CONCURRENCY = int(os.getenv('USERS_REFRESH_CONCURRENCY', '5'))
+USERS_REFRESH_RATE = float(os.getenv('USERS_REFRESH_RATE', '10'))
 
 HOST_MYSQL= os.getenv('HOST_MYSQL')
 PORT_MYSQL= os.getenv('PORT_MYSQL')
@@ -39,6 +80,53 @@ DEEPSEEK_API_KEY = os.getenv('DEEPSEEK_API_KEY')
 
 PROXY = os.getenv('PROXY')
 
+# Пулы HTTP соединений клиентов моделей AI
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', '60'))
+LLM_CONNECT_TIMEOUT = float(os.getenv('LLM_CONNECT_TIMEOUT', '10'))
+LLM_MAX_CONNECTIONS = int(os.getenv('LLM_MAX_CONNECTIONS', '20'))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv('LLM_MAX_KEEPALIVE_CONNECTIONS', '10'))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv('LLM_KEEPALIVE_EXPIRY', '120'))
+LLM_HTTP2 = os.getenv('LLM_HTTP2', 'true').lower() in ('1', 'true', 'yes')
+
+# Параллельные (hedged) запросы к следующей модели, если текущая не ответила за p95 своей задержки
+LLM_HEDGE_ENABLED = os.getenv('LLM_HEDGE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+LLM_HEDGE_MIN_DELAY = float(os.getenv('LLM_HEDGE_MIN_DELAY', '2'))
+LLM_HEDGE_MAX_DELAY = float(os.getenv('LLM_HEDGE_MAX_DELAY', '15'))
+
+# Автоматические выключатели моделей: доля ошибок в окне последних запросов и время остывания
+LLM_BREAKER_FAILURE_RATE = float(os.getenv('LLM_BREAKER_FAILURE_RATE', '0.5'))
+LLM_BREAKER_MIN_CALLS = int(os.getenv('LLM_BREAKER_MIN_CALLS', '4'))
+LLM_BREAKER_WINDOW = int(os.getenv('LLM_BREAKER_WINDOW', '20'))
+LLM_BREAKER_COOLDOWN = float(os.getenv('LLM_BREAKER_COOLDOWN', '30'))
+
+# Сохранение вызовов моделей AI в таблицу llm_usage_logs и интервал записи в секундах
+LLM_USAGE_PERSIST = os.getenv('LLM_USAGE_PERSIST', 'false').lower() in ('1', 'true', 'yes')
+LLM_USAGE_FLUSH_INTERVAL = int(os.getenv('LLM_USAGE_FLUSH_INTERVAL', '60'))
+
+# Бюджет контекста промпта в токенах по умолчанию (0 — без ограничения) и оценка символов на токен
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', '6000'))
+CONTEXT_CHARS_PER_TOKEN = float(os.getenv('CONTEXT_CHARS_PER_TOKEN', '3'))
+
+# Кэш ответов моделей AI: точный и семантический (порог косинусной близости запросов, пусто — выключен)
+AI_CACHE_ENABLED = os.getenv('AI_CACHE_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+AI_CACHE_MAX_BYTES = int(os.getenv('AI_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+AI_CACHE_TTL = float(os.getenv('AI_CACHE_TTL', '3600'))
+_ai_semantic_threshold = os.getenv('AI_SEMANTIC_CACHE_THRESHOLD', '0.95')
+AI_SEMANTIC_CACHE_THRESHOLD = float(_ai_semantic_threshold) if _ai_semantic_threshold else None
+QUERY_EMBEDDING_CACHE_MAX_BYTES = int(os.getenv('QUERY_EMBEDDING_CACHE_MAX_BYTES', str(16 * 1024 * 1024)))
+
+# Источник текста контекста wiki: 'milvus' (из ответа поиска) или 'postgres'
+WIKI_CONTEXT_SOURCE = os.getenv('WIKI_CONTEXT_SOURCE', 'milvus')
+
+# Объём LRU-кэша текстов тем wiki в байтах
+TOPIC_CACHE_MAX_BYTES = int(os.getenv('TOPIC_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+
+# Количество последних сообщений в истории диалога и размер её кэша
+HISTORY_DEPTH = 3
+HISTORY_CACHE_MAX_USERS = int(os.getenv('HISTORY_CACHE_MAX_USERS', '10000'))
+# Время жизни истории пользователя в кэше, секунды: затем она перечитывается из базы (видны записи других процессов)
+HISTORY_CACHE_TTL = float(os.getenv('HISTORY_CACHE_TTL', '300'))
+
 mysql_config = {
     'host': HOST_MYSQL,
     'port': PORT_MYSQL,
@@ -0,0 +1,180 @@
+"""
+Сборка контекста для промпта модели AI с ограничением по количеству токенов.
+
+Контексты wiki идут в порядке релевантности. Если вместе они не помещаются в бюджет,
+менее релевантные отбрасываются (каждому оставшемуся должно достаться не меньше
+MIN_PASSAGE_CHARS символов), а бюджет делится между оставшимися: короткие берутся
+целиком, из длинных вырезается окно предложений, лучше всего совпадающее с запросом.
+
+Количество токенов оценивается по числу символов (CONTEXT_CHARS_PER_TOKEN).
+"""
+
+import math
+import re
+from typing import NamedTuple
+
+import config
+
+MIN_PASSAGE_CHARS = 300
+ELLIPSIS = "…"
+
+_UNIT_RE = re.compile(r"(?<=[.!?;\n])\s+")
+_WORD_RE = re.compile(r"\w+")
+_FORMATTED_RE = re.compile(r"(?= Контекст \d+: )")
+_HEAD_RE = re.compile(r"^ Контекст \d+: ")
+_URL_SEPARATOR = "  URL: "
+
+
+class BuiltContext(NamedTuple):
+    """Собранный контекст и оценка его размера в токенах."""
+
+    text: str
+    tokens: int
+    original_tokens: int
+
+    @property
+    def tokens_saved(self) -> int:
+        """Сколько токенов сэкономлено обрезкой."""
+        return max(self.original_tokens - self.tokens, 0)
+
+
+def estimate_tokens(text: str) -> int:
+    """Оценка количества токенов в тексте."""
+    return math.ceil(len(text) / config.CONTEXT_CHARS_PER_TOKEN) if text else 0
+
+
+def _terms(text: str) -> set:
+    """Основы слов (первые 5 букв слов от 3 букв) для грубого сравнения с учётом словоформ."""
+    return {word[:5] for word in _WORD_RE.findall(text.lower()) if len(word) >= 3}
+
+
+def best_window(text: str, terms: set, max_chars: int) -> str:
+    """
+    Окно подряд идущих предложений текста длиной не более max_chars
+    с наибольшим числом совпадений с запросом (при равенстве — самое длинное, затем самое раннее).
+    """
+    if len(text) <= max_chars:
+        return text
+    if max_chars <= 0:
+        return ""
+
+    units = _UNIT_RE.split(text)
+    scores = [len(terms & _terms(unit)) for unit in units]
+
+    best = None
+    start = 0
+    length = 0
+    score = 0
+    for end, unit in enumerate(units):
+        length += len(unit) + 1
+        score += scores[end]
+        while length - 1 > max_chars and start <= end:
+            length -= len(units[start]) + 1
+            score -= scores[start]
+            start += 1
+        if start <= end and (best is None or (score, length) > best[:2]):
+            best = (score, length, start, end + 1)
+
+    if best is None:
+        # Ни одно предложение не помещается целиком: берём начало самого подходящего
+        index = max(range(len(units)), key=lambda i: scores[i])
+        window = units[index][:max_chars]
+        first, last = index, index + 1
+    else:
+        _, _, first, last = best
+        window = " ".join(units[first:last])
+
+    if first > 0:
+        window = ELLIPSIS + window
+    if last < len(units) or best is None:
+        window = window + ELLIPSIS
+    return window
+
+
+def _allocate(lengths: list, budget: int) -> list:
+    """Деление бюджета символов между фрагментами: короткие целиком, остаток поровну длинным."""
+    allocation = [0] * len(lengths)
+    remaining = budget
+    order = sorted(range(len(lengths)), key=lambda i: lengths[i])
+    for position, index in enumerate(order):
+        share = remaining // (len(lengths) - position)
+        allocation[index] = min(lengths[index], share)
+        remaining -= allocation[index]
+    return allocation
+
+
+def fit_passages(query: str, passages: list, budget_tokens: int | None) -> BuiltContext:
+    """
+    Обрезка списка фрагментов (head, body, tail) под бюджет; обрезается только body.
+
+    :param query: Текст запроса пользователя.
+    :param passages: Фрагменты в порядке релевантности.
+    :param budget_tokens: Бюджет в токенах (None или 0 — без ограничения).
+    """
+    original = "".join(head + body + tail for head, body, tail in passages)
+    original_tokens = estimate_tokens(original)
+    if not budget_tokens or original_tokens <= budget_tokens:
+        return BuiltContext(original, original_tokens, original_tokens)
+
+    budget_chars = int(budget_tokens * config.CONTEXT_CHARS_PER_TOKEN)
+    keep = max(1, min(len(passages), budget_chars // MIN_PASSAGE_CHARS))
+    passages = passages[:keep]
+    overhead = sum(len(head) + len(tail) for head, _, tail in passages)
+    allocation = _allocate([len(body) for _, body, _ in passages], max(budget_chars - overhead, 0))
+
+    terms = _terms(query)
+    text = "".join(
+        head + best_window(body, terms, chars) + tail
+        for (head, body, tail), chars in zip(passages, allocation)
+    )
+    return BuiltContext(text, estimate_tokens(text), original_tokens)
+
+
+def _passage(index: int, book_name, text: str, url) -> tuple:
+    return f" Контекст {index}: {book_name or ''} ", text, f"{_URL_SEPARATOR}{url}"
+
+
+def format_contexts(contexts) -> str:
+    """Склеивает контексты (book_name, text, url) в строку для модели."""
+    return "".join(
+        "".join(_passage(i, book_name, text, url))
+        for i, (book_name, text, url) in enumerate(contexts, start=1)
+    )
+
+
+def build_context(query: str, contexts, budget_tokens: int | None) -> BuiltContext:
+    """
+    Сборка строки контекстов wiki (book_name, text, url) в пределах бюджета токенов.
+
+    :param query: Текст запроса пользователя.
+    :param contexts: Контексты в порядке релевантности.
+    :param budget_tokens: Бюджет в токенах (None или 0 — без ограничения).
+    """
+    passages = [_passage(i, *context) for i, context in enumerate(contexts, start=1)]
+    return fit_passages(query, passages, budget_tokens)
+
+
+def fit_context(query: str, context: str, budget_tokens: int | None) -> BuiltContext:
+    """
+    Обрезка готовой строки контекста под бюджет токенов.
+
+    Обрезается только строка в формате format_contexts: она разбирается на контексты,
+    заголовки и ссылки сохраняются. Любой другой текст (например, JSON тарифов)
+    возвращается без изменений — обрезка сделала бы его некорректным.
+    """
+    if not _HEAD_RE.match(context):
+        tokens = estimate_tokens(context)
+        return BuiltContext(context, tokens, tokens)
+    passages = []
+    for part in _FORMATTED_RE.split(context):
+        if not part:
+            continue
+        head_match = _HEAD_RE.match(part)
+        head = head_match.group(0) if head_match else ""
+        body = part[len(head):]
+        tail = ""
+        if head and _URL_SEPARATOR in body:
+            body, url = body.rsplit(_URL_SEPARATOR, 1)
+            tail = _URL_SEPARATOR + url
+        passages.append((head, body, tail))
+    return fit_passages(query, passages, budget_tokens)
@@ -4,24 +4,29 @@
 """
 
 import asyncio
+import json
 import logging
 import re
-from typing import Dict
+from typing import AsyncIterator, Dict, Literal
 
 from fastapi import HTTPException
 import psycopg2
 from pymilvus import SearchFuture, SearchResult
+from redis.asyncio import Redis
+from redis.exceptions import RedisError
 from tqdm import tqdm
-import redis.asyncio as redis
 
-from aiohttp import ClientSession
 import config
 import funcs
-from database import Milvus, MySQL, PostgreSQL
+from cache import ai_response_cache, query_embedding_cache, topic_cache, users_cache
+from client_1c import client_1c
+from context_builder import build_context
+from database import MAX_TEXT_LENGTH, Milvus, MySQL, PostgreSQL, milvus_connection
 from milvus_schemas import (
     address_schema, address_index_params, address_search_params,
     promt_schema, promt_index_params, promt_search_params,
-    wiki_index_params, wiki_schema, wiki_search_params
+    wiki_index_params, wiki_schema, wiki_search_params, wiki_output_fields,
+    WIKI_TITLE_MAX_LENGTH,
 )
 from pyschemas import Employee1C, Page, PromtModel, Search2ResponseData, SearchResponseData
 
@@ -34,43 +39,182 @@ BATCH_SIZE = 1000
 semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
 
 
-async def get_unique_keys_with_prefix(pattern='login:*', count=10000):
+async def _scan_shard(redis: Redis, pattern: str, count: int, node=None) -> AsyncIterator[list]:
     """
-    Асинхронная функция для получения всех уникальных ключей с заданным префиксом из Redis.
+    Обход SCAN одного шарда: шаблона ключей или узла кластера.
 
-    :param pattern: Шаблон ключей для поиска.
-    :param count: Количество ключей для обработки за один запрос.
-    :return: Множество уникальных ключей.
+    :param node: Узел RedisCluster (None — обычный клиент).
     """
-    r = redis.from_url(
-        f"redis://{config.REDIS_HOST}:{config.REDIS_PORT}",
-        password=config.REDIS_PASSWORD,
-        decode_responses=True
-    )
-
     cursor = 0
-    keys = set()
+    while True:
+        if node is None:
+            cursor, keys = await redis.scan(cursor, match=pattern, count=count)
+        else:
+            result = await redis.scan(cursor, match=pattern, count=count, target_nodes=node)
+            if isinstance(result, dict):
+                result = next(iter(result.values()))
+            cursor, keys = result
+        if keys:
+            yield keys
+        if int(cursor) == 0:
+            break
+
+
+async def iter_keys_with_prefix(
+    redis: Redis, pattern='login:*', count=10000, shards=None, concurrency=MAX_CONCURRENT_REQUESTS
+) -> AsyncIterator[list]:
+    """
+    Асинхронный генератор ключей Redis по шаблону, пакетами по мере поступления.
+
+    Обход разбивается на шарды, которые сканируются параллельно, не более concurrency
+    одновременно: для RedisCluster — по основным узлам, иначе — по шаблонам из shards
+    (например, login:0* … login:9*). Шаблоны шардов должны не пересекаться и вместе
+    покрывать pattern. Без shards на одном узле выполняется обычный последовательный SCAN.
+
+    :param redis: Клиент Redis или RedisCluster.
+    :param pattern: Шаблон ключей (для обхода по узлам кластера).
+    :param count: Подсказка COUNT для SCAN.
+    :param shards: Список непересекающихся шаблонов ключей.
+    :param concurrency: Максимальное количество одновременно сканируемых шардов.
+    :return: Списки ключей по шагам SCAN; SCAN может изредка вернуть ключ дважды.
+    """
+    if shards:
+        sources = [(shard, None) for shard in shards]
+    elif hasattr(redis, 'get_primaries'):
+        sources = [(pattern, node) for node in redis.get_primaries()]
+    else:
+        sources = [(pattern, None)]
+
+    if len(sources) == 1:
+        async for keys in _scan_shard(redis, sources[0][0], count, sources[0][1]):
+            yield keys
+        return
+
+    queue = asyncio.Queue(maxsize=concurrency)
+    limit = asyncio.Semaphore(concurrency)
+    done = object()
+
+    async def produce(shard_pattern, node):
+        # Итог шарда ставится в очередь только при обычном завершении или ошибке:
+        # после отмены потребитель очередь уже не читает, и put заблокировался бы
+        try:
+            async with limit:
+                async for keys in _scan_shard(redis, shard_pattern, count, node):
+                    await queue.put(keys)
+            result = done
+        except Exception as e:
+            result = e
+        await queue.put(result)
+
+    tasks = [asyncio.create_task(produce(*source)) for source in sources]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            item = await queue.get()
+            if item is done:
+                remaining -= 1
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
 
-    with tqdm(desc="Получение ключей из Redis", unit=" ключей") as pbar:
-        while True:
-            cursor, partial_keys = await r.scan(cursor, match=pattern, count=count)
-            pbar.update(len(partial_keys))
-            keys.update(partial_keys)
-            if cursor == 0:
-                break
 
-    await r.aclose()
+async def iter_json_batches(
+    redis: Redis, pattern='login:*', cursor=0, count=1000, max_batches=None
+) -> AsyncIterator[tuple[int, list]]:
+    """
+    Асинхронный генератор JSON документов по шаблону ключей, пакетами по шагам SCAN.
 
-    return keys
+    Следующий SCAN выполняется параллельно с JSON.MGET текущего пакета.
+    SCAN может изредка вернуть один ключ дважды (при перестроении хэш-таблицы).
 
+    :param redis: Клиент Redis.
+    :param pattern: Шаблон ключей.
+    :param cursor: Курсор SCAN, с которого начинается обход (0 — с начала).
+    :param count: Подсказка COUNT для SCAN.
+    :param max_batches: Максимальное количество шагов SCAN (None — до конца).
+    :return: Пары (следующий курсор, документы пакета); курсор 0 означает конец обхода.
+    """
+    scan = asyncio.ensure_future(redis.scan(cursor, match=pattern, count=count))
+    batches = 0
+    try:
+        while scan is not None:
+            cursor, keys = await scan
+            batches += 1
+            scan = None
+            if cursor != 0 and (max_batches is None or batches < max_batches):
+                scan = asyncio.ensure_future(redis.scan(cursor, match=pattern, count=count))
+
+            documents = []
+            if keys:
+                values = await redis.json().mget(keys, path="$")
+                documents = [item[0] for item in values if item]
+            yield cursor, documents
+    finally:
+        if scan is not None:
+            scan.cancel()
+
+
+async def stream_users_export(
+    redis: Redis,
+    output_format: Literal['json', 'ndjson'] = 'json',
+    cursor=0,
+    max_batches=None,
+) -> AsyncIterator[bytes]:
+    """
+    Потоковая выгрузка пользователей (login:*) из Redis.
+
+    Без max_batches выгружается весь набор: JSON-массив или NDJSON.
+    С max_batches выгружается страница: для json — объект {"items": [...], "next_cursor": N},
+    для ndjson — строки документов и последняя строка {"next_cursor": N}.
+    Курсор 0 означает, что выгрузка завершена.
 
-async def insert_addresses_to_milvus(data, milvus_db: Milvus, batch_size=10000):
+    :param redis: Клиент Redis.
+    :param output_format: Формат выгрузки.
+    :param cursor: Курсор SCAN для продолжения выгрузки.
+    :param max_batches: Количество шагов SCAN в странице.
+    """
+    paged = max_batches is not None
+    ndjson = output_format == 'ndjson'
+    if not ndjson:
+        yield b'{"items": [' if paged else b'['
+
+    first = True
+    next_cursor = 0
+    async for next_cursor, documents in iter_json_batches(
+        redis, 'login:*', cursor, max_batches=max_batches
+    ):
+        if not documents:
+            continue
+        lines = [json.dumps(document, ensure_ascii=False) for document in documents]
+        if ndjson:
+            chunk = "\n".join(lines) + "\n"
+        else:
+            chunk = ("" if first else ",") + ",".join(lines)
+        first = False
+        yield chunk.encode("utf-8")
+
+    if ndjson:
+        if paged:
+            yield f'{{"next_cursor": {next_cursor}}}\n'.encode("utf-8")
+    else:
+        yield f'], "next_cursor": {next_cursor}}}'.encode("utf-8") if paged else b']'
+
+
+async def insert_addresses_to_milvus(
+    data, milvus_db: Milvus, batch_size=10000, create_index: bool = True
+):
     """
     Вставляет данные в Milvus пакетами.
 
     :param data: Список данных для вставки.
     :param milvus_db: Объект Milvus.
     :param batch_size: Размер пакета (по умолчанию 10 000 элементов).
+    :param create_index: Построить индекс после вставки (False — при вставке частями).
     """
     total_batches = (len(data) + batch_size - 1) // batch_size
 
@@ -79,33 +223,30 @@ async def insert_addresses_to_milvus(data, milvus_db: Milvus, batch_size=10000):
             batch = data[i:i + batch_size]
             logger.info("Вставляю пакет %d из %d", i // batch_size + 1, total_batches)
             try:
-                formatted_data = []
+                records = milvus_db.new_batch(len(batch), ['house_id', 'flat'])
                 for entry in batch:
                     data_json = entry[0]
                     address = data_json.get('address')
-                    key = data_json.get('login')
                     house_id = data_json.get('houseId')
-                    flat = data_json.get('flat', '')
                     if address is None or house_id is None:
                         continue
-                    formatted_data.append({
-                        'hash': key,
-                        'text': 'passage: ' + address,
-                        'house_id': house_id,
-                        'flat': flat
-                    })
-
-                milvus_db.insert_data(
-                    formatted_data,
-                    additional_fields=['house_id', 'flat'],
-                    batch_size=16
-                )
+                    records.append(
+                        data_json.get('login'),
+                        'passage: ' + address,
+                        house_id,
+                        data_json.get('flat', '')
+                    )
+
+                # Эмбеддинги считаются вне цикла событий, чтобы не задерживать поиск
+                await asyncio.to_thread(milvus_db.embed_batch, records, 16)
+                milvus_db.insert_batch(records)
             except psycopg2.Error as e:
                 logger.error("Ошибка при вставке пакета %d: %s", i // batch_size + 1, e)
                 raise
             pbar.update(1)
 
-    milvus_db.create_index()
+    if create_index:
+        milvus_db.create_index()
 
 
 async def insert_promts_to_milvus(data: list[PromtModel], milvus_db: Milvus):
@@ -115,38 +256,25 @@ async def insert_promts_to_milvus(data: list[PromtModel], milvus_db: Milvus):
     :param data: Список объектов PromtModel для вставки.
     :param milvus_db: Объект Milvus.
     """
-    formatted_data = []
+    records = milvus_db.new_batch(len(data), ['name', 'params'])
     logger.info('Форматирование данных для вставки')
     for entry in data:
-        formatted_data.append({
-            'hash': entry.id,
-            'text': 'passage: ' + entry.template,
-            'name': entry.name,
-            'params': entry.params
-        })
+        records.append(entry.id, 'passage: ' + entry.template, entry.name, entry.params)
     logger.info('Вставка данных в Milvus')
-    milvus_db.insert_data(formatted_data, additional_fields=['name', 'params'], batch_size=1)
+    await asyncio.to_thread(milvus_db.embed_batch, records, 1)
+    milvus_db.insert_batch(records)
     milvus_db.create_index()
 
 
-async def insert_addresses_from_redis_to_milvus():
+async def insert_addresses_from_redis_to_milvus(redis: Redis):
     """
     Извлекает адреса из Redis и вставляет их в Milvus.
-    """
-    try:
-        unique_keys = list(await get_unique_keys_with_prefix(pattern='login:*', count=10000))
-        r = redis.from_url(
-            f"redis://{config.REDIS_HOST}:{config.REDIS_PORT}",
-            password=config.REDIS_PASSWORD,
-            decode_responses=True
-        )
-    except (TypeError, ValueError) as e:
-        logger.error("Ошибка при получении ключей из Redis: %s", e)
-        raise HTTPException(status_code=400, detail="Ошибка при получении ключей из Redis") from e
-    except Exception as e:
-        logger.error("Ошибка при получении ключей из Redis: %s", e)
-        raise HTTPException(status_code=500, detail="Ошибка при получении ключей из Redis") from e
 
+    Ключи читаются потоково (см. iter_keys_with_prefix), документы вставляются
+    в Milvus пакетами по мере накопления, без загрузки всего набора ключей в память.
+
+    :param redis: Клиент Redis.
+    """
     logger.info("Инициализация соединения с Milvus.")
     milvus_db = Milvus(
         config.MILVUS_HOST,
@@ -159,23 +287,46 @@ async def insert_addresses_from_redis_to_milvus():
 
     milvus_db.init_collection()
     result = []
+    insert_size = 10000
 
-    batch_size = 1024
-    total_keys = len(unique_keys)
+    async for values in _read_address_documents(redis):
+        result.extend(values)
+        if len(result) >= insert_size:
+            await insert_addresses_to_milvus(
+                result, milvus_db, batch_size=insert_size, create_index=False
+            )
+            result = []
 
-    with tqdm(total=total_keys, desc="Обработка ключей", unit=" ключей") as pbar:
-        for i in range(0, total_keys, batch_size):
-            batch_keys = unique_keys[i:i + batch_size]
-            values = r.json().mget(batch_keys, path="$")
-            result.extend(values)
-            pbar.update(len(batch_keys))
+    await insert_addresses_to_milvus(result, milvus_db, batch_size=insert_size)
 
-        await insert_addresses_to_milvus(result, milvus_db, batch_size=10000)
+
+async def _read_address_documents(redis: Redis, mget_size: int = 1024):
+    """
+    Потоковое чтение документов login:* из Redis пакетами JSON.MGET.
+    Ошибки чтения из Redis преобразуются в HTTPException; ошибки вставки
+    у вызывающего кода сюда не попадают.
+    """
+    try:
+        with tqdm(desc="Обработка ключей", unit=" ключей") as pbar:
+            async for keys in iter_keys_with_prefix(
+                redis, 'login:*', count=10000, shards=config.REDIS_SCAN_SHARDS
+            ):
+                for i in range(0, len(keys), mget_size):
+                    yield await redis.json().mget(keys[i:i + mget_size], path="$")
+                pbar.update(len(keys))
+    except (TypeError, ValueError) as e:
+        logger.error("Ошибка при получении ключей из Redis: %s", e)
+        raise HTTPException(status_code=400, detail="Ошибка при получении ключей из Redis") from e
+    except RedisError as e:
+        logger.error("Ошибка при получении ключей из Redis: %s", e)
+        raise HTTPException(status_code=500, detail="Ошибка при получении ключей из Redis") from e
 
 
-async def insert_promts_from_redis_to_milvus(redis):
+async def insert_promts_from_redis_to_milvus(redis: Redis):
     """
     Извлекает промты из Redis и вставляет их в Milvus.
+
+    :param redis: Клиент Redis.
     """
     try:
         result = await redis.json().get('scheme:vector')
@@ -279,6 +430,8 @@ def insert_wiki_data():
                 continue
 
         postgres_db.connection.commit()
+        topic_cache.clear()
+        ai_response_cache.clear()
         return True
 
     except psycopg2.Error as e:
@@ -310,16 +463,18 @@ def insert_all_data_from_postgres_to_milvus():
     milvus_db.init_collection()
 
     data = postgres_db.get_data_for_vector_db()
-    data_list = []
-    for topic in data:
-        topic_hash = topic[0]
-        book_name = topic[1] if topic[1] else ''
-        title = topic[2]
-        text_title_less = topic[3]
-        text = 'passage: ' + book_name + '\n' + title + ' ' + text_title_less
-        data_list.append({'hash': topic_hash, 'text': text, 'textTitleLess': text_title_less})
-
-    milvus_db.insert_data(data_list)
+    records = milvus_db.new_batch(len(data), ['book_name', 'url', 'title'])
+    for topic_hash, book_name, title, text, url in data:
+        book_name = book_name if book_name else ''
+        records.append(
+            topic_hash,
+            wiki_passage(book_name, title, text),
+            book_name,
+            url or '',
+            title[:WIKI_TITLE_MAX_LENGTH]
+        )
+
+    milvus_db.insert_data(records)
     milvus_db.create_index()
     duplicates = milvus_db.clean_similar_vectors()
     deleted_count = 0
@@ -352,7 +507,12 @@ def add_new_topic(title, text, user_id):
             wiki_index_params,
             wiki_search_params
         )
-        milvus_db.insert_data([{'hash': text_hash, 'text': title + text, 'textTitleLess': text}])
+        # Коллекция, созданная до появления book_name/url/title, принимает только те поля, что есть
+        values = {'book_name': '', 'url': '', 'title': title[:WIKI_TITLE_MAX_LENGTH]}
+        extra_fields = [field for field in values if milvus_db.has_fields([field])]
+        records = milvus_db.new_batch(1, extra_fields)
+        records.append(text_hash, wiki_passage('', title, text), *[values[field] for field in extra_fields])
+        milvus_db.insert_data(records)
         milvus_db.collection.flush()
         milvus_db.collection.load()
         postgres_db.connection_close()
@@ -368,122 +528,291 @@ async def upload_data_wiki_data_to_milvus():
     """
 
     logger.info('Выгрузка данных WIKI')
-    insert_wiki_data()
-    insert_all_data_from_postgres_to_milvus()
+    await asyncio.to_thread(insert_wiki_data)
+    await asyncio.to_thread(insert_all_data_from_postgres_to_milvus)
+
 
+def wiki_passage(book_name: str, title: str, text: str) -> str:
+    """Текст темы wiki для эмбеддинга и хранения в Milvus."""
+    return 'passage: ' + book_name + '\n' + title + ' ' + text
 
-async def search_milvus_and_prep_data(text, user_id) -> SearchResponseData:
+
+def _topic_from_entity(entity):
     """
-    Выполняет поиск в Milvus и подготавливает данные для ответа.
+    Собирает (book_name, text, url) из полей найденной в Milvus записи.
 
-    :param text: Текст запроса.
-    :param user_id: ID пользователя.
-    :return: Объект SearchResponseData.
+    Текст совпадает с текстом темы в PostgreSQL: префикс, название книги и заголовок
+    (см. wiki_passage) отрезаются. Возвращает None, если текст в Milvus обрезан при вставке
+    или заголовок не удаётся отделить, — тогда текст берётся из PostgreSQL.
     """
+    stored_text = entity.get('text')
+    title = entity.get('title')
+    if stored_text is None or title is None or len(stored_text) >= MAX_TEXT_LENGTH:
+        return None
+    book_name = entity.get('book_name') or ''
+    head = wiki_passage(book_name, title, '')
+    if not stored_text.startswith(head):
+        return None
+    return book_name, stored_text[len(head):], entity.get('url') or None
+
+
+def get_topics_by_hashs_cached(hashs: tuple[str]):
+    """
+    Возвращает темы hash -> (book_name, text, url) через LRU-кэш.
+
+    Отсутствующие в кэше темы запрашиваются из PostgreSQL одним запросом.
+    """
+    topics = topic_cache.get_many(hashs)
+    misses = tuple(topic_hash for topic_hash in hashs if topic_hash not in topics)
+    if not misses:
+        return topics
+
+    generation = topic_cache.generation
     postgres_db = PostgreSQL(**config.postgres_config)
-    milvus_db = Milvus(
-        config.MILVUS_HOST,
-        config.MILVUS_PORT,
-        'Frida_bot_data',
-        wiki_schema,
-        wiki_index_params, 
-        wiki_search_params)
-    milvus_db.collection.load()
     try:
-        response = milvus_db.search(text)
-        if response is None:
-            raise ValueError("Milvus search() вернул None")
-
-        if isinstance(response, SearchFuture):
-            response = response.result()
-
-        if not isinstance(response, SearchResult):
-            raise TypeError(f"Неподдерживаемый тип ответа от Milvus: {type(response)}")
-
-        hashs = []
-        for hits in response:
-            for hit in hits:
-                hash_val = hit.entity.get("hash")
-                if hash_val:
-                    hashs.append(hash_val)
-
-        contexts = postgres_db.get_topics_texts_by_hashs(tuple(hashs))
-        result_string = "История вашего диалога: "
-        message_history = postgres_db.get_history(user_id)
-        for i, msg in enumerate(message_history, 1):
-            query = msg[2]
-            response = msg[3]
-            result_string += f"{i}) Запрос пользователя: {query} | Твой ответ: {response} "
-
-        combined_context = ""
-        for i, (book_name, text, url) in enumerate(contexts, start=1):
-            book_name = book_name if book_name else ''
-            combined_context += f" Контекст {i}: {book_name + ' ' + text}  URL: {url}"
-
-        return SearchResponseData(
-            combined_context=combined_context,
-            chat_history=result_string,
-            hashs=hashs
-            )
+        fetched = postgres_db.get_topics_by_hashs(misses)
     finally:
-        milvus_db.data_release()
-        milvus_db.connection_close()
+        postgres_db.connection_close()
+    topic_cache.set_many(fetched, generation)
+    topics.update(fetched)
+    return topics
 
 
-async def search_milvus(text) -> Search2ResponseData:
+def search_wiki_hits(milvus_db: Milvus, query_embedding):
     """
-    Выполняет поиск в Milvus и возвращает контекст без истории диалога.
+    Ищет темы wiki по готовому эмбеддингу запроса.
+
+    При WIKI_CONTEXT_SOURCE='milvus' текст, book_name и url берутся из ответа Milvus.
+
+    :param milvus_db: Объект Milvus коллекции wiki.
+    :param query_embedding: Нормализованный эмбеддинг запроса.
+    :return: Кортеж (hashs, topics): хэши в порядке релевантности и найденные
+        в ответе Milvus контексты hash -> (book_name, text, url).
+    """
+    from_milvus = (
+        config.WIKI_CONTEXT_SOURCE == 'milvus' and milvus_db.has_fields(wiki_output_fields)
+    )
+    response = milvus_db.search(
+        None, wiki_output_fields if from_milvus else None, query_embedding=query_embedding
+    )
+    if response is None:
+        raise ValueError("Milvus search() вернул None")
+
+    if isinstance(response, SearchFuture):
+        response = response.result()
+
+    if not isinstance(response, SearchResult):
+        raise TypeError(f"Неподдерживаемый тип ответа от Milvus: {type(response)}")
+
+    hashs = []
+    topics = {}
+    for hits in response:
+        for hit in hits:
+            hash_val = hit.entity.get("hash")
+            if not hash_val:
+                continue
+            hashs.append(hash_val)
+            topic = _topic_from_entity(hit.entity) if from_milvus else None
+            if topic is not None:
+                topics[hash_val] = topic
+    return hashs, topics
+
+
+def _search_wiki(text, timer: funcs.StageTimer):
+    """Эмбеддинг запроса (через кэш) и поиск тем wiki в Milvus; блокирующие вызовы."""
+    with timer.stage('embed'):
+        query_embedding = query_embedding_cache.get(text)
+        if query_embedding is None:
+            query_embedding = Milvus.embed_query(text)
+            query_embedding_cache.set(text, query_embedding)
+
+    with timer.stage('search'):
+        milvus_db = milvus_connection.collection(
+            'Frida_bot_data', wiki_schema, wiki_index_params, wiki_search_params
+        )
+        return search_wiki_hits(milvus_db, query_embedding)
+
+
+async def retrieve_wiki_contexts(text, timer: funcs.StageTimer):
+    """
+    Ищет контексты wiki для запроса.
+
+    Эмбеддинг (повторные запросы берут его из кэша) и поиск в Milvus выполняются
+    в отдельном потоке, недостающие в ответе Milvus тексты дозапрашиваются
+    из PostgreSQL (через кэш) тоже вне цикла событий.
 
     :param text: Текст запроса.
-    :return: Объект Search2ResponseData.
+    :param timer: Замер этапов (embed, search, contexts).
+    :return: Кортеж (hashs, contexts), где contexts — список (book_name, text, url)
+        в порядке релевантности.
     """
+    hashs, topics = await asyncio.to_thread(_search_wiki, text, timer)
+
+    missing = tuple(topic_hash for topic_hash in hashs if topic_hash not in topics)
+    if missing:
+        with timer.stage('contexts'):
+            topics.update(await asyncio.to_thread(get_topics_by_hashs_cached, missing))
+
+    contexts = [topics[topic_hash] for topic_hash in hashs if topic_hash in topics]
+    return hashs, contexts
+
+
+def get_history(user_id):
+    """Получает последние сообщения пользователя из PostgreSQL."""
     postgres_db = PostgreSQL(**config.postgres_config)
-    milvus_db = Milvus(config.MILVUS_HOST, config.MILVUS_PORT, 'Frida_bot_data', wiki_schema, wiki_index_params, wiki_search_params)
     try:
-        response = milvus_db.search(text)
-        if response is None:
-            raise ValueError("Milvus search() вернул None")
-
-        if isinstance(response, SearchFuture):
-            response = response.result()
-
-        if not isinstance(response, SearchResult):
-            raise TypeError(f"Неподдерживаемый тип ответа от Milvus: {type(response)}")
-
-        hashs = []
-        for hits in response:
-            for hit in hits:
-                hash_val = hit.entity.get("hash")
-                if hash_val:
-                    hashs.append(hash_val)
-
-        contexts = postgres_db.get_topics_texts_by_hashs(tuple(hashs))
-        combined_context = ""
-        for i, (book_name, text, url) in enumerate(contexts, start=1):
-            book_name = book_name if book_name else ''
-            combined_context += f" Контекст {i}: {book_name + ' ' + text}  URL: {url}"
-
-        return Search2ResponseData(combined_context=combined_context, hashs=hashs)
+        return postgres_db.get_history(user_id)
     finally:
-        milvus_db.data_release()
-        milvus_db.connection_close()
+        postgres_db.connection_close()
 
 
-async def auth_1c(telegramid: int) -> Employee1C | Dict[str, str]:
+def log_message(user_id, query, response, status: bool, hashs, category: str = ""):
+    """Записывает запрос пользователя и ответ в bot_logs."""
+    postgres_db = PostgreSQL(**config.postgres_config)
+    try:
+        postgres_db.log_message(user_id, query, response, status, hashs, category)
+    finally:
+        postgres_db.connection_close()
+
+
+def add_user(user_id: int, username: str, first_name: str, last_name: str) -> bool:
+    """
+    Добавляет пользователя в users, если его там нет.
+    Для пользователей, уже известных процессу, база не запрашивается.
+
+    :return: True, если пользователь добавлен, False — если уже был в базе.
+    """
+    if users_cache.is_known(user_id):
+        return False
+    postgres_db = PostgreSQL(**config.postgres_config)
+    try:
+        return postgres_db.add_user_to_db(user_id, username, first_name, last_name)
+    finally:
+        postgres_db.connection_close()
+
+
+def get_admins():
+    """Список администраторов [(user_id, username), ...] из кэша или базы."""
+    cached = users_cache.get_admins()
+    if cached is not None:
+        return cached
+    postgres_db = PostgreSQL(**config.postgres_config)
+    try:
+        return postgres_db.get_admins(use_cache=False)
+    finally:
+        postgres_db.connection_close()
+
+
+def check_user_is_admin(user_id) -> bool:
+    """Проверяет, является ли пользователь администратором, по общему с get_admins кэшу."""
+    try:
+        user_id = int(user_id)
+    except (TypeError, ValueError):
+        return False
+    return any(admin_id == user_id for admin_id, _ in get_admins())
+
+
+def format_history(message_history) -> str:
+    """Форматирует историю диалога для модели."""
+    return "История вашего диалога: " + "".join(
+        f"{i}) Запрос пользователя: {query} | Твой ответ: {response} "
+        for i, (query, response) in enumerate(message_history, 1)
+    )
+
+
+def _budget(budget_tokens: int | None) -> int:
+    """Бюджет контекста: переданный или CONTEXT_TOKEN_BUDGET по умолчанию."""
+    return config.CONTEXT_TOKEN_BUDGET if budget_tokens is None else budget_tokens
+
+
+async def search_milvus_and_prep_data(
+    text, user_id, timer: funcs.StageTimer | None = None, budget_tokens: int | None = None
+) -> SearchResponseData:
+    """
+    Выполняет поиск в Milvus и подготавливает данные для ответа.
+
+    Поиск контекстов и загрузка истории диалога выполняются параллельно.
+
+    :param text: Текст запроса.
+    :param user_id: ID пользователя.
+    :param timer: Замер этапов для заголовка Server-Timing.
+    :param budget_tokens: Бюджет контекста в токенах (None — CONTEXT_TOKEN_BUDGET, 0 — без ограничения).
+    :return: Объект SearchResponseData.
+    """
+    timer = timer if timer is not None else funcs.StageTimer()
+
+    async def load_history():
+        with timer.stage('history'):
+            return await asyncio.to_thread(get_history, user_id)
+
+    with timer.stage('total'):
+        (hashs, contexts), message_history = await asyncio.gather(
+            retrieve_wiki_contexts(text, timer), load_history()
+        )
+        with timer.stage('assemble'):
+            built = build_context(text, contexts, _budget(budget_tokens))
+            return SearchResponseData(
+                combined_context=built.text,
+                chat_history=format_history(message_history),
+                hashs=hashs,
+                context_tokens=built.tokens,
+                tokens_saved=built.tokens_saved,
+                )
+
+
+async def search_milvus(
+    text, timer: funcs.StageTimer | None = None, budget_tokens: int | None = None
+) -> Search2ResponseData:
+    """
+    Выполняет поиск в Milvus и возвращает контекст без истории диалога.
+
+    :param text: Текст запроса.
+    :param timer: Замер этапов для заголовка Server-Timing.
+    :param budget_tokens: Бюджет контекста в токенах (None — CONTEXT_TOKEN_BUDGET, 0 — без ограничения).
+    :return: Объект Search2ResponseData.
+    """
+    timer = timer if timer is not None else funcs.StageTimer()
+    hashs, contexts = await retrieve_wiki_contexts(text, timer)
+    built = build_context(text, contexts, _budget(budget_tokens))
+    return Search2ResponseData(
+        combined_context=built.text,
+        hashs=hashs,
+        context_tokens=built.tokens,
+        tokens_saved=built.tokens_saved,
+    )
+
+
+async def auth_1c(telegramid: int, use_cache: bool = True) -> Employee1C | Dict[str, str]:
     """
     Проверяет сотрудника по telegramid через 1C.
     Если пусто — доступа нет, если есть fio — возвращает данные.
+    Ответы кэшируются, одновременные проверки одного id объединяются (см. client_1c).
     """
-    url = f'http://server1c.freedom1.ru/UNF_CRM_WS/hs/Grafana/anydata?query=emploeyy&telegramId={telegramid}'
-    async with ClientSession() as session:
-        async with session.get(url) as res:
-            if res.status != 200:
-                return {"error": "Ошибка соединения с 1С"}
-            data = await res.json(content_type=None)
-            if not data:
-                return {"error": "Доступ запрещён"}
-            fio = data.get("fio")
-            jobTitle = data.get('jobTitle')
-            if fio and jobTitle:
-                return Employee1C(fio=fio, jobTitle=jobTitle)
-            return {"error": "Неизвестный ответ от 1С"}
+    return await client_1c.get_employee(telegramid, use_cache)
+
+
+async def auth_1c_many(
+    telegramids, use_cache: bool = False, concurrency: int | None = None, rate_limiter=None
+) -> Dict[int, Employee1C | Dict[str, str]]:
+    """
+    Проверяет несколько сотрудников через 1C, не более MAX_CONCURRENT_REQUESTS одновременно.
+
+    :param telegramids: Telegram id пользователей.
+    :param use_cache: Использовать кэш (по умолчанию данные запрашиваются заново).
+    :param concurrency: Собственный предел одновременных запросов вместо общего.
+    :param rate_limiter: Ограничение частоты запросов (funcs.RateLimiter).
+    :return: Словарь telegramid -> Employee1C или словарь с ключом error.
+    """
+    limit = asyncio.Semaphore(concurrency) if concurrency else semaphore
+
+    async def check(telegramid):
+        async with limit:
+            if rate_limiter is not None:
+                await rate_limiter.acquire()
+            try:
+                return telegramid, await auth_1c(telegramid, use_cache)
+            except Exception as e:
+                logger.warning("Ошибка при проверке пользователя %s в 1С: %s", telegramid, e)
+                return telegramid, {"error": "Ошибка соединения с 1С"}
+
+    return dict(await asyncio.gather(*(check(telegramid) for telegramid in telegramids)))
@@ -3,8 +3,10 @@
 Содержит классы и методы для взаимодействия с коллекциями, выполнения запросов и обработки данных.
 """
 
+import threading
 from typing import List
 
+import numpy as np
 from pymilvus import Collection, CollectionSchema, connections
 from pymilvus import utility
 from pymilvus.exceptions import MilvusException
@@ -12,13 +14,92 @@ from pymilvus.exceptions import MilvusException
 from sklearn.preprocessing import normalize
 
 import psycopg2
+from psycopg2.extras import execute_values
 import mysql.connector
 
-from GPU_control import gpu_lock
+from device_scheduler import device_scheduler
+import config
+from cache import history_cache, topic_cache, users_cache
 import funcs
 
 # from config import mysql_config, postgres_config
 
+# Ограничение длины текста, сохраняемого в Milvus
+MAX_TEXT_LENGTH = 20000
+
+
+class MilvusConnection:
+    """
+    Общее подключение к Milvus и загруженные коллекции для поиска.
+
+    pymilvus держит одно подключение default на процесс, поэтому объекты Milvus
+    не подключаются и не отключаются сами, а берут ссылку на общее подключение:
+    отключение происходит, когда отпущена последняя ссылка. Приложение держит
+    свою ссылку всё время работы (см. lifespan), так что поиск и загрузка данных
+    не закрывают подключение друг у друга.
+    """
+
+    def __init__(self):
+        self._users = 0
+        self._opened = False
+        self._lock = threading.Lock()
+        self._search = {}
+        self._search_lock = threading.Lock()
+
+    def acquire(self, host, port):
+        """Подключение при первой ссылке."""
+        with self._lock:
+            if not self._users:
+                connections.connect(host=host, port=port)
+            self._users += 1
+
+    def release(self):
+        """Отключение при освобождении последней ссылки."""
+        with self._lock:
+            if not self._users:
+                return
+            self._users -= 1
+            if not self._users:
+                connections.disconnect("default")
+
+    def collection(self, collection_name, fields, index_params, search_params) -> "Milvus":
+        """
+        Коллекция для поиска, общая для всех запросов.
+
+        Индекс и загрузка коллекции в память выполняются один раз при первом обращении;
+        запросы не освобождают коллекцию и не закрывают подключение.
+        """
+        with self._search_lock:
+            milvus_db = self._search.get(collection_name)
+            if milvus_db is None:
+                milvus_db = Milvus(
+                    config.MILVUS_HOST, config.MILVUS_PORT,
+                    collection_name, fields, index_params, search_params,
+                )
+                try:
+                    milvus_db.create_index()
+                except Exception:
+                    milvus_db.connection_close()
+                    raise
+                self._search[collection_name] = milvus_db
+            return milvus_db
+
+    def open(self):
+        """Ссылка приложения на подключение (на всё время работы)."""
+        if not self._opened:
+            self.acquire(config.MILVUS_HOST, config.MILVUS_PORT)
+            self._opened = True
+
+    def close(self):
+        """Освобождение коллекций поиска и ссылки приложения."""
+        with self._search_lock:
+            search, self._search = self._search, {}
+        for milvus_db in search.values():
+            milvus_db.connection_close()
+        if self._opened:
+            self._opened = False
+            self.release()
+
 
 class Milvus:
     """Класс для работы с коллекциями Milvus."""
@@ -26,19 +107,22 @@ class Milvus:
     def __init__(
         self, host, port, collection_name, fields, index_params, search_params
     ):
-        """Инициализация подключения к Milvus и создание коллекции."""
-        connections.connect(host=host, port=port)
+        """Открытие или создание коллекции на общем подключении к Milvus."""
+        milvus_connection.acquire(host, port)
+        self._connected = True
         self.collection_name = collection_name
         self.fields = fields
         self.index_params = index_params
         self.schema = CollectionSchema(fields=self.fields)
-        collections = utility.list_collections()
-
-        if collection_name in collections:
-            self.collection = Collection(self.collection_name)
-            self.create_index()
-        else:
-            self.collection = Collection(name=self.collection_name, schema=self.schema)
+        try:
+            collections = utility.list_collections()
+            if collection_name in collections:
+                self.collection = Collection(self.collection_name)
+            else:
+                self.collection = Collection(name=self.collection_name, schema=self.schema)
+        except Exception:
+            self.connection_close()
+            raise
 
         self.search_params = search_params
 
@@ -64,47 +148,75 @@ class Milvus:
         except MilvusException as e:
             print(f"Ошибка при проверке или удалении коллекции: {e}")
 
-    def insert_data(self, data: List[dict], additional_fields=None, batch_size=2):
-        """Вставка данных в коллекцию с динамическим количеством дополнительных полей."""
-        if additional_fields is None:
-            additional_fields = []
-        hashs, texts, embeddings_all = [], [], []
-        additional_data = {field: [] for field in additional_fields}
-
-        for topic in data:
-            hashs.append(topic.get("hash", ""))
-            text = topic.get("text", "")
-            texts.append(text[:20000])
-
-            for field in additional_fields:
-                additional_data[field].append(str(topic.get(field, "")))
-
-        with gpu_lock():
-            with funcs.use_device(funcs.model, funcs.device):
-                for i in range(0, len(texts), batch_size):
-                    embeddings_all.extend(
-                        funcs.generate_embedding(texts[i : i + batch_size])
-                    )
+    @property
+    def embedding_dim(self) -> int:
+        """Размерность поля embedding из схемы коллекции."""
+        for field in self.fields:
+            if field.name == "embedding":
+                return field.params["dim"]
+        raise ValueError(f"В схеме {self.collection_name} нет поля embedding")
 
-        funcs.clear_gpu_memory()
-        embeddings_all = normalize(embeddings_all, axis=1)
-        data_to_insert = [
-            hashs,
-            embeddings_all,
-            texts,
-            *[additional_data[field] for field in additional_fields],
-        ]
-        self.collection.insert(data_to_insert)
+    def has_fields(self, field_names) -> bool:
+        """Проверка, что коллекция содержит все указанные поля."""
+        existing = {field.name for field in self.collection.schema.fields}
+        return set(field_names).issubset(existing)
 
-    def search(self, query_text: str, additional_fields=None, limit=5):
-        """Поиск по запросу с возвратом нужных полей."""
-        if additional_fields is None:
-            additional_fields = []
-        with funcs.use_device(funcs.model, funcs.device):
+    def new_batch(self, capacity: int, additional_fields=None) -> "RecordBatch":
+        """Создание пустого колоночного пакета под схему коллекции."""
+        return RecordBatch(capacity, self.embedding_dim, additional_fields)
+
+    def embed_batch(self, batch: "RecordBatch", batch_size=2):
+        """
+        Генерация нормализованных эмбеддингов колоночного пакета.
+
+        Пакеты по batch_size текстов считаются слайсами планировщика устройства:
+        между ними GPU может быть отдан запросам пользователей.
+        """
+        embeddings = batch.embeddings
+
+        def step(start):
+            def run():
+                embeddings[start : start + batch_size] = funcs.generate_embedding(
+                    batch.texts[start : start + batch_size]
+                )
+            return run
+
+        device_scheduler.run_bulk(step(i) for i in range(0, len(batch), batch_size))
+        funcs.clear_gpu_memory()
+        batch.normalize()
+
+    def insert_batch(self, batch: "RecordBatch"):
+        """Вставка колоночного пакета с готовыми эмбеддингами в коллекцию."""
+        if len(batch):
+            self.collection.insert(batch.to_columns())
+
+    def insert_data(self, batch: "RecordBatch", batch_size=2):
+        """Вставка колоночного пакета в коллекцию с генерацией эмбеддингов."""
+        if not len(batch):
+            return
+        self.embed_batch(batch, batch_size)
+        self.insert_batch(batch)
+
+    @staticmethod
+    def embed_query(query_text: str):
+        """Генерация нормализованного эмбеддинга поискового запроса."""
+        with device_scheduler.interactive():
             query_embedding = funcs.generate_embedding([f"query: {query_text}"])
 
         funcs.clear_gpu_memory()
-        query_embedding = normalize(query_embedding, axis=1)
+        return normalize(query_embedding, axis=1)
+
+    def search(self, query_text: str, additional_fields=None, limit=5, query_embedding=None):
+        """
+        Поиск по запросу с возвратом нужных полей.
+
+        :param query_embedding: Готовый эмбеддинг запроса (см. embed_query);
+            если не передан, генерируется из query_text.
+        """
+        if additional_fields is None:
+            additional_fields = []
+        if query_embedding is None:
+            query_embedding = self.embed_query(query_text)
         output_fields = ["hash"] + (additional_fields if additional_fields else [])
 
         results = self.collection.search(
@@ -163,8 +275,70 @@ class Milvus:
         self.collection.drop()
 
     def connection_close(self):
-        """Закрытие соединения с Milvus."""
-        connections.disconnect("default")
+        """Освобождение ссылки на общее подключение к Milvus."""
+        if self._connected:
+            self._connected = False
+            milvus_connection.release()
+
+
+milvus_connection = MilvusConnection()
+
+
+class RecordBatch:
+    """
+    Колоночный пакет записей для вставки в Milvus.
+
+    Эмбеддинги пишутся в заранее выделенный блок float32, строковые колонки
+    собираются один раз и передаются в Milvus без промежуточных словарей.
+    """
+
+    def __init__(
+        self, capacity: int, dim: int, additional_fields=None, max_text_length=MAX_TEXT_LENGTH
+    ):
+        """
+        :param capacity: Максимальное количество записей в пакете.
+        :param dim: Размерность эмбеддингов.
+        :param additional_fields: Имена дополнительных строковых полей в порядке схемы.
+        :param max_text_length: Ограничение длины текста.
+        """
+        self.additional_fields = list(additional_fields or [])
+        self.max_text_length = max_text_length
+        self.hashs: List[str] = []
+        self.texts: List[str] = []
+        self.columns = {field: [] for field in self.additional_fields}
+        self._embeddings = np.empty((capacity, dim), dtype=np.float32)
+
+    def __len__(self):
+        return len(self.hashs)
+
+    def append(self, topic_hash: str, text: str, *values):
+        """Добавление записи; values передаются в порядке additional_fields."""
+        if len(self.hashs) >= self._embeddings.shape[0]:
+            raise ValueError("Пакет заполнен")
+        self.hashs.append(topic_hash)
+        self.texts.append(text[: self.max_text_length])
+        for field, value in zip(self.additional_fields, values, strict=True):
+            self.columns[field].append(str(value))
+
+    @property
+    def embeddings(self) -> np.ndarray:
+        """Заполненная часть блока эмбеддингов (представление, без копирования)."""
+        return self._embeddings[: len(self)]
+
+    def normalize(self):
+        """L2-нормализация эмбеддингов на месте."""
+        embeddings = self.embeddings
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        np.divide(embeddings, norms, out=embeddings, where=norms > 0)
+
+    def to_columns(self) -> list:
+        """Колонки в порядке схемы: hash, embedding, text, дополнительные поля."""
+        return [
+            self.hashs,
+            self.embeddings,
+            self.texts,
+            *[self.columns[field] for field in self.additional_fields],
+        ]
 
 
 class MySQL:
@@ -231,17 +405,27 @@ class PostgreSQL:
         """
         self.cursor.execute(exstra_query, (topic_hash, user_id))
         self.connection.commit()
+        topic_cache.invalidate([topic_hash])
 
     def add_user_to_db(
         self, user_id: int, username: str, first_name: str, last_name: str
-    ):
-        """Добавление нового пользователя в базу данных."""
+    ) -> bool:
+        """
+        Добавление пользователя в базу данных, если его там нет (один запрос).
+
+        :return: True, если пользователь добавлен, False — если уже был в базе.
+        """
         query = """
             INSERT INTO users (user_id, username, first_name, last_name)
             VALUES (%s, %s, %s, %s)
+            ON CONFLICT (user_id) DO NOTHING
+            RETURNING user_id
         """
         self.cursor.execute(query, (user_id, username, first_name, last_name))
+        created = self.cursor.fetchone() is not None
         self.connection.commit()
+        users_cache.add_known(user_id)
+        return created
 
     def log_message(
         self,
@@ -274,77 +458,118 @@ class PostgreSQL:
             """
             self.cursor.execute(hash_query, (log_id, topic_hash))
         self.connection.commit()
+        history_cache.append(user_id, user_query, response)
 
-    def user_exists(self, user_id: int):
-        """Проверка существования пользователя в базе данных."""
-        query = """
-            SELECT 1 FROM users WHERE user_id = %s
+    def get_users_page(self, after_user_id, limit: int):
         """
-        self.cursor.execute(query, (user_id,))
-        result = self.cursor.fetchone()
-        return result is not None
+        Страница пользователей [(user_id, first_name, last_name), ...] по возрастанию user_id.
 
-    def check_user_is_admin(self, user_id):
-        """Проверка, является ли пользователь администратором."""
-        query = """
-            SELECT is_admin FROM users WHERE user_id = %s
+        :param after_user_id: Последний user_id предыдущей страницы (None — с начала).
+        :param limit: Размер страницы.
         """
-        self.cursor.execute(query, (user_id,))
-        result = self.cursor.fetchone()
-        return result[0] if result is not None else None
+        if after_user_id is None:
+            query = """
+                SELECT user_id, first_name, last_name FROM users
+                ORDER BY user_id LIMIT %s
+            """
+            self.cursor.execute(query, (limit,))
+        else:
+            query = """
+                SELECT user_id, first_name, last_name FROM users
+                WHERE user_id > %s ORDER BY user_id LIMIT %s
+            """
+            self.cursor.execute(query, (after_user_id, limit))
+        return self.cursor.fetchall()
 
-    def get_admins(self):
-        """Получение списка администраторов."""
+    def update_users_names(self, rows) -> int:
+        """
+        Обновление имён пользователей одним запросом.
+
+        :param rows: Список (user_id, first_name, last_name).
+        :return: Количество изменённых строк (строки с теми же именами не перезаписываются).
+        """
+        if not rows:
+            return 0
+        query = """
+            UPDATE users AS u
+            SET first_name = v.first_name, last_name = v.last_name
+            FROM (VALUES %s) AS v (user_id, first_name, last_name)
+            WHERE u.user_id = v.user_id
+              AND (u.first_name IS DISTINCT FROM v.first_name
+                   OR u.last_name IS DISTINCT FROM v.last_name)
+        """
+        execute_values(self.cursor, query, rows, page_size=len(rows))
+        updated = self.cursor.rowcount
+        self.connection.commit()
+        return updated
+
+    def get_admins(self, use_cache: bool = True):
+        """Получение списка администраторов [(user_id, username), ...]."""
+        if use_cache:
+            cached = users_cache.get_admins()
+            if cached is not None:
+                return cached
+        generation = users_cache.admins_generation
         query = """
             SELECT user_id, username FROM users WHERE is_admin = TRUE;
         """
         self.cursor.execute(query)
         result = self.cursor.fetchall()
+        users_cache.set_admins(result, generation)
         return result
 
     def get_data_for_vector_db(self):
         """Получение данных для векторной базы."""
-        query = "SELECT hash, book_name, title, text FROM frida_storage"
+        query = "SELECT hash, book_name, title, text, url FROM frida_storage"
         self.cursor.execute(query)
         result = self.cursor.fetchall()
         return result
 
     def get_history(self, user_id):
-        """Получение истории сообщений пользователя."""
+        """
+        Получение истории сообщений пользователя в виде [(query, response), ...].
+
+        Сначала читается кэш последних сообщений, при промахе — база.
+        """
+        cached = history_cache.get(user_id)
+        if cached is not None:
+            return cached
+
+        version = history_cache.version(user_id)
         query = """
-        WITH LastThreeLogs AS (
-            SELECT *
+        WITH LastLogs AS (
+            SELECT bl.query, bl.response, bl.created_at
             FROM bot_logs bl
             WHERE bl.user_id = %s
             ORDER BY bl.created_at DESC
-            LIMIT 3
+            LIMIT %s
         )
-        SELECT *
-        FROM LastThreeLogs
+        SELECT query, response
+        FROM LastLogs
         ORDER BY created_at ASC;
         """
-        self.cursor.execute(query, (user_id,))
+        self.cursor.execute(query, (user_id, config.HISTORY_DEPTH))
         result = self.cursor.fetchall()
+        history_cache.load(user_id, result, version)
         return result
 
-    def get_topics_texts_by_hashs(self, hashs: tuple[str]):
-        """Получение текстов тем по их хэшам."""
+    def get_topics_by_hashs(self, hashs: tuple[str]):
+        """Получение тем по хэшам в виде словаря hash -> (book_name, text, url)."""
         if not hashs:
-            return []
+            return {}
 
         placeholders = ", ".join(["%s"] * len(hashs))
         query = f"""
-            SELECT book_name, text, url
+            SELECT hash, book_name, text, url
             FROM frida_storage fs
             WHERE fs.hash IN ({placeholders})
         """
         try:
             self.cursor.execute(query, hashs)
-            result = self.cursor.fetchall()
-            return result
+            return {row[0]: row[1:] for row in self.cursor.fetchall()}
         except psycopg2.Error as e:
             print(f"Database error: {e}")
-            return []
+            return {}
 
     def delete_items_by_hashs(self, hashs):
         """Удаление элементов из базы данных по хэшам."""
@@ -354,6 +579,7 @@ class PostgreSQL:
         """
         self.cursor.execute(query, (hashs,))
         self.connection.commit()
+        topic_cache.invalidate(hashs)
         affected_rows = self.cursor.rowcount
         return affected_rows
 
@@ -366,6 +592,44 @@ class PostgreSQL:
         result = self.cursor.fetchone()
         return result[0] if result is not None else None
 
+    def create_llm_usage_table(self):
+        """Создание таблицы llm_usage_logs, если её нет."""
+        self.cursor.execute(
+            """
+            CREATE TABLE IF NOT EXISTS llm_usage_logs (
+                id BIGSERIAL PRIMARY KEY,
+                created_at TIMESTAMPTZ NOT NULL,
+                request_id TEXT,
+                model TEXT NOT NULL,
+                status TEXT NOT NULL,
+                latency DOUBLE PRECISION,
+                ttft DOUBLE PRECISION,
+                prompt_tokens INTEGER,
+                completion_tokens INTEGER,
+                streamed BOOLEAN NOT NULL DEFAULT FALSE
+            )
+            """
+        )
+        self.connection.commit()
+
+    def log_llm_usage(self, rows):
+        """
+        Запись вызовов моделей AI в llm_usage_logs (см. create_llm_usage_table).
+
+        :param rows: Кортежи (created_at, request_id, model, status, latency, ttft,
+            prompt_tokens, completion_tokens, streamed).
+        """
+        execute_values(
+            self.cursor,
+            """
+            INSERT INTO llm_usage_logs (created_at, request_id, model, status, latency, ttft,
+                                        prompt_tokens, completion_tokens, streamed)
+            VALUES %s
+            """,
+            rows,
+        )
+        self.connection.commit()
+
     def connection_close(self):
         """Закрытие соединения с PostgreSQL."""
         self.cursor.close()
@@ -1,22 +1,51 @@
+"""
+Зависимости FastAPI и фабрики общих подключений.
 
-from typing import Annotated, Any, AsyncGenerator
-from redis.asyncio import Redis, from_url
-from fastapi import Depends
+Пул соединений Redis и локальный кэш JSON документов создаются один раз
+в lifespan и передаются маршрутам через зависимости RedisDependency
+и RedisCacheDependency.
+"""
+
+from typing import Annotated
+
+from fastapi import Depends, Request
+from redis.asyncio import BlockingConnectionPool, Redis
 
 import config
+from redis_cache import RedisJSONCache
+
+
+def create_redis_pool(decode_responses: bool = True) -> BlockingConnectionPool:
+    """
+    Создание пула соединений Redis с настройками из конфигурации.
+
+    При исчерпании пула запрос ждёт освободившееся соединение
+    не дольше REDIS_POOL_TIMEOUT секунд.
+    """
+    return BlockingConnectionPool.from_url(
+        f"redis://{config.REDIS_HOST}:{config.REDIS_PORT}",
+        password=config.REDIS_PASSWORD,
+        decode_responses=decode_responses,
+        max_connections=config.REDIS_MAX_CONNECTIONS,
+        timeout=config.REDIS_POOL_TIMEOUT,
+        health_check_interval=config.REDIS_HEALTH_CHECK_INTERVAL,
+        socket_timeout=config.REDIS_SOCKET_TIMEOUT,
+        socket_connect_timeout=config.REDIS_SOCKET_CONNECT_TIMEOUT,
+        socket_keepalive=True,
+    )
+
+
+async def get_redis_connection(request: Request) -> Redis:
+    """Получение общего клиента Redis, созданного в lifespan."""
+    return request.app.state.redis
+
+
+RedisDependency = Annotated[Redis, Depends(get_redis_connection)]
 
 
-async def get_redis_connection() -> AsyncGenerator[Redis, None]:
-    """Получение подключения к Redis."""
-    connection = from_url(
-            f"redis://{config.REDIS_HOST}:{config.REDIS_PORT}",
-            password=config.REDIS_PASSWORD,
-            decode_responses=True
-        )
-    try:
-        yield connection
-    finally:
-        await connection.aclose()
+async def get_redis_cache(request: Request) -> RedisJSONCache:
+    """Получение локального кэша JSON документов Redis, созданного в lifespan."""
+    return request.app.state.redis_cache
 
 
-RedisDependency = Annotated[Any, Depends(get_redis_connection)]
\ No newline at end of file
+RedisCacheDependency = Annotated[RedisJSONCache, Depends(get_redis_cache)]
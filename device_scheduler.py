@@ -0,0 +1,151 @@
+"""
+Планировщик устройства для генерации эмбеддингов.
+
+Эмбеддинги запросов пользователей (interactive) и загрузки данных (bulk) считаются
+под блокировкой GPU (см. GPU_control) с соответствующим приоритетом. Загрузка
+выполняется слайсами: если GPU ждёт кто-то ещё (любой ожидающий этого процесса
+или interactive другого), bulk отпускает блокировку после очередного пакета,
+как только слайс длится не меньше DEVICE_BULK_SLICE секунд, и снова встаёт
+в очередь — уже за ожидающими.
+
+Эмбеддинг запроса ждёт GPU не дольше DEVICE_INTERACTIVE_TIMEOUT секунд: если устройство
+держит загрузка другого процесса, запрос считается на CPU.
+
+Чтобы bulk не голодал при непрерывном потоке запросов, ему гарантируется доля
+DEVICE_BULK_MIN_SHARE времени устройства в этом процессе за последние
+DEVICE_SHARE_WINDOW секунд: пока доля ниже, bulk встаёт в очередь с приоритетом
+interactive.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+import config
+import funcs
+from GPU_control import BULK, INTERACTIVE, PRIORITIES, gpu, gpu_lock
+
+logger = logging.getLogger(__name__)
+
+
+class DeviceScheduler:
+    """Распределение времени устройства между запросами пользователей и загрузкой данных."""
+
+    def __init__(self, bulk_slice: float, bulk_min_share: float, share_window: float):
+        """
+        :param bulk_slice: Минимальная длительность слайса bulk в секундах.
+        :param bulk_min_share: Гарантированная доля времени устройства для bulk (0 — без гарантии).
+        :param share_window: Окно расчёта долей в секундах.
+        """
+        self.bulk_slice = bulk_slice
+        self.bulk_min_share = bulk_min_share
+        self.share_window = share_window
+        self.slices = 0
+        self.preemptions = 0
+        self.promotions = 0
+        self.cpu_fallbacks = 0
+        self._usage = deque()
+        self._mutex = threading.Lock()
+
+    @contextmanager
+    def interactive(self, timeout=config.DEVICE_INTERACTIVE_TIMEOUT):
+        """
+        Устройство для эмбеддинга запроса пользователя.
+
+        :param timeout: Ожидание GPU в секундах; если GPU не освободился, эмбеддинг считается на CPU.
+        """
+        if not gpu.acquire(INTERACTIVE, timeout):
+            with self._mutex:
+                self.cpu_fallbacks += 1
+            logger.warning("GPU занят дольше %s с, эмбеддинг запроса считается на CPU", timeout)
+            with funcs.embed_lock, funcs.use_device(funcs.model, funcs.cpu_device):
+                yield
+            return
+        try:
+            with funcs.embed_lock:
+                started = time.monotonic()
+                try:
+                    with funcs.use_device(funcs.model, funcs.device):
+                        yield
+                finally:
+                    self._record(INTERACTIVE, started)
+        finally:
+            gpu.release()
+
+    def run_bulk(self, steps):
+        """
+        Выполнение шагов загрузки слайсами с уступкой устройства ожидающим.
+
+        :param steps: Вызываемые без аргументов шаги (например, эмбеддинг одного пакета).
+        """
+        steps = iter(steps)
+        step = next(steps, None)
+        while step is not None:
+            priority = BULK
+            if self.bulk_share() < self.bulk_min_share:
+                priority = INTERACTIVE
+                with self._mutex:
+                    self.promotions += 1
+            with gpu_lock(priority=priority), funcs.embed_lock:
+                started = time.monotonic()
+                try:
+                    with funcs.use_device(funcs.model, funcs.device):
+                        while step is not None:
+                            step()
+                            step = next(steps, None)
+                            if step is not None and time.monotonic() - started >= self.bulk_slice \
+                                    and gpu.waiting():
+                                with self._mutex:
+                                    self.preemptions += 1
+                                logger.debug("Загрузка уступает GPU ожидающим")
+                                break
+                finally:
+                    with self._mutex:
+                        self.slices += 1
+                    self._record(BULK, started)
+
+    def bulk_share(self) -> float:
+        """Доля bulk во времени устройства за окно (1.0, если запросов пользователей не было)."""
+        busy = self._busy()
+        total = sum(busy.values())
+        if not busy[INTERACTIVE] or not total:
+            return 1.0
+        return busy[BULK] / total
+
+    def stats(self) -> dict:
+        """Занятость устройства по классам за окно и счётчики слайсов bulk."""
+        with self._mutex:
+            counters = {
+                "slices": self.slices,
+                "preemptions": self.preemptions,
+                "promotions": self.promotions,
+                "cpu_fallbacks": self.cpu_fallbacks,
+            }
+        return {
+            "window": self.share_window,
+            "busy": self._busy(),
+            "bulk_share": self.bulk_share(),
+            **counters,
+        }
+
+    def _record(self, priority: str, started: float):
+        now = time.monotonic()
+        with self._mutex:
+            self._usage.append((now, priority, now - started))
+
+    def _busy(self) -> dict:
+        busy = dict.fromkeys(PRIORITIES, 0.0)
+        with self._mutex:
+            horizon = time.monotonic() - self.share_window
+            while self._usage and self._usage[0][0] < horizon:
+                self._usage.popleft()
+            for _, priority, seconds in self._usage:
+                busy[priority] += seconds
+        return busy
+
+
+device_scheduler = DeviceScheduler(
+    config.DEVICE_BULK_SLICE, config.DEVICE_BULK_MIN_SHARE, config.DEVICE_SHARE_WINDOW
+)
@@ -1,6 +1,6 @@
 """
 Модуль содержит набор утилитарных функций для обработки текста,
-генерации эмбеддингов, очистки GPU памяти и работы с временными файлами.
+генерации эмбеддингов, очистки GPU памяти и сжатия потоковых ответов.
 Переменные:
 - model: загруженная модель 'intfloat/multilingual-e5-large'.
 - tokenizer: токенизатор для модели 'intfloat/multilingual-e5-large'.
@@ -8,13 +8,17 @@
 Примечание:
 Некоторые функции предполагают использование GPU, если оно доступно.
 """
-import os
+import asyncio
 import gc
 import logging
 import hashlib
+import json
 import re
-from pathlib import Path
+import threading
+import time
+import zlib
 from contextlib import contextmanager
+from typing import AsyncIterator
 
 import torch
 from torch import Tensor
@@ -29,10 +33,15 @@ model = AutoModel.from_pretrained(model_base_path)
 tokenizer = AutoTokenizer.from_pretrained(model_base_path)
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+cpu_device = torch.device('cpu')
 logging.warning(device)
 
 # model = model.to(device)
 
+# Модель переносится на устройство на время вычислений, поэтому потоки,
+# генерирующие эмбеддинги, работают с ней по очереди
+embed_lock = threading.Lock()
+
 @contextmanager
 def use_device(local_model, target_device):
     """Контекстный менеджер для временного переноса модели на указанное устройство."""
@@ -86,7 +95,8 @@ def generate_embedding(texts):
             padding=True,
             truncation=True,
             return_tensors='pt')
-    batch_dict = {key: value.to(device) for key, value in batch_dict.items()}
+    model_device = next(model.parameters()).device
+    batch_dict = {key: value.to(model_device) for key, value in batch_dict.items()}
     outputs = model(**batch_dict)
     embeddings = average_pool(outputs.last_hidden_state, batch_dict['attention_mask'])
 
@@ -106,10 +116,68 @@ def clear_gpu_memory():
         torch.cuda.empty_cache()
         gc.collect()
 
-def cleanup_temp_dir(temp_dir: Path):
-    """Очищает временную директорию от старых файлов"""
-    for file in temp_dir.glob("temp_users_*.json"):
+async def gzip_chunks(chunks: AsyncIterator[bytes]) -> AsyncIterator[bytes]:
+    """Потоковое gzip-сжатие последовательности байтовых фрагментов."""
+    compressor = zlib.compressobj(wbits=zlib.MAX_WBITS | 16)
+    async for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
+
+
+def format_sse(event: str, data: dict) -> bytes:
+    """Событие Server-Sent Events с данными в JSON."""
+    payload = json.dumps(data, ensure_ascii=False)
+    return f"event: {event}\ndata: {payload}\n\n".encode("utf-8")
+
+
+async def sse_stream(events: AsyncIterator[tuple[str, dict]]) -> AsyncIterator[bytes]:
+    """Преобразование последовательности событий (имя, данные) в поток SSE."""
+    async for event, data in events:
+        yield format_sse(event, data)
+
+
+class StageTimer:
+    """Замер длительности этапов обработки запроса для заголовка Server-Timing."""
+
+    def __init__(self):
+        self.timings = {}
+
+    @contextmanager
+    def stage(self, name: str):
+        """Контекстный менеджер, записывающий длительность этапа в миллисекундах."""
+        start = time.perf_counter()
         try:
-            os.remove(file)
-        except OSError:
-            pass
+            yield
+        finally:
+            self.timings[name] = (time.perf_counter() - start) * 1000
+
+    def server_timing(self) -> str:
+        """Значение заголовка Server-Timing."""
+        return ", ".join(
+            f"{name};dur={duration:.1f}" for name, duration in self.timings.items()
+        )
+
+
+class RateLimiter:
+    """Ограничение частоты: запросы выпускаются равномерно, не чаще rate в секунду."""
+
+    def __init__(self, rate: float):
+        """
+        :param rate: Запросов в секунду (0 — без ограничения).
+        """
+        self.interval = 1 / rate if rate > 0 else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Ожидание очередного разрешённого момента запроса."""
+        if not self.interval:
+            return
+        async with self._lock:
+            now = time.monotonic()
+            delay = self._next - now
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self._next = max(now, self._next) + self.interval
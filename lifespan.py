@@ -3,37 +3,92 @@
 APScheduler.
 
 Функции:
-- lifespan(app: FastAPI): Контекстный менеджер для запуска и остановки задач планировщика.
+- lifespan(app: FastAPI): Контекстный менеджер для запуска и остановки задач планировщика
+  и общего пула соединений Redis (app.state.redis) с локальным кэшем
+  тарифов и адресов (app.state.redis_cache), клиентов моделей AI и 1С, а также
+  общего подключения к Milvus с загруженными коллекциями поиска (milvus_connection).
 
 Задачи:
 - insert_promts_from_redis_to_milvus: Загрузка данных из Redis в Milvus.
 - upload_data_wiki_data_to_milvus: Загрузка данных из Wiki в Milvus.
+- users_snapshot.refresh: Пересборка снимка выгрузки пользователей.
+- users_refresh.run: Обновление ФИО пользователей из 1С (USERS_REFRESH_HOUR).
+- flush_usage_logs: Запись статистики вызовов моделей AI в PostgreSQL (LLM_USAGE_PERSIST).
 
 Планировщик:
-- Задачи выполняются ежедневно в 03:00.
+- Загрузка данных выполняется ежедневно в 03:00.
+- Пользователи обновляются из 1С ежедневно в USERS_REFRESH_HOUR:00.
+- Снимок пользователей пересобирается каждые USERS_SNAPSHOT_INTERVAL секунд.
 """
+import asyncio
 from contextlib import asynccontextmanager
+from datetime import datetime
 import logging
 from fastapi import FastAPI
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.cron import CronTrigger
+from apscheduler.triggers.interval import IntervalTrigger
+from redis.asyncio import Redis
+import ai
 from crud import insert_promts_from_redis_to_milvus, upload_data_wiki_data_to_milvus
-from redis import from_url
-import config 
+import config
+from client_1c import client_1c
+from database import milvus_connection
+from dependencies import create_redis_pool
+from llm_metrics import flush_usage_logs, init_usage_logs
+from milvus_schemas import (
+    address_schema, address_index_params, address_search_params,
+    promt_schema, promt_index_params, promt_search_params,
+    wiki_schema, wiki_index_params, wiki_search_params,
+)
+from redis_cache import RedisJSONCache
+from snapshots import users_snapshot
+from update_db import users_refresh
 
 scheduler = AsyncIOScheduler()
 logger = logging.getLogger(__name__)
 
+SEARCH_COLLECTIONS = (
+    ('Address', address_schema, address_index_params, address_search_params),
+    ('Promts', promt_schema, promt_index_params, promt_search_params),
+    ('Frida_bot_data', wiki_schema, wiki_index_params, wiki_search_params),
+)
+
+
+def open_milvus():
+    """Общее подключение к Milvus и загрузка коллекций поиска (недоступные загрузятся при первом поиске)."""
+    try:
+        milvus_connection.open()
+    except Exception as e:
+        logger.error("Не удалось подключиться к Milvus: %s", e)
+        return
+    for collection in SEARCH_COLLECTIONS:
+        try:
+            milvus_connection.collection(*collection)
+        except Exception as e:
+            logger.error("Не удалось загрузить коллекцию Milvus %s: %s", collection[0], e)
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Контекстный менеджер для запуска и остановки задач планировщика."""
     logger.info('START')
-    redis = from_url(
-        f"redis://{config.REDIS_HOST}:{config.REDIS_PORT}",
-        password=config.REDIS_PASSWORD,
-        decode_responses=True
+    redis_pool = create_redis_pool()
+    redis = Redis(connection_pool=redis_pool)
+    app.state.redis = redis
+    raw_redis_pool = create_redis_pool(decode_responses=False)
+    raw_redis = Redis(connection_pool=raw_redis_pool)
+    redis_cache = RedisJSONCache(
+        redis,
+        raw_redis,
+        ("terrtar:", "adds:"),
+        config.REDIS_CACHE_MAX_BYTES,
+        config.REDIS_CACHE_TTL,
     )
+    app.state.redis_cache = redis_cache
     try:
+        ai.init_clients()
+        await redis_cache.start()
+        await asyncio.to_thread(open_milvus)
         scheduler.add_job(
             insert_promts_from_redis_to_milvus,
             trigger=CronTrigger(hour=3, minute=0),
@@ -43,9 +98,42 @@ async def lifespan(app: FastAPI):
             upload_data_wiki_data_to_milvus,
             trigger=CronTrigger(hour=3, minute=0)
         )
+        if config.USERS_SNAPSHOT_INTERVAL:
+            scheduler.add_job(
+                users_snapshot.refresh,
+                trigger=IntervalTrigger(seconds=config.USERS_SNAPSHOT_INTERVAL),
+                args=[redis],
+                next_run_time=datetime.now(),
+                max_instances=1,
+                coalesce=True,
+            )
+        if config.USERS_REFRESH_HOUR is not None:
+            scheduler.add_job(
+                users_refresh.run,
+                trigger=CronTrigger(hour=config.USERS_REFRESH_HOUR, minute=0),
+                max_instances=1,
+                coalesce=True,
+            )
+        if config.LLM_USAGE_PERSIST:
+            await init_usage_logs()
+            scheduler.add_job(
+                flush_usage_logs,
+                trigger=IntervalTrigger(seconds=config.LLM_USAGE_FLUSH_INTERVAL),
+                max_instances=1,
+                coalesce=True,
+            )
         scheduler.start()
         yield
     finally:
         scheduler.shutdown()
-        redis.close()
+        await redis_cache.stop()
+        await ai.close_clients()
+        await client_1c.close()
+        await asyncio.to_thread(milvus_connection.close)
+        if config.LLM_USAGE_PERSIST:
+            await flush_usage_logs()
+        await redis.aclose()
+        await raw_redis.aclose()
+        await redis_pool.disconnect()
+        await raw_redis_pool.disconnect()
         logger.info('STOP')
@@ -0,0 +1,260 @@
+"""
+Статистика задержек, ошибок и использования токенов моделей AI.
+
+Используется диспетчером запросов в ai.get_ai для расчёта задержки перед
+параллельным (hedged) запросом к следующей модели, а также для метрик /v1/ai/metrics. При LLM_USAGE_PERSIST каждый вызов модели
+дополнительно сохраняется в таблицу llm_usage_logs (см. flush_usage_logs).
+"""
+
+import asyncio
+import bisect
+import logging
+import math
+import time
+from collections import Counter, deque
+from datetime import datetime, timezone
+from typing import Dict, Optional
+
+import config
+from database import PostgreSQL
+
+logger = logging.getLogger(__name__)
+
+# Границы корзин гистограмм задержек, секунды
+LATENCY_BUCKETS = (0.25, 0.5, 1, 2, 4, 8, 16, 32, 64)
+
+
+class Histogram:
+    """Гистограмма с фиксированными границами корзин (последняя корзина — +Inf)."""
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        """Учёт значения."""
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.total += value
+        self.count += 1
+
+    def snapshot(self) -> dict:
+        """Накопительные счётчики по корзинам (как в Prometheus), сумма и количество."""
+        cumulative = 0
+        buckets = {}
+        for bound, count in zip(self.buckets + (math.inf,), self.counts):
+            cumulative += count
+            buckets["+Inf" if bound == math.inf else str(bound)] = cumulative
+        return {"buckets": buckets, "sum": self.total, "count": self.count}
+
+
+class ModelStats:
+    """
+    Скользящая статистика одной модели: EWMA задержки и доли ошибок,
+    окно последних задержек для оценки p95, гистограммы и счётчики токенов.
+    """
+
+    def __init__(self, alpha: float = 0.2, window: int = 100):
+        """
+        :param alpha: Коэффициент сглаживания EWMA.
+        :param window: Количество последних успешных запросов для расчёта p95.
+        """
+        self.alpha = alpha
+        self.latency_ewma: Optional[float] = None
+        self.error_rate = 0.0
+        self.latencies = deque(maxlen=window)
+        self.successes = 0
+        self.failures = 0
+        self.cancelled = 0
+        self.retries = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.latency_histogram = Histogram()
+        self.ttfb_histogram = Histogram()
+        self.ttft_histogram = Histogram()
+
+    def record_success(self, latency: float):
+        """Учёт успешного запроса с его задержкой в секундах."""
+        self.successes += 1
+        self.latencies.append(latency)
+        self.latency_histogram.observe(latency)
+        if self.latency_ewma is None:
+            self.latency_ewma = latency
+        else:
+            self.latency_ewma += self.alpha * (latency - self.latency_ewma)
+        self.error_rate += self.alpha * (0.0 - self.error_rate)
+
+    def record_failure(self):
+        """Учёт неудачного запроса."""
+        self.failures += 1
+        self.error_rate += self.alpha * (1.0 - self.error_rate)
+
+    def record_tokens(self, prompt_tokens: Optional[int], completion_tokens: Optional[int]):
+        """Учёт использованных токенов."""
+        self.prompt_tokens += prompt_tokens or 0
+        self.completion_tokens += completion_tokens or 0
+
+    def p95(self) -> Optional[float]:
+        """95-й перцентиль задержки по окну или None, если данных нет."""
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, math.ceil(0.95 * len(ordered)) - 1)]
+
+    def snapshot(self) -> dict:
+        """Текущая статистика для диагностики."""
+        return {
+            "latency_ewma": self.latency_ewma,
+            "latency_p95": self.p95(),
+            "error_rate": self.error_rate,
+            "successes": self.successes,
+            "failures": self.failures,
+        }
+
+    def metrics(self) -> dict:
+        """Полные метрики модели: счётчики, токены и гистограммы."""
+        return {
+            **self.snapshot(),
+            "cancelled": self.cancelled,
+            "retries": self.retries,
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "latency": self.latency_histogram.snapshot(),
+            "ttfb": self.ttfb_histogram.snapshot(),
+            "ttft": self.ttft_histogram.snapshot(),
+        }
+
+
+model_stats: Dict[str, ModelStats] = {}
+
+# Переходы на резервную модель: (первая модель по порядку, ответившая модель) -> количество
+fallback_transitions: Counter = Counter()
+
+# Вызовы моделей, ожидающие записи в llm_usage_logs
+_usage_buffer = deque(maxlen=10000)
+_usage_table_ready = False
+
+started_at = datetime.now(timezone.utc)
+
+
+def get_model_stats(model: str) -> ModelStats:
+    """Статистика модели (создаётся при первом обращении)."""
+    stats = model_stats.get(model)
+    if stats is None:
+        stats = model_stats[model] = ModelStats()
+    return stats
+
+
+def record_call(
+    model: str,
+    status: str,
+    latency: float,
+    usage: Optional[dict] = None,
+    ttft: Optional[float] = None,
+    request_id: Optional[str] = None,
+    streamed: bool = False,
+):
+    """
+    Учёт завершённого вызова модели.
+
+    :param status: 'ok', 'error' или 'cancelled' (проигравший параллельный запрос).
+    :param latency: Длительность вызова в секундах.
+    :param usage: Количество токенов {"prompt_tokens": ..., "completion_tokens": ...}.
+    :param ttft: Время до первого фрагмента потокового ответа.
+    :param request_id: Идентификатор запроса пользователя (общий для всех попыток).
+    :param streamed: Потоковый ли вызов.
+    """
+    stats = get_model_stats(model)
+    usage = usage or {}
+    if status == "ok":
+        stats.record_success(latency)
+    elif status == "error":
+        stats.record_failure()
+    else:
+        stats.cancelled += 1
+    stats.record_tokens(usage.get("prompt_tokens"), usage.get("completion_tokens"))
+    if ttft is not None:
+        stats.ttft_histogram.observe(ttft)
+
+    if config.LLM_USAGE_PERSIST:
+        _usage_buffer.append((
+            datetime.now(timezone.utc), request_id, model, status, latency, ttft,
+            usage.get("prompt_tokens"), usage.get("completion_tokens"), streamed,
+        ))
+
+
+def record_retry(model: str):
+    """Учёт повторной попытки запроса к модели."""
+    get_model_stats(model).retries += 1
+
+
+def record_ttfb(model: str, seconds: float):
+    """Учёт времени до получения заголовков HTTP ответа провайдера."""
+    get_model_stats(model).ttfb_histogram.observe(seconds)
+
+
+def record_fallback(from_model: str, to_model: str):
+    """Учёт ответа резервной модели вместо первой по порядку."""
+    fallback_transitions[(from_model, to_model)] += 1
+
+
+def get_metrics() -> dict:
+    """Метрики всех моделей и переходы на резервные модели."""
+    return {
+        "since": started_at.isoformat(),
+        "models": {model: stats.metrics() for model, stats in model_stats.items()},
+        "fallbacks": [
+            {"from": from_model, "to": to_model, "count": count}
+            for (from_model, to_model), count in fallback_transitions.most_common()
+        ],
+        "pending_usage_logs": len(_usage_buffer),
+    }
+
+
+def _write_usage_logs(rows: list):
+    """Запись вызовов моделей в PostgreSQL; таблица создаётся один раз за время работы."""
+    global _usage_table_ready
+    postgres = PostgreSQL(**config.postgres_config)
+    try:
+        if not _usage_table_ready:
+            postgres.create_llm_usage_table()
+            _usage_table_ready = True
+        if rows:
+            postgres.log_llm_usage(rows)
+    finally:
+        postgres.connection_close()
+
+
+async def init_usage_logs():
+    """Создание таблицы llm_usage_logs при запуске; при ошибке повторяется при первой записи."""
+    try:
+        await asyncio.to_thread(_write_usage_logs, [])
+    except Exception as e:
+        logger.error("Ошибка при создании таблицы статистики моделей AI: %s", e)
+
+
+async def flush_usage_logs():
+    """Сохранение накопленных вызовов моделей в llm_usage_logs (задача планировщика)."""
+    rows = []
+    while _usage_buffer:
+        rows.append(_usage_buffer.popleft())
+    if not rows:
+        return
+    started = time.perf_counter()
+    try:
+        await asyncio.to_thread(_write_usage_logs, rows)
+    except Exception as e:
+        logger.error("Ошибка при сохранении статистики моделей AI: %s", e)
+        # Несохранённые записи возвращаются в начало буфера в исходном порядке;
+        # новые записи, появившиеся за время записи, не вытесняются —
+        # при нехватке места отбрасываются самые старые из несохранённых
+        room = _usage_buffer.maxlen - len(_usage_buffer)
+        if room < len(rows):
+            logger.warning("Отброшено %d записей статистики моделей AI", len(rows) - room)
+            rows = rows[len(rows) - room:]
+        _usage_buffer.extendleft(reversed(rows))
+        return
+    logger.info(
+        "Сохранено %d записей статистики моделей AI за %.2f с", len(rows), time.perf_counter() - started
+    )
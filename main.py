@@ -15,6 +15,7 @@ from routes.redis_routes import router as redis_router
 from routes.Frida_routes.auth_router import router as auth_router
 from routes.Frida_routes.milvus_router import router as milvus_router
 from routes.Frida_routes.ai_router import router as ai_router
+from routes.Frida_routes.ask_router import router as ask_router
 from routes.Frida_routes.logger_router import router as log_router
 
 app = FastAPI(
@@ -41,6 +42,7 @@ app.include_router(redis_router)
 app.include_router(auth_router)
 app.include_router(milvus_router)
 app.include_router(ai_router)
+app.include_router(ask_router)
 app.include_router(log_router)
 
 if __name__ == '__main__':
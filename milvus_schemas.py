@@ -68,8 +68,17 @@ wiki_schema = [
     FieldSchema(name='hash', dtype=DataType.VARCHAR, is_primary=True, max_length=255),
     FieldSchema(name='embedding', dtype=DataType.FLOAT_VECTOR, dim=1024),
     FieldSchema(name='text', dtype=DataType.VARCHAR, max_length=60000),
+    FieldSchema(name='book_name', dtype=DataType.VARCHAR, max_length=1024),
+    FieldSchema(name='url', dtype=DataType.VARCHAR, max_length=1024),
+    FieldSchema(name='title', dtype=DataType.VARCHAR, max_length=4096),
 ]
 
+# Поля, из которых контекст собирается прямо из ответа Milvus
+wiki_output_fields = ['text', 'book_name', 'url', 'title']
+
+# Максимальная длина заголовка, сохраняемого в поле title
+WIKI_TITLE_MAX_LENGTH = 1024
+
 wiki_index_params = {
     "index_type": "HNSW",
     "metric_type": "COSINE",
@@ -3,7 +3,7 @@
 Содержит схемы для запросов, ответов и логирования.
 """
 
-from typing import List, Literal, Optional
+from typing import Dict, List, Literal, Optional
 from pydantic import BaseModel, Field
 
 
@@ -80,6 +80,8 @@ class SearchResponseData(BaseModel):
     combined_context: str = Field(..., description="Контекст Вики")
     chat_history: str = Field(..., description="Отформатированная история диалога")
     hashs: List[str] = Field(..., description="ID контекстов которые используются")
+    context_tokens: Optional[int] = Field(None, description="Оценка размера контекста в токенах")
+    tokens_saved: int = Field(0, description="Сколько токенов сэкономлено сокращением контекста")
 
 
 class Search2ResponseData(BaseModel):
@@ -87,6 +89,8 @@ class Search2ResponseData(BaseModel):
 
     combined_context: str = Field(..., description="Контекст Вики")
     hashs: List[str] = Field(..., description="ID контекстов которые используются")
+    context_tokens: Optional[int] = Field(None, description="Оценка размера контекста в токенах")
+    tokens_saved: int = Field(0, description="Сколько токенов сэкономлено сокращением контекста")
 
 
 class AIRequest(BaseModel):
@@ -110,6 +114,30 @@ class AIResponse(BaseModel):
     ai_response: str
 
 
+class AskRequest(BaseModel):
+    """Запрос к боту: поиск контекста, ответ модели и запись в лог за один вызов."""
+
+    user_id: int = Field(..., description="ID пользователя")
+    text: str = Field(..., description="Текст запроса пользователя")
+    model: Optional[str] = Field(
+        default=None, description="Модель AI (если не указана — в порядке DEFAULT_MODEL_ORDER)"
+    )
+    stream: bool = Field(default=False, description="Отдавать ответ потоком Server-Sent Events")
+    log: bool = Field(default=True, description="Записать запрос и ответ в bot_logs")
+    category: str = Field(default="", description="Категория запроса для лога")
+
+
+class AskResponse(BaseModel):
+    """Ответ бота с использованными контекстами и длительностью этапов."""
+
+    ai_response: str
+    hashs: List[str] = Field(..., description="ID контекстов которые используются")
+    context_tokens: Optional[int] = Field(None, description="Оценка размера контекста в токенах")
+    tokens_saved: int = Field(0, description="Сколько токенов сэкономлено сокращением контекста")
+    timings: Dict[str, float] = Field(..., description="Длительность этапов в миллисекундах")
+    logged: bool = Field(..., description="Запрос записан в bot_logs")
+
+
 class LoggData(BaseModel):
     """Модель данных для логирования запросов."""
 
@@ -145,6 +173,13 @@ class RedisAddressModelResponse(BaseModel):
     addresses: List[RedisAddressModel]
 
 
+class RedisAddressBatchResponse(BaseModel):
+    """Схема ответа для пакетного запроса адресов по ID"""
+
+    addresses: List[RedisAddressModel]
+    not_found: List[str] = Field(default_factory=list, description="ID адресов, которых нет в Redis")
+
+
 class Employee1C(BaseModel):
     """Схема ответа от сервиса авторизации по телеграмм id"""
 
@@ -0,0 +1,188 @@
+"""
+Локальный кэш JSON-документов Redis с инвалидацией через CLIENT TRACKING.
+
+Отдельное соединение включает отслеживание в режиме BCAST для заданных префиксов
+ключей с перенаправлением уведомлений на само себя и подписывается на канал
+__redis__:invalidate. При любом изменении ключа с этими префиксами Redis
+присылает его имя, и запись удаляется из кэша.
+
+Пока соединение отслеживания не установлено, кэш не используется и запросы
+идут напрямую в Redis: без уведомлений нельзя гарантировать актуальность данных.
+"""
+
+import asyncio
+import json
+import logging
+
+from redis.asyncio import Redis
+
+from cache import LRUCache
+
+logger = logging.getLogger(__name__)
+
+INVALIDATE_CHANNEL = "__redis__:invalidate"
+PING_INTERVAL = 15
+RECONNECT_DELAY = 5
+
+class RedisJSONCache:
+    """
+    Read-through кэш JSON.GET для ключей с заданными префиксами.
+
+    Документы хранятся только в виде исходных байтов JSON, поэтому max_bytes
+    ограничивает фактический объём кэша; json_get разбирает документ при каждом
+    обращении и возвращает вызывающему собственную копию.
+    """
+
+    def __init__(
+        self, redis: Redis, raw_redis: Redis, prefixes, max_bytes: int, ttl: float | None = None
+    ):
+        """
+        :param redis: Клиент Redis с общим пулом соединений.
+        :param raw_redis: Клиент Redis без декодирования ответов (для чтения байтов JSON).
+        :param prefixes: Префиксы кэшируемых ключей.
+        :param max_bytes: Объём кэша в байтах (по размеру JSON документа).
+        :param ttl: Время жизни записи в секундах, страховка на случай потерянных уведомлений.
+        """
+        self.redis = redis
+        self.raw_redis = raw_redis
+        self.prefixes = tuple(prefixes)
+        self.cache = LRUCache(max_bytes, weigher=len, ttl=ttl)
+        self.tracking = False
+        self.invalidations = 0
+        self._task = None
+
+    async def start(self):
+        """Запуск фоновой задачи отслеживания инвалидаций."""
+        self._task = asyncio.create_task(self._listen())
+
+    async def stop(self):
+        """Остановка фоновой задачи и очистка кэша."""
+        if self._task:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        self.tracking = False
+        self.cache.clear()
+
+    async def json_get_raw(self, key: str) -> bytes | None:
+        """
+        Получение JSON документа по ключу в исходном виде, без разбора.
+
+        :return: Байты JSON или None, если ключа нет.
+        """
+        return await self._get_raw(key)
+
+    async def json_get(self, key: str):
+        """
+        Получение JSON документа по ключу, аналог redis.json().get(key).
+
+        :return: Разобранный документ или None, если ключа нет.
+        """
+        raw = await self._get_raw(key)
+        return json.loads(raw) if raw is not None else None
+
+    async def json_mget(self, keys) -> dict:
+        """
+        Получение нескольких JSON документов: из кэша и одним JSON.MGET для остальных.
+
+        :return: Словарь ключ -> разобранный документ (None, если ключа нет).
+        """
+        raws = {}
+        missing = []
+        for key in keys:
+            raw = None
+            if self.tracking and key.startswith(self.prefixes):
+                raw = self.cache.get(key)
+            if raw is not None:
+                raws[key] = raw
+            else:
+                missing.append(key)
+
+        if missing:
+            generation = self.cache.generation
+            tracking = self.tracking
+            values = await self.raw_redis.execute_command("JSON.MGET", *missing, ".")
+            fetched = {}
+            for key, raw in zip(missing, values):
+                raws[key] = raw
+                if raw is not None and tracking and key.startswith(self.prefixes):
+                    fetched[key] = raw
+            self.cache.set_many(fetched, generation)
+
+        return {key: json.loads(raw) if raw is not None else None for key, raw in raws.items()}
+
+    async def _get_raw(self, key: str) -> bytes | None:
+        """Байты JSON документа из кэша; при промахе читаются из Redis."""
+        cacheable = self.tracking and key.startswith(self.prefixes)
+        if cacheable:
+            raw = self.cache.get(key)
+            if raw is not None:
+                return raw
+
+        generation = self.cache.generation
+        raw = await self.raw_redis.execute_command("JSON.GET", key, ".")
+        if raw is not None and cacheable:
+            self.cache.set(key, raw, generation)
+        return raw
+
+    def stats(self) -> dict:
+        """Статистика кэша: попадания, промахи, объём и число инвалидаций."""
+        return {
+            **self.cache.stats(),
+            "tracking": self.tracking,
+            "invalidations": self.invalidations,
+        }
+
+    async def _listen(self):
+        """Поддержание соединения отслеживания с переподключением при ошибках."""
+        while True:
+            try:
+                await self._track()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Отслеживание инвалидаций Redis прервано: %s", e)
+            self.tracking = False
+            self.cache.clear()
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    async def _track(self):
+        """Включение CLIENT TRACKING на выделенном соединении и чтение уведомлений."""
+        pool = self.redis.connection_pool
+        connection = await pool.get_connection("CLIENT")
+        try:
+            await connection.send_command("CLIENT", "ID")
+            client_id = await connection.read_response()
+
+            prefix_args = [arg for prefix in self.prefixes for arg in ("PREFIX", prefix)]
+            await connection.send_command(
+                "CLIENT", "TRACKING", "ON", "REDIRECT", client_id, "BCAST", *prefix_args
+            )
+            await connection.read_response()
+
+            await connection.send_command("SUBSCRIBE", INVALIDATE_CHANNEL)
+            await connection.read_response()
+
+            self.cache.clear()
+            self.tracking = True
+            logger.info("Отслеживание ключей Redis включено: %s", ", ".join(self.prefixes))
+
+            while True:
+                message = await connection.read_response(timeout=PING_INTERVAL)
+                if message is None:
+                    await connection.send_command("PING")
+                    continue
+                if message[0] != "message" or message[1] != INVALIDATE_CHANNEL:
+                    continue
+                keys = message[2]
+                self.invalidations += 1
+                if keys is None:
+                    self.cache.clear()
+                else:
+                    self.cache.invalidate(keys)
+        finally:
+            self.tracking = False
+            await connection.disconnect()
+            await pool.release(connection)
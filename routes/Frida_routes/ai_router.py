@@ -5,10 +5,18 @@
 и получения ответов. Основной маршрут "/v1/ai" принимает данные запроса
 в формате AIRequest, отправляет их в модель и возвращает результат в виде
 AIResponse. В случае ошибок возвращается HTTP 500 с подробным описанием.
+Маршрут "/v1/ai/stream" отдаёт ответ потоком Server-Sent Events по мере генерации.
+Маршрут "/v1/ai/diagnostics" возвращает состояние выключателей и задержки моделей,
+"/v1/ai/cache_stats" — статистику кэша ответов, "/v1/ai/metrics" — гистограммы задержек,
+токены, повторные попытки и переходы на резервные модели.
 
 Функции:
     get_ai_response(request_data: AIRequest): 
     Асинхронно отправляет запрос к модели AI и возвращает ответ.
+    stream_ai_response(request_data: AIRequest):
+    Потоковый ответ модели AI в формате SSE.
+    get_ai_diagnostics():
+    Возвращает состояние автоматических выключателей и статистику моделей.
 
 Зависимости:
     - get_ai: функция для взаимодействия с моделью AI
@@ -17,8 +25,12 @@ AIResponse. В случае ошибок возвращается HTTP 500 с п
 
 import logging
 from fastapi import APIRouter, HTTPException
+from fastapi.responses import StreamingResponse
 
-from ai import get_ai
+from ai import get_ai, get_models_diagnostics, stream_ai
+from cache import ai_response_cache
+from funcs import sse_stream
+from llm_metrics import get_metrics
 from pyschemas import AIRequest, AIResponse
 
 router = APIRouter()
@@ -61,3 +73,64 @@ async def get_ai_response(
                 "error": str(e)
             }
         ) from e
+
+
+@router.post(
+    "/v1/ai/stream",
+    summary="Потоковый ответ модели AI",
+    description=(
+        "Отправляет запрос к модели AI и возвращает ответ потоком Server-Sent Events: "
+        "события token с фрагментами текста и итоговое событие done с моделью, "
+        "количеством токенов и временем до первого фрагмента (ttft) или error"
+    ),
+    tags=["AI"]
+)
+async def stream_ai_response(request_data: AIRequest):
+    """Потоковый ответ модели AI в формате SSE."""
+    logger.info("Received AI stream model: %s", request_data.model)
+    events = stream_ai(
+        request_data.text,
+        request_data.combined_context,
+        request_data.chat_history,
+        request_data.input_type,
+        request_data.model,
+    )
+    return StreamingResponse(
+        sse_stream(events),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get(
+    "/v1/ai/diagnostics",
+    summary="Состояние моделей AI",
+    description=(
+        "Возвращает состояние автоматических выключателей (closed, open, half_open), "
+        "долю ошибок и задержки по каждой модели"
+    ),
+    tags=["AI"]
+)
+async def get_ai_diagnostics():
+    """Состояние выключателей и статистика задержек моделей AI."""
+    return get_models_diagnostics()
+
+
+@router.get("/v1/ai/cache_stats", tags=["AI"])
+async def get_ai_cache_stats():
+    """Статистика кэша ответов AI: попадания точного и семантического уровней, объём"""
+    return ai_response_cache.stats()
+
+
+@router.get(
+    "/v1/ai/metrics",
+    summary="Метрики моделей AI",
+    description=(
+        "Гистограммы задержек, времени до заголовков ответа (ttfb) и до первого фрагмента "
+        "потока (ttft), количество токенов, повторных попыток и переходов на резервные модели"
+    ),
+    tags=["AI"]
+)
+async def get_ai_metrics():
+    """Метрики использования моделей AI с момента запуска."""
+    return get_metrics()
@@ -0,0 +1,125 @@
+"""
+Маршрут для ответа бота за один запрос.
+
+Маршрут "/v1/ask" выполняет на сервере то, для чего бот раньше делал три вызова
+(/v1/mlv_search, /v1/ai и /v1/log): поиск контекстов wiki параллельно с загрузкой
+истории диалога, сборку контекста под бюджет токенов модели, запрос к модели AI
+и запись в bot_logs. Ответ возвращается целиком (AskResponse) или потоком
+Server-Sent Events, если stream=true.
+
+Функции:
+    ask(request_data: AskRequest, response: Response):
+    Возвращает ответ модели с ID использованных контекстов и длительностью этапов.
+"""
+
+import asyncio
+import logging
+from contextlib import aclosing
+
+from fastapi import APIRouter, HTTPException, Response
+from fastapi.responses import StreamingResponse
+
+import crud
+from ai import context_budget, get_ai, resolve_models, stream_ai
+from funcs import StageTimer, sse_stream
+from pyschemas import AskRequest, AskResponse
+
+router = APIRouter()
+logger = logging.getLogger(__name__)
+
+
+@router.post(
+    "/v1/ask",
+    response_model=AskResponse,
+    summary="Ответ бота за один запрос",
+    description=(
+        "Поиск контекста, ответ модели AI и запись в лог одним вызовом. "
+        "При stream=true ответ отдаётся потоком Server-Sent Events: события token, "
+        "итоговое событие done дополнительно содержит hashs, timings и logged"
+    ),
+    tags=["AI"]
+)
+async def ask(request_data: AskRequest, response: Response):
+    """Отвечает на вопрос пользователя с поиском по wiki и записью в лог."""
+    resolve_models(request_data.model)
+    timer = StageTimer()
+    try:
+        search = await crud.search_milvus_and_prep_data(
+            request_data.text, request_data.user_id, timer, context_budget(request_data.model)
+        )
+    except Exception as e:
+        logger.error("Error in ask search: %s", e)
+        raise HTTPException(status_code=500, detail=str(e)) from e
+
+    if request_data.stream:
+        events = stream_ai(
+            request_data.text, search.combined_context, search.chat_history, 'text', request_data.model
+        )
+        return StreamingResponse(
+            sse_stream(_with_log(events, request_data, search, timer)),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    try:
+        with timer.stage('generate'):
+            answer = await get_ai(
+                request_data.text, search.combined_context, search.chat_history, 'text', request_data.model
+            )
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error("Error in ask generation: %s", e)
+        raise HTTPException(status_code=500, detail=str(e)) from e
+
+    logged = await _log(request_data, answer, search.hashs, timer)
+    response.headers["Server-Timing"] = timer.server_timing()
+    return AskResponse(
+        ai_response=answer,
+        hashs=search.hashs,
+        context_tokens=search.context_tokens,
+        tokens_saved=search.tokens_saved,
+        timings=timer.timings,
+        logged=logged,
+    )
+
+
+async def _log(request_data: AskRequest, answer: str, hashs, timer: StageTimer) -> bool:
+    """Запись ответа в bot_logs; ошибка записи не прерывает ответ пользователю."""
+    if not request_data.log:
+        return False
+    try:
+        with timer.stage('log'):
+            await asyncio.to_thread(
+                crud.log_message,
+                request_data.user_id, request_data.text, answer, True, hashs, request_data.category,
+            )
+        return True
+    except Exception as e:
+        logger.exception("Failed to log message %s: %s", request_data.text, e)
+        return False
+
+
+async def _with_log(events, request_data: AskRequest, search, timer: StageTimer):
+    """Пропускает события потока ответа, перед итоговым событием записывает ответ в лог."""
+    parts = []
+    with timer.stage('generate'):
+        async with aclosing(events) as stream:
+            async for event, data in stream:
+                if event == "token":
+                    parts.append(data["text"])
+                elif event == "done":
+                    break
+                yield event, data
+            else:
+                return
+
+    logged = await _log(request_data, "".join(parts), search.hashs, timer)
+    yield "done", {
+        **data,
+        "hashs": search.hashs,
+        "context_tokens": search.context_tokens,
+        "tokens_saved": search.tokens_saved,
+        "timings": timer.timings,
+        "logged": logged,
+    }
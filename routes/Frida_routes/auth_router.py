@@ -4,6 +4,8 @@
 Маршруты:
 - POST /v1/auth: Проверяет наличие пользователя и добавляет его в базу данных, если он отсутствует.
 - GET /v1/admins: Возвращает список всех администраторов системы.
+- GET /v1/auth/cache_stats: Статистика кэша проверок сотрудников в 1С.
+- GET /v1/users/refresh_stats: Итоги последнего обновления пользователей из 1С.
 
 Исключения:
 - HTTPException с кодом 500 при ошибках работы с базой данных или других внутренних ошибках.
@@ -11,14 +13,16 @@
 
 from typing import Dict, List
 
+import asyncio
 import logging
 
 from fastapi import APIRouter, HTTPException
 from pyschemas import AuthResponse, Employee1C, UserData
 
-import config
 import crud
-from database import PostgreSQL
+from client_1c import client_1c
+from cache import users_cache
+from update_db import users_refresh
 
 router = APIRouter()
 logger = logging.getLogger(__name__)
@@ -29,7 +33,6 @@ async def check_and_add_user(data: UserData):
     """
     Проверяет сотрудника в 1С, при наличии добавляет в БД (если нет), возвращает ФИО и должность.
     """
-    postgres = None
     try:
         # 1. Проверка в 1С
         if not data.user_id == 311362872:
@@ -46,14 +49,14 @@ async def check_and_add_user(data: UserData):
                 detail="Доступ запрещён: пользователь не является сотрудником.",
             )
 
-        # 2. Проверка в Postgres
-        postgres = PostgreSQL(**config.postgres_config)
-        if not postgres.user_exists(data.user_id):
-            postgres.add_user_to_db(
-                data.user_id, data.username,
-                fio.split()[1] if fio else data.firstname,
-                fio.split()[0] if fio else data.lastname
-            )
+        # 2. Добавление в Postgres, если пользователя там нет (один запрос)
+        created = await asyncio.to_thread(
+            crud.add_user,
+            data.user_id, data.username,
+            fio.split()[1] if fio else data.firstname,
+            fio.split()[0] if fio else data.lastname
+        )
+        if created:
             logger.info("User %s added to database.", data.user_id)
             status = "created"
             message = "User successfully added."
@@ -69,9 +72,6 @@ async def check_and_add_user(data: UserData):
     except Exception as e:
         logger.exception("Failed to check/add user %s: %s", data.user_id, e)
         raise HTTPException(status_code=500, detail="Internal server error") from e
-    finally:
-        if postgres:
-            postgres.connection_close()
 
 
 @router.get("/v1/admins", response_model=List[Dict[str, str]], tags=["Frida"])
@@ -86,10 +86,8 @@ async def get_all_admins():
     Raises:
         HTTPException: Если произошла ошибка при работе с базой данных
     """
-    postgres = None
     try:
-        postgres = PostgreSQL(**config.postgres_config)
-        admins = postgres.get_admins()
+        admins = await asyncio.to_thread(crud.get_admins)
         formatted_admins = [
             {"user_id": user_id, "username": username} for user_id, username in admins
         ]
@@ -99,6 +97,15 @@ async def get_all_admins():
         raise HTTPException(
             status_code=500, detail="Не удалось получить список администраторов"
         ) from e
-    finally:
-        if postgres:
-            postgres.connection_close()
+
+
+@router.get("/v1/auth/cache_stats", tags=["Frida"])
+async def get_auth_cache_stats():
+    """Статистика кэша проверок сотрудников в 1С и кэша известных пользователей бота"""
+    return {**client_1c.stats(), "users": users_cache.stats()}
+
+
+@router.get("/v1/users/refresh_stats", tags=["Frida"])
+async def get_users_refresh_stats():
+    """Итоги последнего обновления пользователей из 1С и признак выполнения"""
+    return {"running": users_refresh.running, "last_run": users_refresh.stats or None}
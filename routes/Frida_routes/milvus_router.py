@@ -4,24 +4,28 @@
 Этот модуль реализует следующие эндпоинты FastAPI:
 - /v1/mlv_search: Поиск в Milvus с учетом истории пользователя.
 - /v2/mlv_search: Поиск в Milvus без учета истории пользователя.
+  Контекст поиска сокращается до бюджета токенов модели (model) или max_context_tokens.
 - /v1/upload_wiki_data: Загрузка данных из базы wiki в Milvus (только для администраторов).
 - /v1/add_topic: Добавление новой темы в базу данных PostgreSQL и Milvus.
+- /v1/gpu_stats: Очередь и метрики блокировки GPU, доли времени устройства по классам.
 
 Зависимости:
 - crud: функции для работы с Milvus и базой данных.
-- config: настройки подключения к PostgreSQL.
-- database: класс для работы с PostgreSQL.
 - pyschemas: схемы для валидации и сериализации данных.
 
 """
 
+import asyncio
 import logging
-from fastapi import APIRouter, Body, HTTPException, Query, status, Depends
+from typing import Optional
+from fastapi import APIRouter, Body, HTTPException, Query, Response, status, Depends
 
 import crud
-from config import postgres_config
+from ai import context_budget
+from funcs import StageTimer
+from device_scheduler import device_scheduler
+from GPU_control import gpu
 
-from database import PostgreSQL
 from pyschemas import AddTopicRequest, Search2ResponseData, SearchParams, SearchResponseData
 
 router = APIRouter()
@@ -37,21 +41,33 @@ def get_search_params(
 
 @router.get("/v1/mlv_search", response_model=SearchResponseData, tags=["Milvus"])
 async def search_endpoint_with_history(
+    response: Response,
     params: SearchParams = Depends(get_search_params),
+    model: Optional[str] = Query(None, description="Модель, под бюджет которой сокращается контекст"),
+    max_context_tokens: Optional[int] = Query(None, ge=0, description="Бюджет контекста в токенах (0 — без ограничения)"),
 ):
-    """Поиск в Milvus с историей."""
+    """Поиск в Milvus с историей. Длительность этапов возвращается в заголовке Server-Timing."""
+    timer = StageTimer()
+    budget = max_context_tokens if max_context_tokens is not None else context_budget(model)
     try:
-        return await crud.search_milvus_and_prep_data(params.text, params.user_id)
+        result = await crud.search_milvus_and_prep_data(params.text, params.user_id, timer, budget)
+        response.headers["Server-Timing"] = timer.server_timing()
+        return result
     except Exception as e:
         logger.error("Error: %s", e)
         raise HTTPException(status_code=500, detail=str(e)) from e
 
 
 @router.get("/v2/mlv_search", response_model=Search2ResponseData, tags=["Milvus"])
-async def search_endpoint(text: str = Query(...)):
+async def search_endpoint(
+    text: str = Query(...),
+    model: Optional[str] = Query(None, description="Модель, под бюджет которой сокращается контекст"),
+    max_context_tokens: Optional[int] = Query(None, ge=0, description="Бюджет контекста в токенах (0 — без ограничения)"),
+):
     """Поиск в Milvus без истории."""
+    budget = max_context_tokens if max_context_tokens is not None else context_budget(model)
     try:
-        return await crud.search_milvus(text)
+        return await crud.search_milvus(text, budget_tokens=budget)
     except Exception as e:
         logger.error("Error: %s", e)
         raise HTTPException(status_code=500, detail=str(e)) from e
@@ -76,10 +92,8 @@ async def upload_wiki_data_from_mysqldb_to_milvus(user_data: dict = Body(...)):
                 detail="user_id is required in request body",
             )
 
-        postgres = PostgreSQL(**postgres_config)
-
         # Проверка прав администратора
-        if not postgres.check_user_is_admin(user_id):
+        if not await asyncio.to_thread(crud.check_user_is_admin, user_id):
             logger.warning(
                 "User %s attempted to upload wiki data without admin rights", user_id
             )
@@ -89,7 +103,7 @@ async def upload_wiki_data_from_mysqldb_to_milvus(user_data: dict = Body(...)):
             )
 
         # Загрузка данных
-        wiki_response = crud.insert_wiki_data()
+        wiki_response = await asyncio.to_thread(crud.insert_wiki_data)
         if not wiki_response:
             logger.error("Failed to insert wiki data")
             raise HTTPException(
@@ -98,8 +112,8 @@ async def upload_wiki_data_from_mysqldb_to_milvus(user_data: dict = Body(...)):
             )
 
         # Перенос данных в Milvus
-        milvus_data_count, deleted_data_count = (
-            crud.insert_all_data_from_postgres_to_milvus()
+        milvus_data_count, deleted_data_count = await asyncio.to_thread(
+            crud.insert_all_data_from_postgres_to_milvus
         )
 
         # Формирование ответа
@@ -127,9 +141,6 @@ async def upload_wiki_data_from_mysqldb_to_milvus(user_data: dict = Body(...)):
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Произошла непредвиденная ошибка при обработке запроса",
         ) from e
-    finally:
-        # Закрытие соединения с БД
-        postgres.connection_close()
 
 
 
@@ -148,7 +159,7 @@ async def add_topic_route(data: AddTopicRequest):
     Ожидает в теле запроса: {"title": str, "text": str, "user_id": int}
     """
     try:
-        result = crud.add_new_topic(data.title, data.text, data.user_id)
+        result = await asyncio.to_thread(crud.add_new_topic, data.title, data.text, data.user_id)
         if result is True:
             return {"status": "success", "message": "Тема успешно добавлена"}
         else:
@@ -165,3 +176,9 @@ async def add_topic_route(data: AddTopicRequest):
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail="Произошла непредвиденная ошибка при добавлении темы",
         ) from e
+
+
+@router.get("/v1/gpu_stats", tags=["Milvus"])
+async def get_gpu_stats():
+    """Блокировка GPU (держатель, очередь, ожидание и удержание по классам) и доли времени устройства"""
+    return {**gpu.stats(), "device": device_scheduler.stats()}
@@ -12,6 +12,7 @@
 Каждый маршрут обрабатывает возможные ошибки и возвращает соответствующие HTTP-ответы.
 """
 
+import asyncio
 import logging
 from typing import List
 
@@ -21,9 +22,10 @@ from torch import cuda
 
 import config
 import crud
+from dependencies import RedisDependency
 
 from milvus_schemas import address_schema, address_index_params, address_search_params
-from database import Milvus
+from database import Milvus, milvus_connection
 from pyschemas import AddressModel, Count, StatusResponse
 
 
@@ -31,22 +33,19 @@ router = APIRouter()
 logger = logging.getLogger(__name__)
 
 
+def _search_addresses(query: str):
+    """Поиск адресов в Milvus; блокирует поток на время ожидания GPU для эмбеддинга запроса."""
+    milvus_db = milvus_connection.collection(
+        'Address', address_schema, address_index_params, address_search_params
+    )
+    return milvus_db.search(query, ['text', 'house_id', 'flat'], limit=10)
+
+
 @router.get('/v1/address', response_model=List[AddressModel], tags=["ChatBot addresses"])
 async def get_address_from_text(query: str):
     """Получает адреса из Milvus по текстовому запросу."""
-    milvus_db = None
     try:
-        milvus_db = Milvus(
-            config.MILVUS_HOST,
-            config.MILVUS_PORT,
-            'Address',
-            address_schema,
-            address_index_params,
-            address_search_params
-        )
-
-        milvus_db.collection.load()
-        result = milvus_db.search(query, ['text', 'house_id', 'flat'], limit=10)
+        result = await asyncio.to_thread(_search_addresses, query)
         addresses_list = []
 
         for hit in result[0]:
@@ -67,10 +66,6 @@ async def get_address_from_text(query: str):
     except Exception as e:
         logger.error("Error in get_address_from_text: %s", e)
         raise HTTPException(status_code=500, detail=str(e)) from e
-    finally:
-        if milvus_db:
-            milvus_db.data_release()
-            milvus_db.connection_close()
 
 @router.post('/v1/addresses', response_model=StatusResponse, tags=["ChatBot addresses"])
 async def insert_addresses_to_milvus(data: List[List]):
@@ -95,11 +90,11 @@ async def insert_addresses_to_milvus(data: List[List]):
             milvus_db.connection_close()
 
 @router.post('/upload_address_data', response_model=StatusResponse, tags=["ChatBot addresses"])
-async def upload_address_data():
+async def upload_address_data(redis: RedisDependency):
     """Загружает адреса из Redis в Milvus."""
     try:
         logger.info("Uploading address data from Redis to Milvus")
-        await crud.insert_addresses_from_redis_to_milvus()
+        await crud.insert_addresses_from_redis_to_milvus(redis)
         return StatusResponse(status='success')
     except Exception as e:
         logger.error("Internal server error during data upload: %s", e)
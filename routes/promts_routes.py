@@ -17,11 +17,12 @@
     - pyschemas: Pydantic-модели для ответов API.
 
 """
+import asyncio
 from typing import Dict, List
 from fastapi import APIRouter, HTTPException
 import config
 import crud
-from database import Milvus
+from database import Milvus, milvus_connection
 from dependencies import RedisDependency
 from milvus_schemas import promt_schema, promt_index_params, promt_search_params
 from pyschemas import Count, PromtModel, StatusResponse
@@ -29,40 +30,35 @@ from pyschemas import Count, PromtModel, StatusResponse
 router = APIRouter()
 
 
+def _search_promts(query: str):
+    """Поиск промтов в Milvus; блокирует поток на время ожидания GPU для эмбеддинга запроса."""
+    milvus_db = milvus_connection.collection(
+        'Promts', promt_schema, promt_index_params, promt_search_params
+    )
+    return milvus_db.search(query, ['name', 'text'], limit=3)
+
+
 @router.get('/v1/promt', response_model=List[PromtModel], tags=["ChatBot promts"])
 async def get_promt_by_query(query: str):
     """Получает промты чат-бота из Milvus по текстовому запросу."""
-    try:
-        milvus_db = Milvus(
-            config.MILVUS_HOST,
-            config.MILVUS_PORT,
-            'Promts',
-            promt_schema,
-            promt_index_params,
-            promt_search_params
-        )
-        milvus_db.collection.load()
-        result = milvus_db.search(query, ['name', 'text'], limit=3)
-        promts_list = []
-        hits = result[0]
-        for hit in hits:
-            entity = hit.fields
-            promt_id = entity.get('hash', '')
-            name = entity.get('name', '')
-            template = entity.get('text', '')[9:]
-            params = entity.get('params', '')
-            if hit.distance < 0.42:
-                promts_list.append(PromtModel(id=promt_id,
-                                               name=name,
-                                               template=template,
-                                               params=params))
-        if promts_list:
-            return promts_list
-        else:
-            raise HTTPException(status_code=404, detail="Promts not found")
-    finally:
-        milvus_db.data_release()
-        milvus_db.connection_close()
+    result = await asyncio.to_thread(_search_promts, query)
+    promts_list = []
+    hits = result[0]
+    for hit in hits:
+        entity = hit.fields
+        promt_id = entity.get('hash', '')
+        name = entity.get('name', '')
+        template = entity.get('text', '')[9:]
+        params = entity.get('params', '')
+        if hit.distance < 0.42:
+            promts_list.append(PromtModel(id=promt_id,
+                                           name=name,
+                                           template=template,
+                                           params=params))
+    if promts_list:
+        return promts_list
+    else:
+        raise HTTPException(status_code=404, detail="Promts not found")
 
 @router.post('/v1/promts', response_model=StatusResponse, tags=["ChatBot promts"])
 async def insert_promts_to_milvus(data: Dict):
@@ -2,84 +2,126 @@
 Маршрут:
     GET /all_users_from_redis
 Описание:
-    - Получает все данные пользователей из Redis.
-    - Возвращает файл пользователю.
+    - Потоково выгружает данные пользователей из Redis (JSON-массив или NDJSON).
+    - Поддерживает gzip и продолжение выгрузки с курсора SCAN.
 Возвращает:
-    FileResponse: JSON-файл со всеми пользователями.
+    StreamingResponse: файл со всеми пользователями.
+
+Тарифы (terrtar:*) и адреса по ID (adds:*) читаются через локальный кэш
+с инвалидацией по CLIENT TRACKING, статистика кэша — GET /redis_cache_stats.
+Несколько адресов по ID можно получить одним запросом POST /redis_addresses_by_ids.
 """
 
 import json
+from email.utils import format_datetime, parsedate_to_datetime
 
-import os
-from pathlib import Path
-from typing import List
-import uuid
-from fastapi import APIRouter, HTTPException
-from fastapi.responses import FileResponse
+from typing import List, Literal
+from fastapi import APIRouter, Body, HTTPException, Query, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from redis.commands.search.query import Query as SearchQuery
 import crud
-from dependencies import RedisDependency
-from funcs import cleanup_temp_dir
-from pyschemas import RedisAddressModel, RedisAddressModelResponse
-
-router = APIRouter()
-
-
-@router.get("/all_users_from_redis", response_class=FileResponse, tags=["Redis"])
-async def get_all_users_data_from_redis(redis: RedisDependency):
-    """Получает все данные пользователей из Redis и возвращает их в виде JSON-файла."""
-    temp_dir = Path("temp_files")
-    temp_dir.mkdir(exist_ok=True)
-
-    cleanup_temp_dir(temp_dir)
-
-    temp_filename = None
-
-    try:
-        unique_keys = list(await crud.get_unique_keys_with_prefix())
-
-        result = []
-        batch_size = 1024
-
-        for i in range(0, len(unique_keys), batch_size):
-            batch_keys = unique_keys[i : i + batch_size]
-            values = await redis.json().mget(batch_keys, path="$")
+from dependencies import RedisCacheDependency, RedisDependency
+from funcs import gzip_chunks
+from snapshots import users_snapshot
+from pyschemas import RedisAddressBatchResponse, RedisAddressModel, RedisAddressModelResponse
 
-            cleaned_batch = []
-            for item in values:
-                if item and isinstance(item, list) and len(item) > 0:
-                    cleaned_batch.append(item[0])
+try:
+    import orjson  # noqa: F401  # pylint: disable=unused-import
+    from fastapi.responses import ORJSONResponse as FastJSONResponse
+except ImportError:
+    FastJSONResponse = JSONResponse
 
-            result.extend(cleaned_batch)
-
-        temp_filename = str(temp_dir / f"temp_users_{uuid.uuid4().hex}.json")
-
-        with open(temp_filename, "w", encoding="utf-8") as f:
-            json.dump(result, f, indent=4, ensure_ascii=False)
-
-        if not os.path.exists(temp_filename):
-            raise HTTPException(500, detail="Failed to create temporary file")
-
-        return FileResponse(
-            path=temp_filename,
-            media_type="application/json",
-            filename="users_data.json",
-        )
+router = APIRouter()
 
-    except Exception as e:
-        if temp_filename and os.path.exists(temp_filename):
-            os.remove(temp_filename)
-        raise HTTPException(500, detail=str(e)) from e
+# Поля документа adds:* для ответа RediSearch (JSONPath, имя в ответе).
+# id документа в ответе занят именем ключа, поэтому поле id возвращается как adds_id.
+ADDRESS_RETURN_FIELDS = (
+    ("$.id", "adds_id"),
+    ("$.addressShort", "addressShort"),
+    ("$.title", "title"),
+    ("$.territoryId", "territoryId"),
+    ("$.territory", "territory"),
+    ("$.conn_type", "conn_type"),
+)
+MAX_BATCH_IDS = 1000
+
+
+@router.get("/all_users_from_redis", response_class=StreamingResponse, tags=["Redis"])
+async def get_all_users_data_from_redis(
+    request: Request,
+    redis: RedisDependency,
+    output_format: Literal["json", "ndjson"] = Query("json", alias="format"),
+    gzip: bool = False,
+    cursor: int = Query(0, ge=0, description="Курсор SCAN для продолжения выгрузки"),
+    batches: int | None = Query(
+        None, ge=1, description="Количество шагов SCAN в странице (без параметра — весь набор)"
+    ),
+):
+    """
+    Потоково выгружает данные пользователей из Redis.
+
+    Документы читаются пакетами SCAN + JSON.MGET и сразу отправляются клиенту,
+    поэтому объём памяти не зависит от размера набора. При заданном batches
+    ответ содержит next_cursor для запроса следующей страницы.
+
+    Полная выгрузка в формате json отдаётся из периодически обновляемого снимка
+    с ETag и Last-Modified (если он уже собран) и поддерживает условные запросы.
+    """
+    headers = {
+        "Content-Disposition": f'attachment; filename="users_data.{output_format}"'
+    }
+    if users_snapshot.ready and output_format == "json" and cursor == 0 and batches is None:
+        return _snapshot_response(request, gzip, headers)
+
+    chunks = crud.stream_users_export(redis, output_format, cursor, batches)
+    if gzip:
+        chunks = gzip_chunks(chunks)
+        headers["Content-Encoding"] = "gzip"
+
+    media_type = "application/x-ndjson" if output_format == "ndjson" else "application/json"
+    return StreamingResponse(chunks, media_type=media_type, headers=headers)
+
+
+def _snapshot_response(request: Request, gzip: bool, headers: dict) -> Response:
+    """Ответ из снимка пользователей: 304, gzip или потоковая распаковка."""
+    gzipped = gzip or "gzip" in request.headers.get("accept-encoding", "")
+    headers = {
+        **headers,
+        "ETag": users_snapshot.etag_for(gzipped),
+        "Last-Modified": format_datetime(users_snapshot.last_modified, usegmt=True),
+        "Vary": "Accept-Encoding",
+    }
+    if_modified_since = None
+    if request.headers.get("if-modified-since"):
+        try:
+            if_modified_since = parsedate_to_datetime(request.headers["if-modified-since"])
+        except (TypeError, ValueError):
+            pass
+    if users_snapshot.not_modified(
+        request.headers.get("if-none-match"), if_modified_since, gzipped
+    ):
+        return Response(status_code=304, headers=headers)
+
+    if gzipped:
+        headers["Content-Encoding"] = "gzip"
+        return Response(users_snapshot.data, media_type="application/json", headers=headers)
+    return StreamingResponse(
+        users_snapshot.iter_decompressed(), media_type="application/json", headers=headers
+    )
 
 
 @router.get(
-    "/redis_addresses", tags=["Redis"], response_model=RedisAddressModelResponse
+    "/redis_addresses",
+    tags=["Redis"],
+    response_model=RedisAddressModelResponse,
+    response_class=FastJSONResponse,
 )
 async def get_addresses(query_address: str, redis: RedisDependency):
     """Получает все адреса из Redis"""
     try:
-        from redis.commands.search.query import Query
-
-        query = Query(query_address.lower()).paging(0, 40)
+        query = SearchQuery(query_address.lower()).paging(0, 40)
+        for path, alias in ADDRESS_RETURN_FIELDS:
+            query.return_field(path, as_field=alias)
         addresses = await redis.ft("idx:adds").search(query)
 
         if not addresses.docs:
@@ -87,17 +129,23 @@ async def get_addresses(query_address: str, redis: RedisDependency):
 
         addresses_models = []
         for doc in addresses.docs:
-            data = json.loads(doc.json)
-            if data["territoryId"] is not None:
+            territory_id = _projected_value(doc, "territoryId")
+            if territory_id is not None:
+                conn_type = _projected_value(doc, "conn_type")
                 addresses_models.append(
                     RedisAddressModel(
-                        id=data["id"],
-                        address=data.get("addressShort") or data.get("title", ""),
-                        territory_id=data["territoryId"],
-                        territory_name=data["territory"],
+                        id=doc.adds_id,
+                        address=_projected_value(doc, "addressShort")
+                        or _projected_value(doc, "title")
+                        or "",
+                        territory_id=territory_id,
+                        territory_name=_projected_value(doc, "territory"),
+                        conn_type=json.loads(conn_type) if conn_type else None,
                     )
                 )
-        return RedisAddressModelResponse(addresses=addresses_models)
+        return FastJSONResponse(
+            RedisAddressModelResponse(addresses=addresses_models).model_dump()
+        )
     except HTTPException:
         raise
     except Exception as e:
@@ -105,44 +153,99 @@ async def get_addresses(query_address: str, redis: RedisDependency):
 
 
 @router.get("/redis_address_by_id", tags=["Redis"], response_model=RedisAddressModel)
-async def get_address_by_id(address_id: str, redis: RedisDependency):
-    """Получает адрес по ID из Redis"""
+async def get_address_by_id(address_id: str, redis_cache: RedisCacheDependency):
+    """Получает адрес по ID из Redis (через локальный кэш)"""
     try:
-        address_result = await redis.json().get(f"adds:{address_id}")
+        address_result = await redis_cache.json_get(f"adds:{address_id}")
         if address_result is None:
             raise HTTPException(status_code=404, detail="Address not found")
-
-        if isinstance(address_result, str):
-            address_data = json.loads(address_result)
-        else:
-            address_data = address_result
-
-        return RedisAddressModel(
-            id=address_data["id"],
-            address=address_data.get("addressShort") or address_data.get("title", ""),
-            territory_id=address_data["territoryId"],
-            territory_name=address_data["territory"],
-            conn_type=address_data.get("conn_type")
-        )
+        return _address_from_document(address_result)
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e)) from e
 
 
+@router.post(
+    "/redis_addresses_by_ids",
+    tags=["Redis"],
+    response_model=RedisAddressBatchResponse,
+    response_class=FastJSONResponse,
+)
+async def get_addresses_by_ids(
+    redis_cache: RedisCacheDependency,
+    address_ids: List[str] = Body(..., max_length=MAX_BATCH_IDS),
+):
+    """
+    Получает несколько адресов по ID одним запросом.
+
+    Адреса из локального кэша отдаются сразу, остальные читаются одним JSON.MGET.
+    """
+    try:
+        documents = await redis_cache.json_mget(
+            [f"adds:{address_id}" for address_id in address_ids]
+        )
+        addresses_models = []
+        not_found = []
+        for address_id in address_ids:
+            document = documents.get(f"adds:{address_id}")
+            if document is None:
+                not_found.append(address_id)
+            else:
+                addresses_models.append(_address_from_document(document))
+        return FastJSONResponse(
+            RedisAddressBatchResponse(
+                addresses=addresses_models, not_found=not_found
+            ).model_dump()
+        )
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e)) from e
+
+
+def _projected_value(doc, field: str):
+    """Значение поля из ответа RediSearch с RETURN; JSON null и отсутствие поля — None."""
+    value = getattr(doc, field, None)
+    return None if value in (None, "null") else value
+
+
+def _address_from_document(address_result) -> RedisAddressModel:
+    """Модель адреса из JSON документа adds:*."""
+    if isinstance(address_result, str):
+        address_data = json.loads(address_result)
+    else:
+        address_data = address_result
+
+    return RedisAddressModel(
+        id=address_data["id"],
+        address=address_data.get("addressShort") or address_data.get("title", ""),
+        territory_id=address_data["territoryId"],
+        territory_name=address_data["territory"],
+        conn_type=address_data.get("conn_type")
+    )
+
+
 @router.get("/redis_tariffs", tags=["Redis"])
-async def get_tariffs(territory_id: str, redis: RedisDependency):
-    """Получает тарифы для конкретного territory_id из Redis"""
+async def get_tariffs(territory_id: str, redis_cache: RedisCacheDependency):
+    """
+    Получает тарифы для конкретного territory_id из Redis (через локальный кэш).
+
+    Документ отдаётся в том виде, в каком хранится в Redis, без разбора и повторной сериализации.
+    """
     try:
-        tariffs_result = await redis.json().get(f"terrtar:{territory_id}")
-        if tariffs_result is None:
+        tariffs_raw = await redis_cache.json_get_raw(f"terrtar:{territory_id}")
+        if tariffs_raw is None:
             raise HTTPException(status_code=404, detail="No tariffs found")
-        if isinstance(tariffs_result, str):
-            import json
-
-            tariffs_result = json.loads(tariffs_result)
-        return tariffs_result
+        if tariffs_raw.startswith(b'"'):
+            # Документ сохранён как JSON-строка с JSON внутри
+            return JSONResponse(json.loads(json.loads(tariffs_raw)))
+        return Response(content=tariffs_raw, media_type="application/json")
     except HTTPException:
         raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e)) from e
+
+
+@router.get("/redis_cache_stats", tags=["Redis"])
+async def get_redis_cache_stats(redis_cache: RedisCacheDependency):
+    """Статистика локального кэша тарифов и адресов: hit rate, объём, инвалидации"""
+    return redis_cache.stats()
@@ -0,0 +1,100 @@
+"""
+Снимок выгрузки пользователей из Redis.
+
+Снимок периодически пересобирается планировщиком (см. lifespan) и хранится в памяти
+в сжатом gzip виде вместе с ETag и временем последнего изменения, чтобы повторные
+выгрузки /all_users_from_redis не обходили всё пространство ключей Redis.
+"""
+
+import asyncio
+import hashlib
+import logging
+import zlib
+from datetime import datetime, timezone
+from typing import AsyncIterator
+
+from redis.asyncio import Redis
+
+import crud
+from funcs import gzip_chunks
+
+logger = logging.getLogger(__name__)
+
+DECOMPRESS_CHUNK_SIZE = 64 * 1024
+
+
+class UsersSnapshot:
+    """Сжатый снимок JSON-массива пользователей с ETag и Last-Modified."""
+
+    def __init__(self):
+        self.data: bytes | None = None
+        self.etag: str | None = None
+        self.last_modified: datetime | None = None
+        self.built_at: datetime | None = None
+        self._lock = asyncio.Lock()
+
+    @property
+    def ready(self) -> bool:
+        """Снимок собран хотя бы один раз."""
+        return self.data is not None
+
+    async def refresh(self, redis: Redis):
+        """
+        Пересборка снимка. Если содержимое не изменилось, ETag и Last-Modified сохраняются.
+
+        :param redis: Клиент Redis.
+        """
+        if self._lock.locked():
+            return
+        async with self._lock:
+            digest = hashlib.sha256()
+
+            async def hashed(chunks):
+                async for chunk in chunks:
+                    digest.update(chunk)
+                    yield chunk
+
+            buffer = bytearray()
+            try:
+                async for chunk in gzip_chunks(hashed(crud.stream_users_export(redis))):
+                    buffer.extend(chunk)
+            except Exception as e:
+                logger.error("Ошибка при сборке снимка пользователей: %s", e)
+                return
+
+            etag = f'"{digest.hexdigest()}"'
+            now = datetime.now(timezone.utc).replace(microsecond=0)
+            if etag != self.etag:
+                self.last_modified = now
+            self.data = bytes(buffer)
+            self.etag = etag
+            self.built_at = now
+            logger.info("Снимок пользователей обновлён: %d байт", len(self.data))
+
+    def etag_for(self, gzipped: bool) -> str:
+        """ETag представления: у сжатого и несжатого тела разные ETag (суффикс -gz)."""
+        return self.etag[:-1] + '-gz"' if gzipped else self.etag
+
+    def not_modified(
+        self, if_none_match: str | None, if_modified_since: datetime | None, gzipped: bool
+    ) -> bool:
+        """Проверка условного запроса по If-None-Match / If-Modified-Since для выбранного кодирования."""
+        if if_none_match is not None:
+            tags = {tag.strip().removeprefix("W/") for tag in if_none_match.split(",")}
+            return "*" in tags or self.etag_for(gzipped) in tags
+        if if_modified_since is not None and self.last_modified is not None:
+            return self.last_modified <= if_modified_since
+        return False
+
+    async def iter_decompressed(self) -> AsyncIterator[bytes]:
+        """Потоковая распаковка снимка для клиентов без поддержки gzip."""
+        data = self.data
+        decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+        for start in range(0, len(data), DECOMPRESS_CHUNK_SIZE):
+            chunk = decompressor.decompress(data[start : start + DECOMPRESS_CHUNK_SIZE])
+            if chunk:
+                yield chunk
+        yield decompressor.flush()
+
+
+users_snapshot = UsersSnapshot()
@@ -0,0 +1,51 @@
+import asyncio
+import unittest
+
+from crud import iter_keys_with_prefix
+
+
+class FakeRedis:
+    """SCAN по шаблону: каждый шаг возвращает один ключ, шаблон 'bad' падает на втором шаге."""
+
+    def __init__(self, steps=50):
+        self.steps = steps
+
+    async def scan(self, cursor, match, count):
+        await asyncio.sleep(0)
+        if match == 'bad' and cursor == 1:
+            raise ConnectionError('shard failed')
+        return (cursor + 1) % self.steps, [f'{match}{cursor}']
+
+
+class IterKeysWithPrefixTest(unittest.IsolatedAsyncioTestCase):
+    async def test_shard_error_is_raised_while_others_scan(self):
+        async def consume():
+            async for _ in iter_keys_with_prefix(
+                FakeRedis(), shards=['a', 'bad', 'b', 'c'], concurrency=2
+            ):
+                pass
+
+        with self.assertRaises(ConnectionError):
+            await asyncio.wait_for(consume(), timeout=5)
+        self.assertEqual(len(asyncio.all_tasks()), 1)
+
+    async def test_abandoned_generator_stops_producers(self):
+        keys = iter_keys_with_prefix(FakeRedis(), shards=['a', 'b', 'c'], concurrency=1)
+        self.assertEqual(await keys.__anext__(), ['a0'])
+        await asyncio.wait_for(keys.aclose(), timeout=5)
+        self.assertEqual(len(asyncio.all_tasks()), 1)
+
+    async def test_all_shards_are_scanned(self):
+        batches = [
+            keys async for keys in iter_keys_with_prefix(
+                FakeRedis(steps=3), shards=['a', 'b', 'c'], concurrency=2
+            )
+        ]
+        self.assertEqual(
+            sorted(key for keys in batches for key in keys),
+            ['a0', 'a1', 'a2', 'b0', 'b1', 'b2', 'c0', 'c1', 'c2'],
+        )
+
+
+if __name__ == '__main__':
+    unittest.main()
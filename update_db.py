@@ -1,40 +1,158 @@
+"""
+Обновление ФИО пользователей в Postgres по данным из 1С.
+
+Пользователи читаются страницами по user_id (USERS_REFRESH_BATCH_SIZE), для каждой
+страницы запросы к 1С выполняются параллельно (USERS_REFRESH_CONCURRENCY) с ограничением
+частоты (USERS_REFRESH_RATE), а изменения записываются одним UPDATE на страницу —
+только для пользователей, у которых имя действительно изменилось. Следующая страница
+читается, пока идут запросы к 1С по текущей.
+
+Задача запускается планировщиком (см. lifespan) или вручную: python update_db.py.
+Итоги последнего запуска — users_refresh.stats.
+"""
+
 import asyncio
 import logging
+import time
+from datetime import datetime, timezone
 
-from database import PostgreSQL
 import config
-from crud import auth_1c
+from client_1c import ACCESS_DENIED, client_1c
+from crud import auth_1c_many
+from database import PostgreSQL
+from funcs import RateLimiter
 from pyschemas import Employee1C
 
-logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-def update_users_from_1c():
-    """
-    Обновляет ФИО и должность всех пользователей в Postgres по данным из 1С.
-    """
-    postgres = PostgreSQL(**config.postgres_config)
-    try:
-        postgres.cursor.execute("SELECT user_id FROM users")
-        user_ids = [row[0] for row in postgres.cursor.fetchall()]
 
-        for user_id in user_ids:
+def _split_fio(fio: str):
+    """(first_name, last_name) из ФИО «Фамилия Имя Отчество» или None, если имени нет."""
+    parts = fio.split()
+    if len(parts) < 2:
+        return None
+    return parts[1], parts[0]
+
+
+class UsersRefresh:
+    """Задача обновления пользователей из 1С со статистикой последнего запуска."""
+
+    def __init__(self):
+        self.stats: dict = {}
+        self._lock = asyncio.Lock()
+
+    @property
+    def running(self) -> bool:
+        """Выполняется ли обновление."""
+        return self._lock.locked()
+
+    async def run(self) -> dict:
+        """
+        Обновление всех пользователей. Повторный запуск во время выполнения пропускается.
+
+        :return: Статистика запуска.
+        """
+        if self._lock.locked():
+            logger.info("Обновление пользователей из 1С уже выполняется")
+            return self.stats
+        async with self._lock:
+            stats = {
+                "started_at": datetime.now(timezone.utc).isoformat(),
+                "finished_at": None,
+                "duration": None,
+                "status": "running",
+                "scanned": 0,
+                "employees": 0,
+                "not_employees": 0,
+                "errors": 0,
+                "changed": 0,
+                "updated": 0,
+            }
+            self.stats = stats
+            started = time.perf_counter()
+            postgres = PostgreSQL(**config.postgres_config)
             try:
-                employee = asyncio.run(auth_1c(user_id))
-                if employee and isinstance(employee, Employee1C):
-                    firstname = employee.fio.split()[1]
-                    lastname = employee.fio.split()[0]
-                    postgres.cursor.execute(
-                        "UPDATE users SET first_name = %s, last_name = %s WHERE user_id = %s",
-                        (firstname, lastname, user_id)
-                    )
-                    postgres.connection.commit()
-                    logger.info(f"Пользователь {user_id} обновлён: {firstname}, {lastname}")
+                await self._refresh(postgres, stats)
+                stats["status"] = "ok"
             except Exception as e:
-                logger.warning(f"Ошибка при обновлении пользователя {user_id}: {e}")
-                postgres.connection.rollback()
+                stats["status"] = "error"
+                stats["error"] = str(e)
+                logger.exception("Ошибка при обновлении пользователей из 1С: %s", e)
+            finally:
+                postgres.connection_close()
+                stats["finished_at"] = datetime.now(timezone.utc).isoformat()
+                stats["duration"] = round(time.perf_counter() - started, 3)
+            logger.info(
+                "Обновление пользователей из 1С: проверено %d, изменено %d, ошибок %d за %.1f с",
+                stats["scanned"], stats["updated"], stats["errors"], stats["duration"],
+            )
+            return stats
+
+    async def _refresh(self, postgres: PostgreSQL, stats: dict):
+        batch_size = config.USERS_REFRESH_BATCH_SIZE
+        rate_limiter = RateLimiter(config.USERS_REFRESH_RATE)
+
+        page = await asyncio.to_thread(postgres.get_users_page, None, batch_size)
+        while page:
+            next_page = None
+            if len(page) == batch_size:
+                next_page = asyncio.create_task(
+                    asyncio.to_thread(postgres.get_users_page, page[-1][0], batch_size)
+                )
+            try:
+                employees = await auth_1c_many(
+                    [row[0] for row in page],
+                    concurrency=config.USERS_REFRESH_CONCURRENCY,
+                    rate_limiter=rate_limiter,
+                )
+                if next_page is not None:
+                    # Чтение и запись используют одно соединение, поэтому запись — после чтения
+                    await asyncio.shield(next_page)
+            except BaseException:
+                if next_page is not None:
+                    next_page.cancel()
+                raise
+
+            changes = []
+            for user_id, first_name, last_name in page:
+                stats["scanned"] += 1
+                employee = employees.get(user_id)
+                if not isinstance(employee, Employee1C):
+                    if employee is not None and employee.get("error") == ACCESS_DENIED:
+                        stats["not_employees"] += 1
+                    else:
+                        stats["errors"] += 1
+                    continue
+                stats["employees"] += 1
+                names = _split_fio(employee.fio)
+                if names is None:
+                    logger.warning("Пользователь %s: неполное ФИО в 1С: %s", user_id, employee.fio)
+                    continue
+                if names != (first_name, last_name):
+                    changes.append((user_id, *names))
+
+            stats["changed"] += len(changes)
+            stats["updated"] += await asyncio.to_thread(postgres.update_users_names, changes)
+            page = next_page.result() if next_page is not None else []
+
+
+users_refresh = UsersRefresh()
+
+
+async def _main():
+    try:
+        return await users_refresh.run()
     finally:
-        postgres.connection_close()
+        await client_1c.close()
+
+
+def update_users_from_1c():
+    """
+    Обновляет ФИО всех пользователей в Postgres по данным из 1С.
+    """
+    return asyncio.run(_main())
+
 
 if __name__ == "__main__":
-    update_users_from_1c()
\ No newline at end of file
+    logging.basicConfig(level=logging.INFO)
+    update_users_from_1c()